@@ -1,6 +1,9 @@
 from pathlib import Path
 import re
+import json
+import hashlib
 
+import numpy as np
 import peft
 import torch
 from torch import nn
@@ -8,10 +11,11 @@ import torch.nn.functional as F
 import safetensors.torch
 import torchvision
 from PIL import Image, ImageOps
-from torchvision import transforms
-import imageio
 
 from utils.common import is_main_process, VIDEO_EXTENSIONS, round_to_nearest_multiple, round_down_to_multiple
+from utils.media_probe import get_video_backend, DEFAULT_VIDEO_BACKEND
+from utils.frame_cache import FrameCache
+from utils.latent_store import hash_module
 
 
 def make_contiguous(*tensors):
@@ -42,6 +46,11 @@ def extract_clips(video, target_frames, video_clip_mode):
         raise NotImplementedError(f'video_clip_mode={video_clip_mode} is not recognized')
 
 
+# uint8 (channels, ...) in [0, 255] -> float in [-1, 1]. Same result as ToTensor() followed by Normalize([0.5], [0.5]).
+def uint8_to_model_input(tensor):
+    return tensor.float().div(255).sub(0.5).div(0.5)
+
+
 def convert_crop_and_resize(pil_img, width_and_height):
     if pil_img.mode not in ['RGB', 'RGBA'] and 'transparency' in pil_img.info:
         pil_img = pil_img.convert('RGBA')
@@ -62,7 +71,6 @@ class PreprocessMediaFile:
         self.config = config
         self.video_clip_mode = config.get('video_clip_mode', 'single_beginning')
         print(f'using video_clip_mode={self.video_clip_mode}')
-        self.pil_to_tensor = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
         self.support_video = support_video
         self.framerate = framerate
         self.round_height = round_height
@@ -70,16 +78,43 @@ class PreprocessMediaFile:
         self.round_frames = round_frames
         if self.support_video:
             assert self.framerate
+            # Must be the same backend the dataset metadata was probed with, so frame counts agree.
+            self.video_backend = get_video_backend(config.get('video_backend', DEFAULT_VIDEO_BACKEND), self.framerate)
+        # Optional cache of decoded and resized video clips, shared by all models and VAEs.
+        self.frame_cache = FrameCache(config['frame_cache_dir']) if self.support_video and 'frame_cache_dir' in config else None
+
+    # Everything besides the file itself that determines the output for a size bucket. Part of cache keys.
+    def get_cache_params(self, size_bucket):
+        return {'size_bucket': list(size_bucket), **self.get_fixed_cache_params()}
+
+    # The part of get_cache_params() that is the same for every size bucket.
+    def get_fixed_cache_params(self):
+        return {
+            'framerate': self.framerate,
+            'video_backend': self.video_backend.name if self.support_video else None,
+            'video_clip_mode': self.video_clip_mode,
+            'rounding': [self.round_width, self.round_height, self.round_frames],
+        }
 
     def __call__(self, filepath, mask_filepath, size_bucket=None):
         is_video = (Path(filepath).suffix in VIDEO_EXTENSIONS)
-        if is_video:
+        frame_cache_key = None
+        cached_clips = None
+        if is_video and self.frame_cache is not None and size_bucket is not None:
+            frame_cache_key = self.frame_cache.key(filepath, **self.get_cache_params(size_bucket))
+            cached_clips = self.frame_cache.load(frame_cache_key)
+
+        if cached_clips is not None:
+            # The video isn't decoded. The resolution is only needed to check the mask.
+            num_frames = None
+            if mask_filepath:
+                meta = self.video_backend.probe(filepath, exact=False)
+                height, width = meta['height'], meta['width']
+        elif is_video:
             assert self.support_video
-            num_frames = 0
-            for frame in imageio.v3.imiter(filepath, fps=self.framerate):
-                num_frames += 1
-                height, width = frame.shape[:2]
-            video = imageio.v3.imiter(filepath, fps=self.framerate)
+            meta = self.video_backend.probe(filepath, exact=True)
+            num_frames, height, width = meta['frames'], meta['height'], meta['width']
+            video = self.video_backend.iter_frames(filepath)
         else:
             num_frames = 1
             pil_img = Image.open(filepath)
@@ -111,27 +146,47 @@ class PreprocessMediaFile:
         else:
             mask = None
 
-        resized_video = torch.empty((num_frames, 3, height_rounded, width_rounded))
-        for i, frame in enumerate(video):
+        if cached_clips is not None:
+            return [(uint8_to_model_input(torch.from_numpy(np.array(clip))), mask) for clip in cached_clips]
+
+        # Frames are kept as uint8 until the end, which is also the format of the frame cache.
+        # Sized from the probed frame count, which for constant framerate video comes from the container header.
+        resized_video = torch.empty((num_frames, height_rounded, width_rounded, 3), dtype=torch.uint8)
+        decoded_frames = 0
+        for frame in video:
+            if decoded_frames == num_frames:
+                raise ValueError(f'{filepath} decoded to more frames than the {num_frames} its metadata reports. Re-encode the video.')
             if not isinstance(frame, Image.Image):
                 frame = torchvision.transforms.functional.to_pil_image(frame)
             cropped_image = convert_crop_and_resize(frame, resize_wh)
-            resized_video[i, ...] = self.pil_to_tensor(cropped_image)
-
+            resized_video[decoded_frames].numpy()[...] = np.asarray(cropped_image)
+            decoded_frames += 1
+        if decoded_frames < num_frames:
+            # Never encode the uninitialized tail. The clips are extracted from the frames that were decoded.
+            print(f'WARNING: {filepath} decoded to {decoded_frames} frames, its metadata reports {num_frames}')
+            resized_video = resized_video[:decoded_frames]
+
+        # (num_frames, height, width, channels) -> (channels, num_frames, height, width)
+        resized_video = torch.permute(resized_video, (3, 0, 1, 2))
         if not self.support_video:
-            return [(resized_video.squeeze(0), mask)]
+            return [(uint8_to_model_input(resized_video.squeeze(1)), mask)]
 
-        # (num_frames, channels, height, width) -> (channels, num_frames, height, width)
-        resized_video = torch.permute(resized_video, (1, 0, 2, 3))
         if not is_video:
-            return [(resized_video, mask)]
+            return [(uint8_to_model_input(resized_video), mask)]
         else:
             videos = extract_clips(resized_video, frames_rounded, self.video_clip_mode)
-            return [(video, mask) for video in videos]
+            if frame_cache_key is not None and len(videos) > 0:
+                self.frame_cache.save(frame_cache_key, torch.stack(videos).numpy())
+            return [(uint8_to_model_input(video), mask) for video in videos]
 
 
 class BasePipeline:
     framerate = None
+    # Whether prepare_inputs() decodes latents stored with latent_cache_codec.
+    supports_latent_codec = False
+    # Frames per latent frame if the VAE is causal in time (latent frame t only depends on frames up to 4t for
+    # a factor of 4), else None. Allows latent_prefix_reuse.
+    causal_vae_temporal_compression = None
 
     def load_diffusion_model(self):
         pass
@@ -205,9 +260,36 @@ class BasePipeline:
     def get_call_vae_fn(self, vae):
         raise NotImplementedError()
 
+    # JSON serializable description of the VAE and how it's called, for keys of the latent store. Anything that
+    # changes the encoded latents must change this. The default is the VAE class, its config and a hash of its
+    # weights. Hashing the weights takes a few seconds, set vae_identity to any string to skip it.
+    def get_vae_identity(self):
+        if vae_identity := self.config['model'].get('vae_identity', None):
+            return vae_identity
+        vae = self.get_vae()
+        config = getattr(vae, 'config', None)
+        return {
+            'model': self.name,
+            'vae_class': type(vae).__name__,
+            'config': None if config is None else hashlib.sha256(json.dumps(dict(config), sort_keys=True, default=str).encode()).hexdigest(),
+            'weights': hash_module(vae),
+        }
+
     def get_call_text_encoder_fn(self, text_encoder):
         raise NotImplementedError()
 
+    # JSON serializable description of text encoder i (starting at 1) and how it's called, e.g. the max length,
+    # for keys of the text embedding cache. Cached embeddings of a caption are reused as long as this is the same.
+    # None if there's nothing beyond the model type, which already separates caches.
+    def get_text_encoder_identity(self, i):
+        return None
+
+    # Text encoder outputs that are padded along their first (sequence) dimension, {output key: attention mask key}.
+    # They are cached trimmed to the attention mask length, and the dataset pads them back to the longest one in
+    # each batch, so the model must accept any sequence length. Padding is assumed to be on the right.
+    def get_variable_length_text_embeddings(self):
+        return {}
+
     def prepare_inputs(self, inputs, timestep_quantile=None):
         raise NotImplementedError()
 
@@ -16,6 +16,9 @@ from loguru import logger
 from models.base import BasePipeline, PreprocessMediaFile, make_contiguous
 from utils.common import AUTOCAST_DTYPE, load_safetensors
 from utils.offloading import ModelOffloader
+from utils.latent_codec import decode_latents
+from utils.latent_store import hash_path
+from utils.prefix_kv_cache import PrefixKVCache
 from hyvideo.config import add_network_args, add_extra_models_args, add_denoise_schedule_args, add_inference_args, sanity_check_args
 from hyvideo.modules import load_model
 from hyvideo.vae import load_vae
@@ -190,6 +193,8 @@ def vae_encode(tensor, vae):
 class HunyuanVideoPipeline(BasePipeline):
     name = 'hunyuan-video'
     framerate = 24
+    supports_latent_codec = True
+    causal_vae_temporal_compression = 4
     checkpointable_layers = ['DoubleBlock', 'SingleBlock']
     adapter_target_modules = ['MMDoubleStreamBlock', 'MMSingleStreamBlock']
 
@@ -364,6 +369,37 @@ class HunyuanVideoPipeline(BasePipeline):
             return {'latents': vae_encode(tensor.to(vae.device, vae.dtype), vae)}
         return fn
 
+    def get_vae_identity(self):
+        # Hashing the weights takes a few seconds. Set vae_identity to any string to skip it.
+        if vae_identity := self.model_config.get('vae_identity', None):
+            return vae_identity
+        vae_path = self.model_config.get('vae_path', os.path.join(self.args.model_base, 'hunyuan-video-t2v-720p/vae'))
+        return {'model': self.name, 'vae': hash_path(vae_path), 'dtype': str(self.model_config['dtype']), 'tiling': True}
+
+    def get_text_encoder_identity(self, i):
+        dtype = str(self.model_config['dtype'])
+        if i == 1:
+            return {
+                'text_encoder': self.args.text_encoder,
+                'path': self.model_config.get('llm_path', os.path.join(self.args.model_base, 'text_encoder')),
+                'dtype': dtype,
+                'max_length': [self.max_text_length_video, self.max_text_length_image],
+                'prompt_template': [self.args.prompt_template_video, self.args.prompt_template],
+                'hidden_state_skip_layer': self.args.hidden_state_skip_layer,
+                'apply_final_norm': self.args.apply_final_norm,
+            }
+        return {
+            'text_encoder': self.args.text_encoder_2,
+            'path': self.model_config.get('clip_path', os.path.join(self.args.model_base, 'text_encoder_2')),
+            'dtype': dtype,
+            'max_length': self.args.text_len_2,
+        }
+
+    # The LLM hidden states are padded to max_text_length_video, but most captions are far shorter. The CLIP
+    # output is pooled, so it has no sequence dimension.
+    def get_variable_length_text_embeddings(self):
+        return {'prompt_embeds_1': 'prompt_attention_mask_1'}
+
     def get_call_text_encoder_fn(self, text_encoder):
         if text_encoder == self.text_encoder:
             text_encoder_idx = 1
@@ -371,38 +407,50 @@ class HunyuanVideoPipeline(BasePipeline):
             text_encoder_idx = 2
         else:
             raise RuntimeError()
+        prefix_kv_cache = None
+        if text_encoder_idx == 1 and self.model_config.get('llm_prefix_kv_cache', True):
+            prefix_kv_cache = PrefixKVCache(text_encoder.model)
         def fn(caption, is_video):
             # args are lists
-            prompt_embeds, prompt_attention_masks = [], []
-            # need to use a loop because is_video might be different for each one
-            for caption, is_video in zip(caption, is_video):
-                if is_video:
-                    # This is tricky. The text encoder will crop off the prompt correctly based on the data_type, but the offical code only sets the max
-                    # length (which needs to be set accordingly to the prompt) once. So we have to do it here each time.
-                    if text_encoder_idx == 1:
-                        text_encoder.max_length = self.max_text_length_video
-                    data_type = 'video'
+            prompt_embeds = [None] * len(caption)
+            prompt_attention_masks = [None] * len(caption)
+            # is_video selects the prompt template, so encode all captions of each data type as one batch, and put
+            # the results back in the original order.
+            for data_type in ('image', 'video'):
+                indices = [i for i, v in enumerate(is_video) if bool(v) == (data_type == 'video')]
+                if len(indices) == 0:
+                    continue
+                # This is tricky. The text encoder will crop off the prompt correctly based on the data_type, but the offical code only sets the max
+                # length (which needs to be set accordingly to the prompt) once. So we have to do it here each time.
+                if text_encoder_idx == 1:
+                    text_encoder.max_length = self.max_text_length_video if data_type == 'video' else self.max_text_length_image
+                if text_encoder_idx == 1 and prefix_kv_cache is not None and text_encoder.use_template:
+                    prompt_embed, prompt_mask = self._encode_llm_with_prefix_kv_cache(
+                        prefix_kv_cache,
+                        text_encoder,
+                        [caption[i] for i in indices],
+                        device=next(text_encoder.parameters()).device,
+                        data_type=data_type,
+                    )
                 else:
-                    if text_encoder_idx == 1:
-                        text_encoder.max_length = self.max_text_length_image
-                    data_type = 'image'
-                (
-                    prompt_embed,
-                    negative_prompt_embed,
-                    prompt_mask,
-                    negative_prompt_mask,
-                ) = self.encode_prompt(
-                    caption,
-                    device=next(text_encoder.parameters()).device,
-                    num_videos_per_prompt=1,
-                    do_classifier_free_guidance=False,
-                    text_encoder=text_encoder,
-                    data_type=data_type,
-                )
-                prompt_embeds.append(prompt_embed)
-                prompt_attention_masks.append(prompt_mask)
-            prompt_embeds = torch.cat(prompt_embeds)
-            prompt_attention_masks = torch.cat(prompt_attention_masks)
+                    (
+                        prompt_embed,
+                        negative_prompt_embed,
+                        prompt_mask,
+                        negative_prompt_mask,
+                    ) = self.encode_prompt(
+                        [caption[i] for i in indices],
+                        device=next(text_encoder.parameters()).device,
+                        num_videos_per_prompt=1,
+                        do_classifier_free_guidance=False,
+                        text_encoder=text_encoder,
+                        data_type=data_type,
+                    )
+                for j, i in enumerate(indices):
+                    prompt_embeds[i] = prompt_embed[j]
+                    prompt_attention_masks[i] = prompt_mask[j]
+            prompt_embeds = torch.stack(prompt_embeds)
+            prompt_attention_masks = torch.stack(prompt_attention_masks)
             if text_encoder_idx == 1:
                 return {'prompt_embeds_1': prompt_embeds, 'prompt_attention_mask_1': prompt_attention_masks}
             elif text_encoder_idx == 2:
@@ -411,8 +459,29 @@ class HunyuanVideoPipeline(BasePipeline):
                 raise RuntimeError()
         return fn
 
+    # Same result as encode_prompt() for the LLM text encoder (see TextEncoder.encode in hyvideo), but the prompt
+    # template prefix that encode() crops off is encoded once per template, see PrefixKVCache.
+    def _encode_llm_with_prefix_kv_cache(self, prefix_kv_cache, text_encoder, captions, device, data_type):
+        prompt_template = text_encoder.prompt_template_video if data_type == 'video' else text_encoder.prompt_template
+        crop_start = prompt_template.get('crop_start', -1)
+        text_inputs = text_encoder.text2tokens(captions, data_type=data_type)
+        input_ids = text_inputs['input_ids'].to(device)
+        attention_mask = text_inputs['attention_mask'].to(device) if text_encoder.use_attention_mask else None
+        if crop_start <= 0 or crop_start >= input_ids.shape[1]:
+            outputs = text_encoder.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+            last_hidden_state, hidden_states = outputs.last_hidden_state, outputs.hidden_states
+        else:
+            last_hidden_state, hidden_states = prefix_kv_cache.forward(input_ids, attention_mask, crop_start)
+            attention_mask = attention_mask[:, crop_start:] if attention_mask is not None else None
+        hidden_state_skip_layer = text_encoder.hidden_state_skip_layer
+        if hidden_state_skip_layer is not None:
+            last_hidden_state = hidden_states[-(hidden_state_skip_layer + 1)]
+            if hidden_state_skip_layer > 0 and text_encoder.apply_final_norm:
+                last_hidden_state = text_encoder.model.final_layer_norm(last_hidden_state)
+        return last_hidden_state.to(dtype=text_encoder.dtype, device=device), attention_mask
+
     def prepare_inputs(self, inputs, timestep_quantile=None):
-        latents = inputs['latents'].float()
+        latents = decode_latents(inputs['latents'], inputs.get('latents_scale', None), inputs.get('latents_shift', None))
         prompt_embeds_1 = inputs['prompt_embeds_1']
         prompt_attention_mask_1 = inputs['prompt_attention_mask_1']
         prompt_embeds_2 = inputs['prompt_embeds_2']
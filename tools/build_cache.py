@@ -0,0 +1,106 @@
+# Builds the dataset cache without launching training. The media files are split into --num_shards deterministic
+# shards, so several machines (or several GPUs on one machine) can each cache one shard, all writing to the same
+# cache directories. A final --merge run combines the shard metadata and writes the same cache layout
+# DatasetManager.cache() expects, so training starts without encoding anything.
+# Example, two shards on two GPUs, then merge:
+#   CUDA_VISIBLE_DEVICES=0 python tools/build_cache.py --config config.toml --num_shards 2 --shard 0 --master_port 29500 &
+#   CUDA_VISIBLE_DEVICES=1 python tools/build_cache.py --config config.toml --num_shards 2 --shard 1 --master_port 29501 &
+#   wait
+#   python tools/build_cache.py --config config.toml --num_shards 2 --merge
+import argparse
+import os
+import sys
+import json
+sys.path.insert(0, os.path.abspath('.'))
+
+import toml
+import torch
+import deepspeed
+import multiprocess as mp
+
+from utils import dataset as dataset_util
+from utils import common
+from utils.common import set_config_defaults, get_pipeline
+from utils.patches import apply_patches
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', required=True, help='Path to TOML configuration file, the same one used for training.')
+parser.add_argument('--num_shards', type=int, default=1, help='Number of shards the media files are split into.')
+parser.add_argument('--shard', type=int, default=None, help='Index of the shard to cache.')
+parser.add_argument('--merge', action='store_true', help='Merge the shards after all of them are cached.')
+parser.add_argument('--regenerate_cache', action='store_true', default=None, help='Force regenerate cache.')
+parser.add_argument('--verify_cache', action='store_true', default=None, help='Check the existing cache first, and cache corrupt items again.')
+parser.add_argument('--i_know_what_i_am_doing', action='store_true', default=None, help='Skip certain dataset checks.')
+parser.add_argument('--master_port', type=int, default=29500, help='Port for the single process distributed group. Must be different for shards running on the same machine.')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    if args.merge == (args.shard is not None):
+        raise ValueError('Pass exactly one of --shard or --merge')
+    if args.shard is not None and not 0 <= args.shard < args.num_shards:
+        raise ValueError(f'--shard must be in [0, {args.num_shards})')
+    cache_shard = (args.shard, args.num_shards) if args.shard is not None else None
+
+    apply_patches()
+
+    # needed for broadcasting Queue in dataset.py
+    mp.current_process().authkey = b'afsaskgfdjh4'
+
+    with open(args.config) as f:
+        # Inline TOML tables are not pickleable, which messes up the multiprocessing dataset stuff. This is a workaround.
+        config = json.loads(json.dumps(toml.load(f)))
+
+    set_config_defaults(config)
+    common.AUTOCAST_DTYPE = config['model']['dtype']
+
+    # Every shard is its own single process group. Caching never communicates between shards, they only share
+    # the cache directories on disk.
+    os.environ['RANK'] = '0'
+    os.environ['LOCAL_RANK'] = '0'
+    os.environ['WORLD_SIZE'] = '1'
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    if torch.cuda.is_available():
+        deepspeed.init_distributed()
+        torch.cuda.set_device(0)
+    else:
+        deepspeed.init_distributed(dist_backend='gloo')
+
+    regenerate_cache = (
+        args.regenerate_cache if args.regenerate_cache is not None
+        else config.get('regenerate_cache', False)
+    )
+    if args.merge and regenerate_cache:
+        raise ValueError('--regenerate_cache would encode everything again in the merge step. Pass it to the shards instead.')
+
+    model = get_pipeline(config)
+
+    caching_batch_size = config.get('caching_batch_size', 1)
+    dataset_manager = dataset_util.DatasetManager(model, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+
+    dataset_configs = [config['dataset']]
+    for eval_dataset in config['eval_datasets']:
+        dataset_configs.append(eval_dataset if type(eval_dataset) == str else eval_dataset['config'])
+    all_datasets = []
+    for config_path in dataset_configs:
+        with open(config_path) as f:
+            dataset_config = toml.load(f)
+        dataset = dataset_util.Dataset(dataset_config, model, skip_dataset_validation=args.i_know_what_i_am_doing, cache_shard=cache_shard)
+        dataset_manager.register(dataset)
+        all_datasets.append(dataset)
+
+    if args.merge:
+        # The merged metadata index has every file the shards probed. The normal caching below then finds every
+        # latent and text embedding already cached by the shards, and only writes the bucket metadata and indexes.
+        for dataset in all_datasets:
+            dataset.merge_cache_shards(args.num_shards)
+
+    if args.verify_cache:
+        dataset_manager.verify_cache()
+    dataset_manager.cache()
+    if args.merge:
+        print(f'Merged {args.num_shards} cache shards')
+    else:
+        print(f'Cached shard {args.shard} of {args.num_shards}')
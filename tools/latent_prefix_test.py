@@ -0,0 +1,71 @@
+# Bounds the difference between latents sliced from a longer encode (latent_prefix_reuse) and encoding the shorter
+# frame bucket directly, with the HunyuanVideo VAE. Encodes the first frames of a video for each frame bucket and
+# compares the leading latent frames of the longest encode against each shorter one.
+# Example:
+#   python tools/latent_prefix_test.py --input video.mp4 --frame_buckets 33 65 129 --tolerance 0.05
+from pathlib import Path
+import sys
+import argparse
+import os.path
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.abspath('submodules/HunyuanVideo'))
+
+import torch
+import imageio
+import torchvision
+
+from hyvideo.vae import load_vae
+
+
+MODEL_BASE = Path('/home/anon/HunyuanVideo/ckpts')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', type=Path, required=True)
+parser.add_argument('--frame_buckets', type=int, nargs='+', default=[33, 65])
+parser.add_argument('--resolution', type=int, default=256)
+parser.add_argument('--tolerance', type=float, default=0.05, help='Maximum relative RMS difference.')
+
+args = parser.parse_args()
+assert args.input.is_file()
+
+
+def vae_encode(tensor, vae):
+    # The mode, not a sample, so only the encoder itself makes a difference.
+    latents = vae.encode(tensor).latent_dist.mode()
+    return latents * vae.config.scaling_factor
+
+
+if __name__ == '__main__':
+    vae, _, s_ratio, t_ratio = load_vae(
+        '884-16c-hy',
+        'bf16',
+        vae_path=MODEL_BASE / 'hunyuan-video-t2v-720p/vae',
+        device='cuda',
+    )
+
+    frame_buckets = sorted(args.frame_buckets)
+    frames = []
+    for frame in imageio.v3.imiter(args.input):
+        frames.append(torch.from_numpy(frame).permute(2, 0, 1))
+        if len(frames) == frame_buckets[-1]:
+            break
+    assert len(frames) == frame_buckets[-1], f'{args.input} has less than {frame_buckets[-1]} frames'
+    video = torch.stack(frames).float() / 255
+    video = torchvision.transforms.functional.resize(video, args.resolution)
+    video = torchvision.transforms.functional.center_crop(video, args.resolution)
+    # (frames, channels, height, width) -> (1, channels, frames, height, width), values in range [-1, 1]
+    video = (video.permute(1, 0, 2, 3).unsqueeze(0) * 2) - 1
+
+    with torch.no_grad():
+        longest = vae_encode(video.to(vae.device, vae.dtype), vae).float()
+        failed = False
+        for num_frames in frame_buckets[:-1]:
+            direct = vae_encode(video[:, :, :num_frames].to(vae.device, vae.dtype), vae).float()
+            sliced = longest[:, :, :(num_frames - 1) // t_ratio + 1]
+            assert sliced.shape == direct.shape, (sliced.shape, direct.shape)
+            error = (sliced - direct).square().mean().sqrt() / direct.square().mean().sqrt()
+            max_error = (sliced - direct).abs().max()
+            ok = error.item() <= args.tolerance
+            failed = failed or not ok
+            print(f'{num_frames} frames from {frame_buckets[-1]}: relative RMS {error.item():.2e}, max abs {max_error.item():.2e}, {"OK" if ok else "FAIL"}')
+    assert not failed, f'sliced latents differ from a direct encode by more than {args.tolerance}'
@@ -0,0 +1,79 @@
+# Checks that PrefixKVCache gives bitwise the same cropped hidden states as a full forward of the prompt template
+# plus caption, with a tiny randomly initialized Llama, so nothing is downloaded. Runs on CPU in a few seconds.
+# Example:
+#   python tools/prefix_kv_cache_test.py
+import argparse
+import os.path
+import sys
+sys.path.insert(0, os.path.abspath('.'))
+
+import torch
+from transformers import LlamaConfig, LlamaModel
+
+from utils.prefix_kv_cache import PrefixKVCache
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--attn_implementation', default='eager')
+args = parser.parse_args()
+
+PREFIX_LEN = 24
+MAX_LENGTH = 64
+VOCAB_SIZE = 1000
+
+
+def make_batch(prefix, caption_lengths, generator):
+    input_ids = torch.zeros((len(caption_lengths), MAX_LENGTH), dtype=torch.long)
+    attention_mask = torch.zeros((len(caption_lengths), MAX_LENGTH), dtype=torch.long)
+    for i, length in enumerate(caption_lengths):
+        input_ids[i, :PREFIX_LEN] = prefix
+        input_ids[i, PREFIX_LEN:PREFIX_LEN+length] = torch.randint(1, VOCAB_SIZE, (length,), generator=generator)
+        attention_mask[i, :PREFIX_LEN+length] = 1
+    return input_ids.to(args.device), attention_mask.to(args.device)
+
+
+def reference(model, input_ids, attention_mask):
+    with torch.no_grad():
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+    return outputs.last_hidden_state[:, PREFIX_LEN:], tuple(h[:, PREFIX_LEN:] for h in outputs.hidden_states)
+
+
+def check(name, outputs, expected, attention_mask):
+    mask = attention_mask[:, PREFIX_LEN:] != 0
+    for i, (a, b) in enumerate(zip((outputs[0],) + outputs[1], (expected[0],) + expected[1])):
+        assert a.shape == b.shape, f'{name}: shape {a.shape} != {b.shape}'
+        assert torch.equal(a[mask], b[mask]), f'{name}: output {i} differs, max abs difference {(a[mask] - b[mask]).abs().max().item()}'
+    print(f'{name}: OK')
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        attn_implementation=args.attn_implementation,
+    )
+    model = LlamaModel(config).eval().to(args.device)
+    cache = PrefixKVCache(model)
+    prefix = torch.randint(1, VOCAB_SIZE, (PREFIX_LEN,), generator=generator)
+    prefix_key = (str(torch.device(args.device)), model.dtype, tuple(prefix.tolist()))
+
+    # The first batch of a prefix is checked against the full forward, later batches use the cache only.
+    for step, caption_lengths in enumerate([[3, 17, 1, 40], [8, 8], [MAX_LENGTH - PREFIX_LEN, 5, 12]]):
+        input_ids, attention_mask = make_batch(prefix, caption_lengths, generator)
+        check(f'batch {step}', cache.forward(input_ids, attention_mask, PREFIX_LEN), reference(model, input_ids, attention_mask), attention_mask)
+    if cache.prefixes[prefix_key] is None:
+        print(f'prefix cache disabled itself, {args.attn_implementation} attention is not bitwise stable for different query lengths on {args.device}')
+    else:
+        print('prefix cache used')
+
+    # Rows with a different template prefix fall back to the full forward.
+    input_ids, attention_mask = make_batch(prefix, [4, 9], generator)
+    input_ids[1, 3] = (input_ids[1, 3] + 1) % VOCAB_SIZE
+    check('mismatched prefix', cache.forward(input_ids, attention_mask, PREFIX_LEN), reference(model, input_ids, attention_mask), attention_mask)
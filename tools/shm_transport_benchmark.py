@@ -0,0 +1,98 @@
+# Measures the cost of moving batches between caching map workers and GPU ranks, with a CPU stand-in for the
+# VAE. Compares sending the tensors through the manager queue (the old way) with the shared memory transport.
+# Example:
+#   python tools/shm_transport_benchmark.py --frames 33 --height 720 --width 1280 --batches 16
+import argparse
+import os.path
+import sys
+import time
+sys.path.insert(0, os.path.abspath('.'))
+
+import torch
+import torch.nn.functional as F
+import multiprocess as mp
+
+from utils.shm_transport import TensorDescriptor, SharedMemoryAttachments, get_slab_allocator
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--frames', type=int, default=33)
+parser.add_argument('--height', type=int, default=480)
+parser.add_argument('--width', type=int, default=848)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--batches', type=int, default=16)
+parser.add_argument('--workers', type=int, default=4)
+args = parser.parse_args()
+
+
+# Same compression as the HunyuanVideo VAE: 4x temporal, 8x spatial, 16 channels. Cheap, so the transport dominates.
+def stand_in_vae(tensor):
+    latents = F.avg_pool3d(tensor, kernel_size=(4, 8, 8), ceil_mode=True)
+    return {'latents': latents.repeat(1, 6, 1, 1, 1)[:, :16]}
+
+
+def gpu_rank(queue, use_shm):
+    attachments = SharedMemoryAttachments()
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        tensor, pipe = task
+        if use_shm:
+            descriptor = tensor
+            tensor = attachments.read(descriptor)
+        results = stand_in_vae(tensor)
+        del tensor
+        if use_shm:
+            results = attachments.write_results(results, descriptor.name) or results
+        pipe.send(results)
+    attachments.close()
+
+
+def worker(queue, use_shm, num_batches):
+    shape = (args.batch_size, 3, args.frames, args.height, args.width)
+    frames = torch.rand(shape)
+    allocator = get_slab_allocator()
+    for _ in range(num_batches):
+        parent_conn, child_conn = mp.Pipe(duplex=False)
+        if use_shm:
+            slab = allocator.acquire(frames.numel() * frames.element_size())
+            batched, descriptor = slab.empty(shape, frames.dtype)
+            batched.copy_(frames)
+            del batched
+            queue.put((descriptor, child_conn))
+            result = parent_conn.recv()
+            result = {k: slab.read(v).clone() if isinstance(v, TensorDescriptor) else v for k, v in result.items()}
+            allocator.release(slab)
+        else:
+            queue.put((frames.clone(), child_conn))
+            result = parent_conn.recv()
+        assert result['latents'].shape[1] == 16
+    allocator.close()
+
+
+def run(use_shm):
+    manager = mp.Manager()
+    queue = manager.Queue()
+    consumer = mp.Process(target=gpu_rank, args=(queue, use_shm))
+    consumer.start()
+    batches_per_worker = args.batches // args.workers
+    start = time.perf_counter()
+    workers = [mp.Process(target=worker, args=(queue, use_shm, batches_per_worker)) for _ in range(args.workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    duration = time.perf_counter() - start
+    queue.put(None)
+    consumer.join()
+    manager.shutdown()
+    return duration, batches_per_worker * args.workers
+
+
+if __name__ == '__main__':
+    batch_mb = args.batch_size * 3 * args.frames * args.height * args.width * 4 / 1024**2
+    print(f'batch: {args.batch_size}x3x{args.frames}x{args.height}x{args.width} float32 ({batch_mb:.1f} MB)')
+    for name, use_shm in [('manager queue', False), ('shared memory', True)]:
+        duration, num_batches = run(use_shm)
+        print(f'{name}: {num_batches} batches in {duration:.2f}s ({num_batches/duration:.2f} batches/s, {num_batches*batch_mb/duration:.0f} MB/s)')
@@ -0,0 +1,57 @@
+# Checks the mask-trimmed text embedding storage with the outputs of both HunyuanVideo text encoders: the LLM
+# output is trimmed to its attention mask and padded back by collate, the pooled CLIP output (which has no mask)
+# passes through unchanged. Uses random tensors with the real shapes, runs on CPU.
+# Example:
+#   python tools/text_embedding_trim_test.py
+import os.path
+import sys
+sys.path.insert(0, os.path.abspath('.'))
+
+import torch
+
+from utils.dataset import _trim_text_embeddings, _pad_and_stack
+
+
+# What HunyuanVideoPipeline.get_variable_length_text_embeddings() returns.
+VARIABLE_LENGTH = {'prompt_embeds_1': 'prompt_attention_mask_1'}
+MAX_LENGTH = 256
+
+
+def text_encoder_1_result(lengths):
+    embeds = torch.randn(len(lengths), MAX_LENGTH, 32)
+    mask = torch.zeros(len(lengths), MAX_LENGTH, dtype=torch.long)
+    for i, length in enumerate(lengths):
+        mask[i, :length] = 1
+    return {'prompt_embeds_1': embeds, 'prompt_attention_mask_1': mask}
+
+
+def text_encoder_2_result(batch_size):
+    return {'prompt_embeds_2': torch.randn(batch_size, 16)}
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    lengths = [5, 40, 0, 17]
+
+    # Text encoder 1: every row trimmed to its mask length (at least one position).
+    result = text_encoder_1_result(lengths)
+    rows = _trim_text_embeddings(result, VARIABLE_LENGTH)
+    for i, length in enumerate(lengths):
+        assert rows['prompt_embeds_1'][i].shape == (max(length, 1), 32)
+        assert rows['prompt_attention_mask_1'][i].shape == (max(length, 1),)
+    # Collate pads to the longest row in the batch, the positions inside the mask are unchanged.
+    embeds = _pad_and_stack(rows['prompt_embeds_1'])
+    mask = _pad_and_stack(rows['prompt_attention_mask_1'])
+    assert embeds.shape == (len(lengths), max(lengths), 32)
+    assert torch.equal(mask, result['prompt_attention_mask_1'][:, :max(lengths)])
+    valid = mask != 0
+    assert torch.equal(embeds[valid], result['prompt_embeds_1'][:, :max(lengths)][valid])
+    for i, length in enumerate(lengths):
+        assert (embeds[i, max(length, 1):] == 0).all()
+    print('text encoder 1: OK')
+
+    # Text encoder 2 doesn't return the mask of text encoder 1, its outputs are stored as they are.
+    result = text_encoder_2_result(len(lengths))
+    rows = _trim_text_embeddings(result, VARIABLE_LENGTH)
+    assert rows is result
+    print('text encoder 2: OK')
@@ -0,0 +1,133 @@
+# Captions/s of the HunyuanVideo text encoder call, one caption per forward (how it used to work) vs one batched
+# forward per data type, with a small randomly initialized Llama standing in for the LLM so it runs anywhere. Also
+# checks both give the same embeddings. --prefix_kv_cache runs both with the prompt template prefix KV cache
+# (llm_prefix_kv_cache in the model config), otherwise it's off.
+# Example:
+#   python tools/text_encoder_batching_benchmark.py --captions 256 --batch_size 32 --device cuda
+#   python tools/text_encoder_batching_benchmark.py --captions 256 --batch_size 32 --device cuda --prefix_kv_cache
+import argparse
+import os.path
+import sys
+import time
+from types import SimpleNamespace
+sys.path.insert(0, os.path.abspath('.'))
+
+import torch
+from torch import nn
+from transformers import LlamaConfig, LlamaModel
+
+from models.hunyuan_video import HunyuanVideoPipeline
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--captions', type=int, default=256)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--text_len', type=int, default=256)
+parser.add_argument('--layers', type=int, default=4)
+parser.add_argument('--hidden_size', type=int, default=512)
+parser.add_argument('--prefix_kv_cache', action='store_true', help='Use the prompt template prefix KV cache.')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+
+# Template prefix lengths of the HunyuanVideo prompt templates, cropped off after the forward.
+CROP_START = {'image': 36, 'video': 95}
+VOCAB_SIZE = 32000
+HIDDEN_STATE_SKIP_LAYER = 2
+
+
+# Same interface as hyvideo's TextEncoder, as far as HunyuanVideoPipeline uses it.
+class StandInTextEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.max_length = args.text_len + CROP_START['video']
+        self.use_template = True
+        self.prompt_template = {'crop_start': CROP_START['image']}
+        self.prompt_template_video = {'crop_start': CROP_START['video']}
+        self.use_attention_mask = True
+        self.hidden_state_skip_layer = HIDDEN_STATE_SKIP_LAYER
+        self.apply_final_norm = False
+        self.dtype = torch.float32
+        config = LlamaConfig(
+            vocab_size=VOCAB_SIZE,
+            hidden_size=args.hidden_size,
+            intermediate_size=4*args.hidden_size,
+            num_hidden_layers=args.layers,
+            num_attention_heads=8,
+            num_key_value_heads=8,
+            attn_implementation='eager',
+        )
+        self.model = LlamaModel(config)
+
+    # Template tokens, then the caption tokens, padded to max_length. Same shapes as the real tokenizer output.
+    def text2tokens(self, captions, data_type='image'):
+        input_ids = torch.zeros((len(captions), self.max_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(captions), self.max_length), dtype=torch.long)
+        for i, caption in enumerate(captions):
+            tokens = [hash((data_type, j)) % VOCAB_SIZE for j in range(CROP_START[data_type])]
+            tokens += [hash(word) % VOCAB_SIZE for word in caption.split()]
+            tokens = tokens[:self.max_length]
+            input_ids[i, :len(tokens)] = torch.tensor(tokens)
+            attention_mask[i, :len(tokens)] = 1
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+# The hyvideo encode_prompt path: tokenize, full forward, take the skip layer hidden state, crop the template.
+def encode_prompt(prompts, device, num_videos_per_prompt, do_classifier_free_guidance, text_encoder, data_type):
+    text_inputs = text_encoder.text2tokens(prompts, data_type=data_type)
+    attention_mask = text_inputs['attention_mask'].to(device)
+    with torch.no_grad():
+        outputs = text_encoder.model(input_ids=text_inputs['input_ids'].to(device), attention_mask=attention_mask, output_hidden_states=True)
+    hidden_state = outputs.hidden_states[-(HIDDEN_STATE_SKIP_LAYER + 1)]
+    crop_start = CROP_START[data_type]
+    return hidden_state[:, crop_start:], None, attention_mask[:, crop_start:], None
+
+
+def make_pipeline():
+    text_encoder = StandInTextEncoder().to(args.device).eval()
+    pipeline = HunyuanVideoPipeline.__new__(HunyuanVideoPipeline)
+    pipeline.model_config = {'llm_prefix_kv_cache': args.prefix_kv_cache}
+    pipeline.diffusers_pipeline = SimpleNamespace(text_encoder=text_encoder, text_encoder_2=None, encode_prompt=encode_prompt)
+    pipeline.max_text_length_video = args.text_len + CROP_START['video']
+    pipeline.max_text_length_image = args.text_len + CROP_START['image']
+    return pipeline, text_encoder
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def benchmark(name, fn, batches):
+    fn(*batches[0])
+    sync()
+    start = time.perf_counter()
+    results = [fn(*batch) for batch in batches]
+    sync()
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {args.captions / elapsed:.1f} captions/s')
+    return results
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    pipeline, text_encoder = make_pipeline()
+    fn = pipeline.get_call_text_encoder_fn(text_encoder)
+    words = ['a', 'car', 'crash', 'at', 'an', 'intersection', 'near', 'miss', 'with', 'pedestrian', 'in', 'rain', 'night', 'truck']
+    captions = [' '.join(words[(i*7 + j) % len(words)] for j in range(10 + i % 40)) for i in range(args.captions)]
+    is_video = [i % 4 != 0 for i in range(args.captions)]
+    batches = [(captions[i:i+args.batch_size], is_video[i:i+args.batch_size]) for i in range(0, args.captions, args.batch_size)]
+
+    def one_at_a_time(captions, is_video):
+        results = [fn([caption], [v]) for caption, v in zip(captions, is_video)]
+        return {k: torch.cat([result[k] for result in results]) for k in results[0]}
+
+    print(f'prefix KV cache: {"on" if args.prefix_kv_cache else "off"}')
+    before = benchmark('one caption per forward', one_at_a_time, batches)
+    after = benchmark(f'batched per data type (batch size {args.batch_size})', fn, batches)
+    # Only positions inside the attention mask are used.
+    max_error = 0
+    for a, b in zip(before, after):
+        mask = a['prompt_attention_mask_1'] != 0
+        assert torch.equal(mask, b['prompt_attention_mask_1'] != 0)
+        max_error = max(max_error, (a['prompt_embeds_1'][mask].float() - b['prompt_embeds_1'][mask].float()).abs().max().item())
+    print(f'max abs difference: {max_error:.2e}')
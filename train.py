@@ -23,7 +23,7 @@ import numpy as np
 
 from utils import dataset as dataset_util
 from utils import common
-from utils.common import is_main_process, get_rank, DTYPE_MAP, empty_cuda_cache
+from utils.common import is_main_process, get_rank, DTYPE_MAP, empty_cuda_cache, set_config_defaults, get_pipeline
 import utils.saver
 from utils.isolate_rng import isolate_rng
 from utils.patches import apply_patches
@@ -40,6 +40,7 @@ parser.add_argument('--resume_from_checkpoint', nargs='?', const=True, default=N
                     help='resume training from checkpoint. If no value is provided, resume from the most recent checkpoint. If a folder name is provided, resume from that specific folder.')
 parser.add_argument('--regenerate_cache', action='store_true', default=None, help='Force regenerate cache. Useful if none of the files have changed but their contents have, e.g. modified captions.')
 parser.add_argument('--cache_only', action='store_true', default=None, help='Cache model inputs then exit.')
+parser.add_argument('--verify_cache', action='store_true', default=None, help='Check the existing cache for truncated files and non-finite values, and cache corrupt items again.')
 parser.add_argument('--i_know_what_i_am_doing', action='store_true', default=None, help="Skip certain checks and overrides. You may end up using settings that won't work.")
 parser.add_argument('--master_port', type=int, default=29500, help='Master port for distributed training')
 parser.add_argument('--dump_dataset', type=Path, default=None, help='Decode cached latents and dump the dataset to this directory.')
@@ -79,47 +80,6 @@ def _count_all_layer_params(self):
 ds_pipe_module.PipelineModule._count_layer_params = _count_all_layer_params
 
 
-def set_config_defaults(config):
-    # Force the user to set this. If we made it a default of 1, it might use a lot of disk space.
-    assert 'save_every_n_epochs' in config
-
-    config.setdefault('pipeline_stages', 1)
-    config.setdefault('activation_checkpointing', False)
-    config['reentrant_activation_checkpointing'] = (config['activation_checkpointing'] == 'unsloth')
-    config.setdefault('warmup_steps', 0)
-    if 'save_dtype' in config:
-        config['save_dtype'] = DTYPE_MAP[config['save_dtype']]
-
-    model_config = config['model']
-    model_dtype_str = model_config['dtype']
-    model_config['dtype'] = DTYPE_MAP[model_dtype_str]
-    if 'transformer_dtype' in model_config:
-        model_config['transformer_dtype'] = DTYPE_MAP[model_config['transformer_dtype']]
-    model_config.setdefault('guidance', 1.0)
-
-    if 'adapter' in config:
-        adapter_config = config['adapter']
-        adapter_type = adapter_config['type']
-        if adapter_config['type'] == 'lora':
-            if 'alpha' in adapter_config:
-                raise NotImplementedError(
-                    'This script forces alpha=rank to make the saved LoRA format simpler and more predictable with downstream inference programs. Please remove alpha from the config.'
-                )
-            adapter_config['alpha'] = adapter_config['rank']
-            adapter_config.setdefault('dropout', 0.0)
-            adapter_config.setdefault('dtype', model_dtype_str)
-            adapter_config['dtype'] = DTYPE_MAP[adapter_config['dtype']]
-        else:
-            raise NotImplementedError(f'Adapter type {adapter_type} is not implemented')
-
-    config.setdefault('logging_steps', 1)
-    config.setdefault('eval_datasets', [])
-    config.setdefault('eval_gradient_accumulation_steps', 1)
-    config.setdefault('eval_every_n_steps', None)
-    config.setdefault('eval_every_n_epochs', None)
-    config.setdefault('eval_before_first_step', True)
-
-
 def get_most_recent_run_dir(output_dir):
     return list(sorted(glob.glob(os.path.join(output_dir, '*'))))[-1]
 
@@ -265,36 +225,7 @@ if __name__ == '__main__':
     )
 
     model_type = config['model']['type']
-
-    if model_type == 'flux':
-        from models import flux
-        model = flux.FluxPipeline(config)
-    elif model_type == 'ltx-video':
-        from models import ltx_video
-        model = ltx_video.LTXVideoPipeline(config)
-    elif model_type == 'hunyuan-video':
-        from models import hunyuan_video
-        model = hunyuan_video.HunyuanVideoPipeline(config)
-    elif model_type == 'sdxl':
-        from models import sdxl
-        model = sdxl.SDXLPipeline(config)
-    elif model_type == 'cosmos':
-        from models import cosmos
-        model = cosmos.CosmosPipeline(config)
-    elif model_type == 'lumina_2':
-        from models import lumina_2
-        model = lumina_2.Lumina2Pipeline(config)
-    elif model_type == 'wan':
-        from models import wan
-        model = wan.WanPipeline(config)
-    elif model_type == 'chroma':
-        from models import chroma
-        model = chroma.ChromaPipeline(config)
-    elif model_type == 'hidream':
-        from models import hidream
-        model = hidream.HiDreamPipeline(config)
-    else:
-        raise NotImplementedError(f'Model type {model_type} is not implemented')
+    model = get_pipeline(config)
 
     # import sys, PIL
     # test_image = sys.argv[1]
@@ -401,6 +332,8 @@ if __name__ == '__main__':
         dist.barrier()
         quit()
 
+    if args.verify_cache:
+        dataset_manager.verify_cache()
     dataset_manager.cache()
     if args.cache_only:
         quit()
@@ -0,0 +1,88 @@
+from pathlib import Path
+from collections import defaultdict
+import os
+import re
+import json
+import time
+
+from deepspeed.utils.logging import logger
+
+from utils.common import atomic_write
+
+
+# Last use time of the cache files in one cache directory, {file name: timestamp}.
+LEDGER_NAME = 'cache_ledger.json'
+# Cache files written by map() with num_proc have a _00000_of_00008 suffix. All parts are one fingerprint.
+PART_SUFFIX = re.compile(r'_\d{5}_of_\d{5}$')
+
+
+def _load_ledger(cache_dir):
+    try:
+        with open(Path(cache_dir) / LEDGER_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Records that the given cache files (names in cache_dir) were used now. Another process updating the same ledger
+# at the same time can lose an update, which only makes the file look older.
+def record_use(cache_dir, cache_files):
+    cache_dir = Path(cache_dir)
+    ledger = _load_ledger(cache_dir)
+    now = time.time()
+    for cache_file in cache_files:
+        ledger[Path(cache_file).name] = now
+    with atomic_write(cache_dir / LEDGER_NAME) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(ledger, f)
+
+
+def _fingerprint(path):
+    return PART_SUFFIX.sub('', path.stem)
+
+
+# Deletes the least recently used cache fingerprints under cache_dirs until they use at most budget_bytes. A
+# fingerprint is every file of one map() output: its Arrow files, the shard written from them, and its segment
+# index file. Anything used or written since run_start (the current run, or another process caching right now) is
+# never deleted. Files missing from the ledgers count as last used when they were written.
+def collect_garbage(cache_dirs, budget_bytes, run_start):
+    units = defaultdict(lambda: {'files': [], 'size': 0, 'last_used': 0})
+    ledgers = {}
+    for cache_dir in cache_dirs:
+        for path in list(Path(cache_dir).rglob('*.arrow')) + list(Path(cache_dir).rglob('*.shard')):
+            unit = units[(path.parent, _fingerprint(path))]
+            stat = path.stat()
+            unit['files'].append(path)
+            unit['size'] += stat.st_size
+            if path.parent not in ledgers:
+                ledgers[path.parent] = _load_ledger(path.parent)
+            last_used = max(ledgers[path.parent].get(path.name, 0), stat.st_mtime)
+            unit['last_used'] = max(unit['last_used'], last_used)
+        for segment_file in Path(cache_dir).rglob('*segments/*.json'):
+            key = (segment_file.parent.parent, _fingerprint(segment_file))
+            if key in units:
+                units[key]['files'].append(segment_file)
+            else:
+                # Index of a segment whose cache files are gone, it's never loaded again.
+                os.remove(segment_file)
+
+    total = sum(unit['size'] for unit in units.values())
+    if total <= budget_bytes:
+        return
+    evicted = 0
+    evicted_bytes = 0
+    for unit in sorted(units.values(), key=lambda unit: unit['last_used']):
+        if total <= budget_bytes:
+            break
+        if unit['last_used'] >= run_start:
+            continue
+        # The segment index file goes first, so an interrupted eviction never leaves an index without its files.
+        for path in sorted(unit['files'], key=lambda path: path.suffix != '.json'):
+            os.remove(path)
+        total -= unit['size']
+        evicted += 1
+        evicted_bytes += unit['size']
+    if evicted > 0:
+        print(f'cache_disk_budget_gb: removed {evicted} least recently used cache fingerprints ({evicted_bytes / 2**30:.2f} GiB), cache now uses {total / 2**30:.2f} GiB')
+    if total > budget_bytes:
+        logger.warning(f'Cache uses {total / 2**30:.2f} GiB, more than cache_disk_budget_gb, but everything left is used by the current run')
+
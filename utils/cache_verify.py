@@ -0,0 +1,173 @@
+from pathlib import Path
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import pyarrow as pa
+from deepspeed.utils.logging import logger
+
+from utils.latent_store import LatentStore
+from utils.shard import read_shard_source
+from utils.segment_index import save_segment
+
+
+# Values with a larger magnitude are reported as corrupt. Latents are roughly unit scale, and text encoder hidden
+# states stay far below this.
+MAX_ABS = 1e4
+
+
+# Leaf values of a (nested) list array and the range of leaf values of each row.
+def _flatten(array):
+    offsets = np.arange(len(array)+1, dtype=np.int64)
+    while pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+        offsets = array.offsets.to_numpy()[offsets]
+        array = array.values
+    return array, offsets
+
+
+# Float32 view of leaf values for the range checks, or None for columns that can't hold bad values.
+def _as_float(name, values):
+    if pa.types.is_floating(values.type):
+        return values.to_numpy(zero_copy_only=False).astype(np.float32, copy=False)
+    # Encoded latents are integer views of bfloat16 or float8 bits, see utils/latent_codec.py.
+    if name == 'latents' and values.type == pa.int16():
+        return torch.from_numpy(values.to_numpy(zero_copy_only=False)).view(torch.bfloat16).float().numpy()
+    if name == 'latents' and values.type == pa.uint8():
+        return torch.from_numpy(values.to_numpy(zero_copy_only=False)).view(torch.float8_e4m3fn).float().numpy()
+    return None
+
+
+# Rows (relative to the batch) with non-finite or out of range values in any tensor column.
+def _bad_rows(batch, max_abs):
+    bad = []
+    for name, column in zip(batch.schema.names, batch.columns):
+        values, offsets = _flatten(column)
+        values = _as_float(name, values)
+        if values is None or len(values) == 0:
+            continue
+        bad_values = np.flatnonzero(~(np.abs(values) <= max_abs))
+        if len(bad_values) > 0:
+            bad.append(np.searchsorted(offsets, bad_values, side='right') - 1)
+    return np.unique(np.concatenate(bad)) if bad else np.zeros(0, dtype=np.int64)
+
+
+# Reads every record batch of an Arrow cache file. Returns the number of rows, the bad rows, and the latent store
+# key of every row if there is one.
+def _check_cache_file(path, max_abs):
+    num_rows = 0
+    bad_rows = []
+    latent_keys = []
+    with pa.memory_map(str(path)) as source:
+        for batch in pa.ipc.open_stream(source):
+            bad_rows.append(_bad_rows(batch, max_abs) + num_rows)
+            if 'latent_key' in batch.schema.names:
+                latent_keys.extend(batch.column('latent_key').to_pylist())
+            num_rows += batch.num_rows
+    return num_rows, np.concatenate(bad_rows) if bad_rows else np.zeros(0, dtype=np.int64), latent_keys
+
+
+def _check_store_entry(store, key, max_abs):
+    if store.num_clips(key) is None:
+        return False
+    try:
+        clips = [store.load(key, i) for i in range(store.num_clips(key))]
+    except Exception:
+        return False
+    for clip in clips:
+        for name, tensor in clip.items():
+            if name == 'latents' and tensor.dtype == torch.int16:
+                tensor = tensor.view(torch.bfloat16)
+            elif name == 'latents' and tensor.dtype == torch.uint8:
+                tensor = tensor.view(torch.float8_e4m3fn)
+            if tensor.is_floating_point() and not (tensor.float().abs() <= max_abs).all():
+                return False
+    return True
+
+
+# Checks one segment of an item-granular cache (see _map_and_cache_items in dataset.py). Returns the keys of the
+# corrupt items, and why.
+def _verify_segment(segment_file, store, store_results, max_abs):
+    with open(segment_file) as f:
+        segment = json.load(f)
+    items = segment['items']
+    num_rows = 0
+    bad_rows = []
+    latent_keys = []
+    for cache_file in segment['cache_files']:
+        path = segment_file.parent.parent / cache_file
+        try:
+            file_rows, file_bad_rows, file_latent_keys = _check_cache_file(path, max_abs)
+        except (OSError, pa.ArrowException) as e:
+            return segment, list(items), f'unreadable cache file {cache_file}: {e}'
+        bad_rows.append(file_bad_rows + num_rows)
+        latent_keys.extend(file_latent_keys)
+        num_rows += file_rows
+    expected_rows = max((end for start, end in items.values()), default=0)
+    if num_rows != expected_rows:
+        return segment, list(items), f'{num_rows} rows, index expects {expected_rows}'
+
+    bad_rows = set(np.concatenate(bad_rows).tolist()) if bad_rows else set()
+    reason = f'{len(bad_rows)} rows with non-finite or out of range values' if bad_rows else None
+    if store is not None and latent_keys:
+        for row, key in enumerate(latent_keys):
+            if key not in store_results:
+                store_results[key] = _check_store_entry(store, key, max_abs)
+            if not store_results[key]:
+                bad_rows.add(row)
+                reason = 'missing or corrupt latent store entries'
+    corrupt = [key for key, (start, end) in items.items() if any(row in bad_rows for row in range(start, end))]
+    return segment, corrupt, reason
+
+
+# Checks all latent and text embedding caches under cache_dirs, in parallel: every cache file must be readable
+# and have the number of rows its segment index expects, and tensors must be finite and within max_abs. Corrupt
+# items are removed from the index (and their latent store entries deleted), so the next caching pass encodes
+# exactly those items again. Unreadable shard files are deleted, they are rebuilt from the Arrow files.
+def verify_cache(cache_dirs, latent_store_dir=None, max_abs=MAX_ABS, num_workers=8):
+    start = time.time()
+    segment_files = sorted(set(
+        segment_file
+        for cache_dir in cache_dirs
+        for segment_file in Path(cache_dir).glob('**/*segments/*.json')
+    ))
+    store = None if latent_store_dir is None else LatentStore(latent_store_dir)
+    store_results = {}
+    with ThreadPoolExecutor(num_workers) as executor:
+        results = list(executor.map(lambda segment_file: _verify_segment(segment_file, store, store_results, max_abs), segment_files))
+
+    num_items = 0
+    num_corrupt = 0
+    for segment_file, (segment, corrupt, reason) in zip(segment_files, results):
+        num_items += len(segment['items'])
+        if len(corrupt) == 0:
+            continue
+        num_corrupt += len(corrupt)
+        logger.warning(f'Cache segment {segment_file}: {len(corrupt)} of {len(segment["items"])} items are corrupt ({reason}), they will be cached again')
+        if len(corrupt) == len(segment['items']):
+            # Remove the cache files too. Caching the same items again would otherwise find them by fingerprint.
+            os.remove(segment_file)
+            for cache_file in segment['cache_files']:
+                path = segment_file.parent.parent / cache_file
+                if path.exists():
+                    os.remove(path)
+        else:
+            for key in corrupt:
+                del segment['items'][key]
+            save_segment(segment_file.parent, segment)
+    if store is not None:
+        for key, ok in store_results.items():
+            path = store.store_dir / store.relative_path(key)
+            if not ok and path.exists():
+                os.remove(path)
+
+    for cache_dir in cache_dirs:
+        for shard_path in Path(cache_dir).glob('**/*.shard'):
+            if read_shard_source(shard_path) is None:
+                logger.warning(f'Removing unreadable shard file {shard_path}, it will be written again')
+                os.remove(shard_path)
+
+    print(f'verified cache: {len(segment_files)} segments, {num_items} items in {time.time()-start:.1f}s, {num_corrupt} corrupt items')
+    return num_corrupt
@@ -0,0 +1,123 @@
+from pathlib import Path
+from collections import defaultdict
+import os
+import json
+import time
+
+import numpy as np
+from torch.utils.tensorboard import SummaryWriter
+
+
+# Latency samples kept per stage for the percentiles of one interval.
+MAX_SAMPLES = 10000
+PERCENTILES = (50, 90, 99)
+# Worker stats that are added up. The latent store ones count media files: found in the store, encoded, and sliced
+# from the latents of a longer frame bucket (latent_prefix_reuse).
+COUNTERS = ('items', 'frames', 'bytes_written', 'text_items', 'store_hits', 'store_encoded', 'prefix_derived')
+
+
+# Live metrics of the caching phase, from the point of view of one GPU rank: the forward calls it runs, and the
+# stage stats map workers send it. Every interval seconds a snapshot of the interval (rates, queue depth, forward
+# batch sizes, latency percentiles per stage, idle time) is appended to a JSONL file and written to TensorBoard.
+# Counters are per rank, add them up over ranks for the totals.
+class CachingTelemetry:
+    def __init__(self, log_dir, rank, interval=10):
+        self.log_dir = Path(log_dir)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.rank = rank
+        self.interval = interval
+        self.jsonl = open(self.log_dir / f'caching_rank{rank}.jsonl', 'a')
+        self.tb_writer = SummaryWriter(log_dir=str(self.log_dir / f'rank{rank}'))
+        self.start = time.time()
+        self.last_emit = self.start
+        self.step = 0
+        self.totals = defaultdict(float)
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self.counters = defaultdict(float)
+        self.samples = defaultdict(list)
+        self.queue_depths = []
+
+    def _add_samples(self, name, values):
+        samples = self.samples[name]
+        samples.extend(values[:MAX_SAMPLES - len(samples)])
+
+    # Stats a map worker sent through the queue. Lists are latency samples, numbers are added up.
+    def record_worker_stats(self, stats):
+        for k, v in stats.items():
+            if isinstance(v, list):
+                self._add_samples(k, v)
+            elif k in COUNTERS:
+                self.counters[k] += v
+
+    # One forward call on this rank. submodel is 0 for the VAE, i for text encoder i.
+    def record_forward(self, submodel, batch_size, latency):
+        name = 'vae' if submodel == 0 else f'text_encoder_{submodel}'
+        self._add_samples(f'{name}_batch_size', [batch_size])
+        self._add_samples(f'{name}_forward_latency', [latency])
+
+    def record_idle(self, seconds):
+        self.counters['gpu_idle'] += seconds
+
+    def record_queue_depth(self, depth):
+        if len(self.queue_depths) < MAX_SAMPLES:
+            self.queue_depths.append(depth)
+
+    def maybe_emit(self):
+        if time.time() - self.last_emit >= self.interval:
+            self.emit()
+
+    def emit(self):
+        now = time.time()
+        elapsed = max(now - self.last_emit, 1e-9)
+        for k, v in self.counters.items():
+            self.totals[k] += v
+        record = {
+            'time': now,
+            'rank': self.rank,
+            'elapsed': now - self.start,
+            'items_per_s': self.counters['items'] / elapsed,
+            'frames_per_s': self.counters['frames'] / elapsed,
+            'text_items_per_s': self.counters['text_items'] / elapsed,
+            'mb_written_per_s': self.counters['bytes_written'] / elapsed / 2**20,
+            'gpu_idle_fraction': min(self.counters['gpu_idle'] / elapsed, 1.0),
+            'total_items': self.totals['items'],
+            'total_frames': self.totals['frames'],
+            'total_text_items': self.totals['text_items'],
+            'total_mb_written': self.totals['bytes_written'] / 2**20,
+            'total_gpu_idle': self.totals['gpu_idle'],
+            'total_latent_store_hits': self.totals['store_hits'],
+            'total_latent_store_encoded': self.totals['store_encoded'],
+            'total_latent_prefix_derived': self.totals['prefix_derived'],
+        }
+        if self.queue_depths:
+            record['queue_depth_mean'] = float(np.mean(self.queue_depths))
+            record['queue_depth_max'] = int(np.max(self.queue_depths))
+        for name, values in self.samples.items():
+            if name.endswith('_batch_size'):
+                # Histogram of forward batch sizes, {batch size: count}.
+                sizes, counts = np.unique(values, return_counts=True)
+                record[name] = {int(size): int(count) for size, count in zip(sizes, counts)}
+            else:
+                for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                    record[f'{name}_p{p}_ms'] = float(value) * 1000
+
+        self.jsonl.write(json.dumps(record) + '\n')
+        self.jsonl.flush()
+        for k, v in record.items():
+            if k in ('time', 'rank', 'elapsed'):
+                continue
+            if isinstance(v, dict):
+                self.tb_writer.add_histogram(f'caching/{k}', np.repeat(list(v.keys()), list(v.values())), self.step)
+            else:
+                self.tb_writer.add_scalar(f'caching/{k}', v, self.step)
+        self.tb_writer.flush()
+        self.step += 1
+        self.last_emit = now
+        self._reset_interval()
+
+    def close(self):
+        self.emit()
+        self.jsonl.close()
+        self.tb_writer.close()
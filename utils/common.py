@@ -1,5 +1,7 @@
 from contextlib import contextmanager
+from pathlib import Path
 import gc
+import os
 import time
 
 import torch
@@ -44,6 +46,22 @@ def log_duration(name):
         print(f'{name}: {time.time()-start:.3f}')
 
 
+# Yields a temporary path next to path to write the file to, and renames it to path once writing succeeds, so readers
+# and interrupted runs never see a partially written file. If writing fails, the temporary file is removed. suffix
+# stays at the end of the temporary name, for writers that add their own extension (np.save).
+@contextmanager
+def atomic_write(path, suffix=''):
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name.removesuffix(suffix)}.tmp{os.getpid()}{suffix}')
+    try:
+        yield tmp_path
+    except BaseException:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
 def load_safetensors(path):
     tensors = {}
     with safe_open(path, framework="pt", device="cpu") as f:
@@ -65,3 +83,78 @@ def round_to_nearest_multiple(x, multiple):
 
 def round_down_to_multiple(x, multiple):
     return int((x // multiple) * multiple)
+
+
+def set_config_defaults(config):
+    # Force the user to set this. If we made it a default of 1, it might use a lot of disk space.
+    assert 'save_every_n_epochs' in config
+
+    config.setdefault('pipeline_stages', 1)
+    config.setdefault('activation_checkpointing', False)
+    config['reentrant_activation_checkpointing'] = (config['activation_checkpointing'] == 'unsloth')
+    config.setdefault('warmup_steps', 0)
+    if 'save_dtype' in config:
+        config['save_dtype'] = DTYPE_MAP[config['save_dtype']]
+
+    model_config = config['model']
+    model_dtype_str = model_config['dtype']
+    model_config['dtype'] = DTYPE_MAP[model_dtype_str]
+    if 'transformer_dtype' in model_config:
+        model_config['transformer_dtype'] = DTYPE_MAP[model_config['transformer_dtype']]
+    model_config.setdefault('guidance', 1.0)
+
+    if 'adapter' in config:
+        adapter_config = config['adapter']
+        adapter_type = adapter_config['type']
+        if adapter_config['type'] == 'lora':
+            if 'alpha' in adapter_config:
+                raise NotImplementedError(
+                    'This script forces alpha=rank to make the saved LoRA format simpler and more predictable with downstream inference programs. Please remove alpha from the config.'
+                )
+            adapter_config['alpha'] = adapter_config['rank']
+            adapter_config.setdefault('dropout', 0.0)
+            adapter_config.setdefault('dtype', model_dtype_str)
+            adapter_config['dtype'] = DTYPE_MAP[adapter_config['dtype']]
+        else:
+            raise NotImplementedError(f'Adapter type {adapter_type} is not implemented')
+
+    config.setdefault('logging_steps', 1)
+    config.setdefault('eval_datasets', [])
+    config.setdefault('eval_gradient_accumulation_steps', 1)
+    config.setdefault('eval_every_n_steps', None)
+    config.setdefault('eval_every_n_epochs', None)
+    config.setdefault('eval_before_first_step', True)
+
+
+# Creates the model pipeline for the model type in the config. Models are imported here, so only the selected one is loaded.
+def get_pipeline(config):
+    model_type = config['model']['type']
+    if model_type == 'flux':
+        from models import flux
+        return flux.FluxPipeline(config)
+    elif model_type == 'ltx-video':
+        from models import ltx_video
+        return ltx_video.LTXVideoPipeline(config)
+    elif model_type == 'hunyuan-video':
+        from models import hunyuan_video
+        return hunyuan_video.HunyuanVideoPipeline(config)
+    elif model_type == 'sdxl':
+        from models import sdxl
+        return sdxl.SDXLPipeline(config)
+    elif model_type == 'cosmos':
+        from models import cosmos
+        return cosmos.CosmosPipeline(config)
+    elif model_type == 'lumina_2':
+        from models import lumina_2
+        return lumina_2.Lumina2Pipeline(config)
+    elif model_type == 'wan':
+        from models import wan
+        return wan.WanPipeline(config)
+    elif model_type == 'chroma':
+        from models import chroma
+        return chroma.ChromaPipeline(config)
+    elif model_type == 'hidream':
+        from models import hidream
+        return hidream.HiDreamPipeline(config)
+    else:
+        raise NotImplementedError(f'Model type {model_type} is not implemented')
@@ -1,11 +1,14 @@
 from pathlib import Path
 import os.path
 import random
-from collections import defaultdict
+from collections import defaultdict, deque
 import math
 import os
 import hashlib
 import json
+import time
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -13,16 +16,32 @@ from deepspeed.utils.logging import logger
 from deepspeed import comm as dist
 import datasets
 from datasets.fingerprint import Hasher
-from PIL import Image
-import imageio
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json
+import pyarrow.parquet
 import multiprocess as mp
 
-from utils.common import is_main_process, VIDEO_EXTENSIONS, round_to_nearest_multiple
+from utils.common import is_main_process, round_to_nearest_multiple
+from utils.metadata_index import MetadataIndex
+from utils.media_probe import DEFAULT_VIDEO_BACKEND, TIMESTAMP_EPSILON
+from utils.metadata_probe import probe_media_files
+from utils.latent_codec import STORAGE_DTYPES, validate_latent_codec, encode_latents, decode_latents, round_trip_error
+from utils.shm_transport import TensorDescriptor, SharedMemoryAttachments, get_slab_allocator
+from utils.shard import CACHE_FORMATS, Shard, write_shard, read_shard_source
+from utils.latent_store import LatentStore
+from utils.local_cache import replicate_files
+from utils.cache_verify import verify_cache
+from utils.cache_gc import record_use, collect_garbage
+from utils.segment_index import load_segment_index, save_segment
+from utils.caching_telemetry import CachingTelemetry
 
 
 DEBUG = False
 IMAGE_SIZE_ROUND_TO_MULTIPLE = 32
 NUM_PROC = min(8, os.cpu_count())
+# Encode batches handled by one latents map() call.
+ENCODE_BATCHES_PER_MAP_CALL = 8
 
 
 def shuffle_with_seed(l, seed=None):
@@ -70,18 +89,191 @@ def _map_and_cache(dataset, map_fn, cache_dir, cache_file_prefix='', new_fingerp
     return dataset
 
 
-class TextEmbeddingDataset:
-    def __init__(self, te_dataset):
-        self.te_dataset = te_dataset
-        self.image_file_to_te_idx = defaultdict(list)
-        for i, image_file in enumerate(te_dataset['image_file']):
-            self.image_file_to_te_idx[image_file].append(i)
+# Key of every item (row) of a dataset, from the values of the given columns. An item whose key is in the cache
+# is never mapped again.
+def _item_keys(dataset, columns, fingerprint_args):
+    values = dataset.select_columns(columns).with_format(None)[:]
+    return [
+        hashlib.sha256(json.dumps([fingerprint_args, list(row)]).encode()).hexdigest()
+        for row in zip(*(values[column] for column in columns))
+    ]
+
+
+# Row range of every input item in the output of map(). With item_column, the output rows of an item are the
+# consecutive rows with the same value in that column, possibly none. Otherwise, map() is one row per item.
+def _item_row_ranges(input_dataset, output_dataset, item_column=None):
+    if item_column is None:
+        assert len(output_dataset) == len(input_dataset)
+        return [[i, i+1] for i in range(len(input_dataset))]
+    input_values = input_dataset.select_columns([item_column]).with_format(None)[:][item_column]
+    output_values = output_dataset.data.column(item_column).to_pylist()
+    ranges = []
+    row = 0
+    for value in input_values:
+        start = row
+        while row < len(output_values) and output_values[row] == value:
+            row += 1
+        ranges.append([start, row])
+    assert row == len(output_values)
+    return ranges
+
+
+# Item-granular _map_and_cache. The cache is a set of segments, each the map() output for some items, plus a
+# segment index (JSON) with the row range of every item in its segment. Only items that aren't in the index are
+# mapped, into a new segment. Returns the memory-mapped concatenation of the segments holding the current items
+# (nothing is copied, rows of items that no longer exist are just never used), and the row range of each item in it.
+def _map_and_cache_items(dataset, map_fn, cache_dir, item_keys, cache_file_prefix='', item_column=None, new_fingerprint_args=None, regenerate_cache=False, caching_batch_size=1):
+    index_dir = cache_dir / f'{cache_file_prefix}segments'
+    segments = [] if regenerate_cache else load_segment_index(index_dir)
+    cached_keys = set(key for segment in segments for key in segment['items'])
+    missing = [i for i, key in enumerate(item_keys) if key not in cached_keys]
+    if len(missing) > 0:
+        if map_fn is None:
+            raise RuntimeError(f'{len(missing)} items are missing from the cache in {cache_dir}')
+        print(f'caching {len(missing)} new or modified items, {len(item_keys)-len(missing)} items unchanged')
+        subset = dataset.select(missing) if len(missing) < len(dataset) else dataset
+        new_segment = _map_and_cache(
+            subset,
+            map_fn,
+            cache_dir,
+            cache_file_prefix=cache_file_prefix,
+            new_fingerprint_args=list(new_fingerprint_args or []),
+            regenerate_cache=regenerate_cache,
+            caching_batch_size=caching_batch_size,
+        )
+        ranges = _item_row_ranges(subset, new_segment, item_column)
+        segment = {
+            'cache_files': [Path(f['filename']).name for f in new_segment.cache_files],
+            'created': time.time(),
+            'items': {item_keys[i]: row_range for i, row_range in zip(missing, ranges)},
+        }
+        save_segment(index_dir, segment)
+        segments = [s for s in segments if s['cache_files'] != segment['cache_files']] + [segment]
+
+    # Later segments take precedence, e.g. after --regenerate_cache.
+    location = {}
+    for segment_idx, segment in enumerate(segments):
+        for key, (start, end) in segment['items'].items():
+            location[key] = (segment_idx, start, end)
+    # Every segment with a current item counts as used, even if the item has no rows, see utils/cache_gc.py.
+    record_use(cache_dir, [cache_file for segment_idx in set(location[key][0] for key in item_keys) for cache_file in segments[segment_idx]['cache_files']])
+    used_segments = sorted(set(location[key][0] for key in item_keys if location[key][2] > location[key][1]))
+    if len(used_segments) == 0:
+        # No item has any rows. Still return a (empty) table with the right columns.
+        used_segments = [location[item_keys[0]][0]]
+    segment_offsets = {}
+    parts = []
+    num_rows = 0
+    for segment_idx in used_segments:
+        segment_offsets[segment_idx] = num_rows
+        for cache_file in segments[segment_idx]['cache_files']:
+            parts.append(datasets.Dataset.from_file(str(cache_dir / cache_file)))
+            num_rows += len(parts[-1])
+    cached_dataset = datasets.concatenate_datasets(parts)
+    cached_dataset.set_format('torch')
+    item_rows = np.zeros((len(item_keys), 2), dtype=np.int64)
+    for i, key in enumerate(item_keys):
+        segment_idx, start, end = location[key]
+        offset = segment_offsets.get(segment_idx, 0)
+        item_rows[i] = (offset + start, offset + end)
+    return cached_dataset, item_rows
+
+
+# Memory-maps a cached dataset written by _map_and_cache, given its cache files.
+def _load_cache_files(cache_files):
+    dataset = datasets.concatenate_datasets([datasets.Dataset.from_file(cache_file) for cache_file in cache_files])
+    dataset.set_format('torch')
+    return dataset
+
 
-    def get_text_embeddings(self, image_file, caption_number):
-        return self.te_dataset[self.image_file_to_te_idx[image_file][caption_number]]
+# Returns the shard copy of a cached dataset, next to its first cache file. The shard is written if it doesn't
+# exist, or if the Arrow cache files changed since it was written (e.g. --regenerate_cache).
+def _get_shard(dataset, column_dtypes=None):
+    cache_files = [f['filename'] for f in dataset.cache_files]
+    if len(cache_files) == 0:
+        return None
+    source = [[cache_file, os.stat(cache_file).st_size, os.stat(cache_file).st_mtime_ns] for cache_file in cache_files]
+    shard_path = Path(cache_files[0]).with_suffix('.shard')
+    if read_shard_source(shard_path) != source:
+        print(f'writing shard: {shard_path}')
+        write_shard(shard_path, dataset, column_dtypes=column_dtypes, source=source)
+    record_use(shard_path.parent, [shard_path.name])
+    return Shard(shard_path)
 
 
-def _cache_text_embeddings(metadata_dataset, map_fn, i, cache_dir, regenerate_cache, caching_batch_size):
+class TextEmbeddingDataset:
+    # item_image_files and item_rows are the media file and the te_dataset row of every caption, with all captions
+    # of a media file consecutive. Only needed for get_rows().
+    def __init__(self, te_dataset, shard=None, item_image_files=None, item_rows=None):
+        self.te_dataset = te_dataset
+        self.shard = shard
+        self.item_image_files = item_image_files
+        self.item_rows = item_rows
+        self.image_file_to_first_item = None
+
+    # Returns the text embedding row for each (image_file, caption_number) pair.
+    def get_rows(self, image_files, caption_numbers):
+        if self.image_file_to_first_item is None:
+            self.image_file_to_first_item = {}
+            for i, image_file in enumerate(self.item_image_files):
+                self.image_file_to_first_item.setdefault(image_file, i)
+        first_items = np.array([self.image_file_to_first_item[image_file] for image_file in image_files], dtype=np.int64)
+        return self.item_rows[first_items + caption_numbers]
+
+    def get_text_embeddings(self, row):
+        if self.shard is not None:
+            return self.shard[int(row)]
+        return self.te_dataset[int(row)]
+
+
+# Splits a batch of text encoder outputs into rows, trimming the outputs in variable_length ({output key: attention
+# mask key}, see BasePipeline.get_variable_length_text_embeddings) and their masks to the mask length. Rows keep at
+# least one position, so a batch of them is never empty. Each text encoder only returns some of the outputs, pairs
+# that aren't in result are skipped.
+def _trim_text_embeddings(result, variable_length):
+    variable_length = {key: mask_key for key, mask_key in variable_length.items() if key in result and mask_key in result}
+    if not variable_length:
+        return result
+    trimmed = {k: list(v) for k, v in result.items()}
+    for key, mask_key in variable_length.items():
+        mask = result[mask_key]
+        positions = torch.arange(1, mask.shape[1]+1)
+        lengths = (positions * (mask != 0)).amax(dim=1).clamp(min=1).tolist()
+        trimmed[key] = [row[:length] for row, length in zip(result[key], lengths)]
+        trimmed[mask_key] = [row[:length] for row, length in zip(mask, lengths)]
+    return trimmed
+
+
+# Version of the stored text embedding format. Bump it when the format changes, so existing entries are encoded
+# again instead of being read in the old format.
+TRIMMED_TEXT_EMBEDDINGS_VERSION = 1
+
+
+# Token for the format text embeddings are stored in, part of their item keys. None for models without variable
+# length outputs, which are stored as the text encoder returns them, so those caches stay valid.
+def _text_embedding_format(variable_length):
+    if not variable_length:
+        return None
+    return {'trimmed': TRIMMED_TEXT_EMBEDDINGS_VERSION, 'variable_length': variable_length}
+
+
+# Stacks tensors into a batch. Tensors of different shapes (trimmed text embeddings) are zero padded at the end
+# of each dimension to the largest size in the batch.
+def _pad_and_stack(tensors):
+    shape = tensors[0].shape
+    if all(tensor.shape == shape for tensor in tensors):
+        return torch.stack(tensors)
+    max_shape = [max(sizes) for sizes in zip(*(tensor.shape for tensor in tensors))]
+    batch = tensors[0].new_zeros([len(tensors)] + max_shape)
+    for i, tensor in enumerate(tensors):
+        batch[(i,) + tuple(slice(0, size) for size in tensor.shape)] = tensor
+    return batch
+
+
+# Text embeddings of several directories are cached together, per unique (caption, is_video), keyed by the caption
+# and the text encoder identity, so a caption shared by many media files in any of the directories is encoded and
+# stored once. Returns a TextEmbeddingDataset for each metadata dataset, all backed by the same cache.
+def _cache_text_embeddings(metadata_datasets, map_fn, i, cache_dir, regenerate_cache, caching_batch_size, cache_format='arrow', text_encoder_identity=None, text_embedding_format=None):
 
     def flatten_captions(example):
         image_file_out, caption_out, is_video_out = [], [], []
@@ -92,27 +284,86 @@ def _cache_text_embeddings(metadata_dataset, map_fn, i, cache_dir, regenerate_ca
                 is_video_out.append(is_video)
         return {'image_file': image_file_out, 'caption': caption_out, 'is_video': is_video_out}
 
-    flattened_captions = metadata_dataset.map(flatten_captions, batched=True, keep_in_memory=True, remove_columns=metadata_dataset.column_names)
-    te_dataset = _map_and_cache(
-        flattened_captions,
+    flattened_captions = [
+        metadata_dataset.map(flatten_captions, batched=True, keep_in_memory=True, remove_columns=metadata_dataset.column_names)
+        for metadata_dataset in metadata_datasets
+    ]
+    # A directory without any usable media files has no captions (and no columns).
+    non_empty = [captions for captions in flattened_captions if len(captions) > 0]
+    if len(non_empty) == 0:
+        return [TextEmbeddingDataset(None, None, [], np.zeros(0, dtype=np.int64)) for _ in metadata_datasets]
+    all_captions = datasets.concatenate_datasets(non_empty) if len(non_empty) > 1 else non_empty[0]
+    values = all_captions.select_columns(['caption', 'is_video']).with_format(None)[:]
+    unique_index = {}
+    unique_rows = []
+    caption_to_unique = np.zeros(len(all_captions), dtype=np.int64)
+    for row, caption_key in enumerate(zip(values['caption'], values['is_video'])):
+        if caption_key not in unique_index:
+            unique_index[caption_key] = len(unique_rows)
+            unique_rows.append(row)
+        caption_to_unique[row] = unique_index[caption_key]
+    unique_captions = all_captions.select(unique_rows) if len(unique_rows) < len(all_captions) else all_captions
+    # One item per unique caption.
+    fingerprint_args = [i] if text_encoder_identity is None else [i, text_encoder_identity]
+    if text_embedding_format is not None:
+        fingerprint_args.append(text_embedding_format)
+    te_dataset, item_rows = _map_and_cache_items(
+        unique_captions,
         map_fn,
         cache_dir,
+        _item_keys(unique_captions, ['caption', 'is_video'], fingerprint_args),
         cache_file_prefix=f'text_embeddings_{i}_',
-        new_fingerprint_args=[i],
+        new_fingerprint_args=fingerprint_args,
         regenerate_cache=regenerate_cache,
         caching_batch_size=caching_batch_size,
     )
-    return TextEmbeddingDataset(te_dataset)
+    shard = _get_shard(te_dataset) if cache_format == 'shard' else None
+    rows = item_rows[caption_to_unique, 0]
+    te_datasets = []
+    start = 0
+    for captions in flattened_captions:
+        end = start + len(captions)
+        image_files = captions.data.column('image_file').to_pylist() if len(captions) > 0 else []
+        te_datasets.append(TextEmbeddingDataset(te_dataset, shard, image_files, rows[start:end]))
+        start = end
+    return te_datasets
+
+
+# Caches the text embeddings of every directory of the given datasets into one cache in cache_dir, see
+# _cache_text_embeddings(), and gives each directory its part.
+def _cache_shared_text_embeddings(datasets, map_fn, i, cache_dir, regenerate_cache=False, caching_batch_size=1, text_encoder_identity=None, text_embedding_format=None):
+    directory_datasets = [directory_dataset for ds in datasets for directory_dataset in ds.directory_datasets]
+    print(f'caching text embeddings: {cache_dir}, {len(directory_datasets)} directories')
+    os.makedirs(cache_dir, exist_ok=True)
+    te_datasets = _cache_text_embeddings(
+        [directory_dataset.metadata_dataset for directory_dataset in directory_datasets],
+        map_fn,
+        i,
+        Path(cache_dir),
+        regenerate_cache,
+        caching_batch_size,
+        directory_datasets[0].cache_format,
+        text_encoder_identity,
+        text_embedding_format,
+    )
+    for directory_dataset, te_dataset in zip(directory_datasets, te_datasets):
+        directory_dataset.add_text_embedding_dataset(te_dataset)
 
 
 # The smallest unit of a dataset. Represents a single size bucket from a single folder of images
 # and captions on disk. Not batched; returns individual items.
 class SizeBucketDataset:
-    def __init__(self, metadata_dataset, directory_config, size_bucket, model_name):
+    def __init__(self, metadata_dataset, directory_config, size_bucket, model_name, latent_codec='none', cache_format='arrow', latent_store_dir=None):
         self.metadata_dataset = metadata_dataset
         self.directory_config = directory_config
         self.size_bucket = size_bucket
         self.model_name = model_name
+        self.latent_codec = latent_codec
+        self.cache_format = cache_format
+        # With a latent store, the cached table only has references to store entries.
+        self.latent_store = None if latent_store_dir is None else LatentStore(latent_store_dir)
+        self.latent_dataset = None
+        self.latent_shard = None
         self.path = Path(self.directory_config['path'])
         self.cache_dir = self.path / 'cache' / self.model_name / f'cache_{size_bucket[0]}x{size_bucket[1]}x{size_bucket[2]}'
         os.makedirs(self.cache_dir, exist_ok=True)
@@ -121,49 +372,122 @@ class SizeBucketDataset:
         if self.num_repeats <= 0:
             raise ValueError(f'num_repeats must be >0, was {self.num_repeats}')
 
-    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1):
+    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1, latent_identity=None):
         print(f'caching latents: {self.size_bucket}')
-        self.latent_dataset = _map_and_cache(
+        fingerprint_args = ([] if self.latent_codec == 'none' else [self.latent_codec]) + ([] if self.latent_store is None else ['latent_store'])
+        # latent_identity (see DatasetManager.get_latent_identity) changes whenever the latents would, e.g. with
+        # another VAE checkpoint or video backend.
+        if latent_identity is not None:
+            fingerprint_args.append(latent_identity)
+        # One item per media file, with any number of latent rows (clips). Latents don't depend on the captions, so
+        # they aren't part of the key and editing a caption doesn't encode the file again.
+        item_keys = _item_keys(self.metadata_dataset, ['image_file', 'mask_file', 'size_bucket', 'is_video', 'file_version'], fingerprint_args)
+        self.latent_dataset, item_rows = _map_and_cache_items(
             self.metadata_dataset,
             map_fn,
             self.cache_dir,
+            item_keys,
             cache_file_prefix='latents_',
+            item_column='image_file',
+            new_fingerprint_args=fingerprint_args,
             regenerate_cache=regenerate_cache,
             caching_batch_size=caching_batch_size,
         )
-        iteration_order = []
-        for example in self.latent_dataset.select_columns(['image_file', 'caption']):
-            image_file = example['image_file']
-            for i, caption in enumerate(example['caption']):
-                iteration_order.append((image_file, caption, i))
+        if self.cache_format == 'shard':
+            # The torch format turns every integer column into int64, store encoded latents in their real dtype.
+            column_dtypes = None if self.latent_codec == 'none' else {'latents': STORAGE_DTYPES[self.latent_codec]}
+            self.latent_shard = _get_shard(self.latent_dataset, column_dtypes=column_dtypes)
+        # One training example per (latent row, caption number, item), for the rows of current items. The captions
+        # come from the current metadata, the cached rows may be from before a caption was edited.
+        self.captions = self.metadata_dataset.select_columns(['caption']).with_format(None)[:]['caption']
+        rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.arange(start, end) for start, end in item_rows])
+        items = np.repeat(np.arange(len(item_rows)), item_rows[:, 1] - item_rows[:, 0])
+        num_captions = np.array([len(captions) for captions in self.captions], dtype=np.int64)[items]
+        latent_rows = np.repeat(rows, num_captions)
+        caption_numbers = np.arange(len(latent_rows)) - np.repeat(np.cumsum(num_captions) - num_captions, num_captions)
+        iteration_order = np.stack([latent_rows, caption_numbers, np.repeat(items, num_captions)], axis=1)
         # Shuffle again, since one media file can produce multiple training examples. E.g. video, or maybe
         # in the future data augmentation. Don't need to shuffle text embeddings since those are looked
         # up by image file name.
-        shuffle_with_seed(iteration_order, 42)
-        self.iteration_order = iteration_order
-        self.image_file_to_latents_idx = {
-            image_file: i
-            for i, image_file in enumerate(self.latent_dataset['image_file'])
-        }
-
-
-    def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
-        print(f'caching text embeddings: {self.size_bucket}')
-        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, regenerate_cache, caching_batch_size)
-        self.text_embedding_datasets.append(te_dataset)
+        self.iteration_order = iteration_order[np.random.default_rng(42).permutation(len(iteration_order))]
+        self.text_embedding_rows = None
 
     def add_text_embedding_dataset(self, te_dataset):
         self.text_embedding_datasets.append(te_dataset)
 
+    # For each text encoder, the text embedding row of every example in iteration_order.
+    def _get_text_embedding_rows(self):
+        if self.text_embedding_rows is None:
+            image_files = self.latent_dataset.data.column('image_file').to_pylist()
+            image_files = [image_files[i] for i in self.iteration_order[:, 0]]
+            self.text_embedding_rows = [ds.get_rows(image_files, self.iteration_order[:, 1]) for ds in self.text_embedding_datasets]
+        return self.text_embedding_rows
+
+    # Everything another process needs to load this dataset from the cache: the cache files, and the index
+    # arrays that would otherwise have to be rebuilt by reading the cached tables.
+    def get_plan(self):
+        return {
+            'size_bucket': self.size_bucket,
+            'latents_cache_files': [f['filename'] for f in self.latent_dataset.cache_files],
+            'latents_shard': None if self.latent_shard is None else self.latent_shard.path,
+            'iteration_order': self.iteration_order,
+            'captions': self.captions,
+            'latent_store_dir': None if self.latent_store is None else str(self.latent_store.store_dir),
+            'latent_store_files': self._get_latent_store_files(),
+            'text_embeddings': [
+                {
+                    'cache_files': [f['filename'] for f in ds.te_dataset.cache_files],
+                    'shard': None if ds.shard is None else ds.shard.path,
+                    'rows': rows,
+                }
+                for ds, rows in zip(self.text_embedding_datasets, self._get_text_embedding_rows())
+            ],
+        }
+
+    # Store entries the examples read, relative to the store directory.
+    def _get_latent_store_files(self):
+        if self.latent_store is None:
+            return []
+        keys = self.latent_dataset.data.column('latent_key').take(pa.array(np.unique(self.iteration_order[:, 0])))
+        return [str(self.latent_store.relative_path(key)) for key in pc.unique(keys).to_pylist()]
+
+    def load_plan(self, plan):
+        # The plan can point at a different (e.g. node-local) copy of the store.
+        if plan['latent_store_dir'] is not None:
+            self.latent_store = LatentStore(plan['latent_store_dir'])
+        # With shards, the Arrow cache files aren't needed at all.
+        if plan['latents_shard'] is not None:
+            self.latent_shard = Shard(plan['latents_shard'])
+        else:
+            self.latent_dataset = _load_cache_files(plan['latents_cache_files'])
+        self.iteration_order = plan['iteration_order']
+        self.captions = plan['captions']
+        self.text_embedding_datasets = [
+            TextEmbeddingDataset(None, Shard(te_plan['shard'])) if te_plan['shard'] is not None
+            else TextEmbeddingDataset(_load_cache_files(te_plan['cache_files']))
+            for te_plan in plan['text_embeddings']
+        ]
+        self.text_embedding_rows = [te_plan['rows'] for te_plan in plan['text_embeddings']]
+
     def __getitem__(self, idx):
         idx = idx % len(self.iteration_order)
-        image_file, caption, caption_number = self.iteration_order[idx]
-        ret = self.latent_dataset[self.image_file_to_latents_idx[image_file]]
+        latent_row, caption_number, item = self.iteration_order[idx]
+        if self.latent_shard is not None:
+            ret = self.latent_shard[int(latent_row)]
+        else:
+            ret = self.latent_dataset[int(latent_row)]
+        if self.latent_store is not None:
+            ret.update(self.latent_store.load(ret.pop('latent_key'), int(ret.pop('clip'))))
+            ret.setdefault('mask', None)
+        if self.latent_codec != 'none':
+            # The torch format turns every integer column into int64. Go back to the storage dtype, which is
+            # how the model knows how to decode the latents.
+            ret['latents'] = ret['latents'].to(STORAGE_DTYPES[self.latent_codec])
         if DEBUG:
-            print(Path(image_file).stem)
-        for ds in self.text_embedding_datasets:
-            ret.update(ds.get_text_embeddings(image_file, caption_number))
-        ret['caption'] = caption
+            print(Path(ret['image_file']).stem)
+        for ds, rows in zip(self.text_embedding_datasets, self._get_text_embedding_rows()):
+            ret.update(ds.get_text_embeddings(rows[idx]))
+        ret['caption'] = self.captions[item][caption_number]
         return ret
 
     def __len__(self):
@@ -211,17 +535,20 @@ class ConcatenatedBatchedDataset:
 
 
 class ARBucketDataset:
-    def __init__(self, ar_frames, resolutions, metadata_dataset, directory_config, model_name):
+    def __init__(self, ar_frames, resolutions, metadata_dataset, directory_config, model_name, latent_codec='none', cache_format='arrow', latent_store_dir=None):
         self.ar_frames = ar_frames
         self.resolutions = resolutions
         self.metadata_dataset = metadata_dataset
         self.directory_config = directory_config
         self.model_name = model_name
+        self.cache_format = cache_format
         self.size_buckets = []
         self.path = Path(directory_config['path'])
-        self.cache_dir = self.path / 'cache' / self.model_name / f'ar_frames_{self.ar_frames[0]:.3f}_{self.ar_frames[1]}'
-        os.makedirs(self.cache_dir, exist_ok=True)
 
+        # The rows of this bucket, once. Each resolution only replaces the size_bucket column, the other columns are
+        # shared by all of them.
+        metadata = self.metadata_dataset.with_format('arrow')[:]
+        size_bucket_column = metadata.column_names.index('size_bucket')
         for res in resolutions:
             area = res**2
             w = math.sqrt(area * self.ar_frames[0])
@@ -229,28 +556,26 @@ class ARBucketDataset:
             w = round_to_nearest_multiple(w, IMAGE_SIZE_ROUND_TO_MULTIPLE)
             h = round_to_nearest_multiple(h, IMAGE_SIZE_ROUND_TO_MULTIPLE)
             size_bucket = (w, h, self.ar_frames[1])
-            metadata_with_size_bucket = self.metadata_dataset.map(lambda example: {'size_bucket': size_bucket}, keep_in_memory=True)
+            size_bucket_array = _to_list_array(np.tile(np.array(size_bucket, dtype=np.int64), (len(metadata), 1)))
+            metadata_with_size_bucket = datasets.Dataset(
+                metadata.set_column(size_bucket_column, 'size_bucket', size_bucket_array),
+                fingerprint=Hasher.hash([self.metadata_dataset._fingerprint, size_bucket]),
+            )
             self.size_buckets.append(
-                SizeBucketDataset(metadata_with_size_bucket, directory_config, size_bucket, model_name)
+                SizeBucketDataset(metadata_with_size_bucket, directory_config, size_bucket, model_name, latent_codec=latent_codec, cache_format=cache_format, latent_store_dir=latent_store_dir)
             )
 
     def get_size_bucket_datasets(self):
         return self.size_buckets
 
-    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1):
+    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1, latent_identity=None):
         print(f'caching latents: {self.ar_frames}')
         for ds in self.size_buckets:
-            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
-
-    def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
-        print(f'caching text embeddings: {self.ar_frames}')
-        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, regenerate_cache, caching_batch_size)
-        for size_bucket_dataset in self.size_buckets:
-            size_bucket_dataset.add_text_embedding_dataset(te_dataset)
+            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size, latent_identity=latent_identity)
 
 
 class DirectoryDataset:
-    def __init__(self, directory_config, dataset_config, model_name, framerate=None, skip_dataset_validation=False):
+    def __init__(self, directory_config, dataset_config, model_name, framerate=None, video_backend=DEFAULT_VIDEO_BACKEND, latent_codec='none', cache_format='arrow', latent_store_dir=None, cache_shard=None, skip_dataset_validation=False):
         self._set_defaults(directory_config, dataset_config)
         self.directory_config = directory_config
         self.dataset_config = dataset_config
@@ -258,6 +583,12 @@ class DirectoryDataset:
             self.validate()
         self.model_name = model_name
         self.framerate = framerate
+        self.video_backend = video_backend
+        self.latent_codec = latent_codec
+        self.cache_format = cache_format
+        self.latent_store_dir = latent_store_dir
+        # (shard index, number of shards). Only this shard of the media files is used, see tools/build_cache.py.
+        self.cache_shard = cache_shard
         self.enable_ar_bucket = directory_config.get('enable_ar_bucket', dataset_config.get('enable_ar_bucket', False))
         # Configure directly from user-specified size buckets.
         self.size_buckets = directory_config.get('size_buckets', dataset_config.get('size_buckets', None))
@@ -274,7 +605,11 @@ class DirectoryDataset:
         self.mask_path = Path(self.directory_config['mask_path']) if 'mask_path' in self.directory_config else None
         # For testing. Default if a mask is missing.
         self.default_mask_file = Path(self.directory_config['default_mask_file']) if 'default_mask_file' in self.directory_config else None
+        # Optional JSONL or Parquet file listing every media file with its resolution, frame count and captions.
+        self.manifest = Path(self.directory_config['manifest']) if 'manifest' in self.directory_config else None
         self.cache_dir = self.path / 'cache' / self.model_name
+        # Set when the size bucket datasets were created from a plan, instead of from the cache.
+        self.from_plan = False
 
         if not self.path.exists() or not self.path.is_dir():
             raise RuntimeError(f'Invalid path: {self.path}')
@@ -282,6 +617,8 @@ class DirectoryDataset:
             raise RuntimeError(f'Invalid mask_path: {self.mask_path}')
         if self.default_mask_file is not None and (not self.default_mask_file.exists() or not self.default_mask_file.is_file()):
             raise RuntimeError(f'Invalid default_mask_file: {self.default_mask_file}')
+        if self.manifest is not None and (not self.manifest.exists() or not self.manifest.is_file()):
+            raise RuntimeError(f'Invalid manifest: {self.manifest}')
 
         if self.use_size_buckets:
             self.ars = np.array([w / h for w, h, _ in self.size_buckets])
@@ -312,97 +649,232 @@ class DirectoryDataset:
             quit()
 
     def cache_metadata(self, regenerate_cache=False):
-        files = list(self.path.glob('*'))
-        # deterministic order
-        files.sort()
-
-        # Mask can have any extension, it just needs to have the same stem as the image.
-        mask_file_stems = {path.stem: path for path in self.mask_path.glob('*') if path.is_file()} if self.mask_path is not None else {}
-
-        image_files = []
-        caption_files = []
-        mask_files = []
-        for file in files:
-            if not file.is_file() or file.suffix == '.txt' or file.suffix == '.npz' or file.suffix == '.json':
+        _cache_metadata([self], regenerate_cache=regenerate_cache)
+
+    # First half of metadata caching. Lists the directory and returns the files that need to be probed, which
+    # are new or modified files. Probe results are stored per file, so unchanged files are never probed again.
+    def _scan_metadata(self, regenerate_cache=False):
+        media_files = self._list_media_files()
+        assert len(media_files) > 0, f'Directory {self.path} had no images/videos!'
+        if self.cache_shard is not None:
+            media_files = [media_file for media_file in media_files if _in_cache_shard(media_file[0], self.cache_shard)]
+        index = MetadataIndex(self._metadata_index_path(self.cache_shard), self._probe_config(), regenerate=regenerate_cache)
+        to_probe = [(image_file, caption_file, stat_key) for image_file, caption_file, _, stat_key in media_files if index.lookup(image_file, stat_key) is None]
+        print(f'caching metadata: {self.path}: {len(media_files)-len(to_probe)} files unchanged, {len(to_probe)} files to probe')
+        return media_files, index, to_probe
+
+    # Shards write their own metadata index, so they don't overwrite each other's.
+    def _metadata_index_path(self, cache_shard=None):
+        if cache_shard is None:
+            return self.cache_dir / 'metadata' / 'metadata_index.json'
+        return self.cache_dir / 'metadata' / f'metadata_index.shard{cache_shard[0]}of{cache_shard[1]}.json'
+
+    # After all shards are cached, merges their metadata indexes into the main one, so the directory doesn't
+    # have to be probed again.
+    def merge_cache_shards(self, num_shards):
+        if self.manifest is not None:
+            return
+        index = MetadataIndex(self._metadata_index_path(), self._probe_config())
+        for i in range(num_shards):
+            shard_index_path = self._metadata_index_path((i, num_shards))
+            if not shard_index_path.exists():
+                logger.warning(f'Metadata index of cache shard {i} not found: {shard_index_path}')
                 continue
-            image_file = file
-            caption_file = image_file.with_suffix('.txt')
-            if not os.path.exists(caption_file):
-                caption_file = ''
-            image_files.append(str(image_file))
-            caption_files.append(str(caption_file))
-            if image_file.stem in mask_file_stems:
-                mask_files.append(str(mask_file_stems[image_file.stem]))
-            elif self.default_mask_file is not None:
-                mask_files.append(str(self.default_mask_file))
-            else:
-                if self.mask_path is not None:
-                    logger.warning(f'No mask file was found for image {image_file}, not using mask.')
-                mask_files.append(None)
-        assert len(image_files) > 0, f'Directory {self.path} had no images/videos!'
+            index.merge(MetadataIndex(shard_index_path, self._probe_config()))
+        index.save()
+
+    # Second half of metadata caching, after the index has been updated with the probe results.
+    def _finish_metadata(self, media_files, index):
+        index.prune(image_file for image_file, _, _, _ in media_files)
+        if is_main_process():
+            index.save()
+
+        metadata = self._build_metadata(media_files, index)
+        widths = np.array(metadata.pop('width'), dtype=np.int64)
+        heights = np.array(metadata.pop('height'), dtype=np.int64)
+        frames = np.array(metadata.pop('frames'), dtype=np.int64)
+        self._make_bucket_datasets(pa.Table.from_pydict(metadata), widths, heights, frames)
+
+    # Manifest mode. The manifest already has the resolution, frame count and captions of every media file, so the
+    # directory is never scanned and no file is probed. The whole manifest is read in bulk into an Arrow table.
+    def _load_manifest(self):
+        print(f'loading metadata from manifest: {self.manifest}')
+        if self.manifest.suffix == '.parquet':
+            table = pyarrow.parquet.read_table(self.manifest)
+        else:
+            table = pyarrow.json.read_json(self.manifest)
+        for column in ('image_file', 'width', 'height', 'frames'):
+            if column not in table.column_names:
+                raise RuntimeError(f'Manifest {self.manifest} is missing required field {column}')
+        num_files = len(table)
+        assert num_files > 0, f'Manifest {self.manifest} had no images/videos!'
+
+        # Relative paths are relative to the directory path.
+        image_file = table['image_file'].cast(pa.string())
+        image_file = pc.if_else(pc.starts_with(image_file, '/'), image_file, pc.binary_join_element_wise(f'{self.path}/', image_file, ''))
+        if self.cache_shard is not None:
+            in_shard = pa.array([_in_cache_shard(f, self.cache_shard) for f in image_file.to_pylist()])
+            table = table.filter(in_shard)
+            image_file = image_file.filter(in_shard)
+            num_files = len(table)
+
+        if 'caption' in table.column_names:
+            caption = table['caption'].combine_chunks()
+            if not pa.types.is_list(caption.type):
+                # One caption per media file, make it a list of one caption.
+                caption = pa.ListArray.from_arrays(pa.array(np.arange(num_files+1, dtype=np.int32)), caption.cast(pa.string()).fill_null(''))
+        else:
+            logger.warning(f'Manifest {self.manifest} has no captions. Using empty captions.')
+            caption = pa.array([['']] * num_files, type=pa.list_(pa.string()))
+        if self.directory_config['shuffle_tags'] or self.directory_config['caption_prefix']:
+            captions = caption.to_pylist()
+            for image_file_str, file_captions in zip(image_file.to_pylist(), captions):
+                self._process_captions(image_file_str, file_captions)
+            caption = pa.array(captions, type=pa.list_(pa.string()))
+
+        if 'mask_file' in table.column_names:
+            mask_file = table['mask_file'].cast(pa.string())
+            if self.default_mask_file is not None:
+                mask_file = mask_file.fill_null(str(self.default_mask_file))
+        elif self.default_mask_file is not None:
+            mask_file = pa.array([str(self.default_mask_file)] * num_files, type=pa.string())
+        else:
+            mask_file = pa.nulls(num_files, type=pa.string())
+
+        widths = table['width'].to_numpy().astype(np.int64)
+        heights = table['height'].to_numpy().astype(np.int64)
+        frames = table['frames'].to_numpy().astype(np.int64)
+        if 'fps' in table.column_names:
+            # Frame counts at the native framerate. Convert to the number of frames after resampling to the model
+            # framerate, the same way the video backend resamples constant framerate videos.
+            fps = table['fps'].fill_null(0).to_numpy().astype(np.float64)
+            resampled = np.maximum(np.ceil(frames * self.framerate / np.where(fps > 0, fps, 1) - TIMESTAMP_EPSILON), 1).astype(np.int64)
+            frames = np.where((fps > 0) & (frames > 1), resampled, frames)
+
+        stat = self.manifest.stat()
+        fingerprint_args = [str(self.manifest.resolve()), stat.st_size, stat.st_mtime_ns, str(self.path), self.framerate, str(self.default_mask_file), self.directory_config['shuffle_tags'], self.directory_config['caption_prefix']]
+        if self.cache_shard is not None:
+            fingerprint_args.append(list(self.cache_shard))
+        fingerprint = Hasher.hash(fingerprint_args)
+        # Media files in a manifest aren't stat'ed. Edit the manifest (e.g. rename the file) to cache a file again.
+        file_version = pa.nulls(num_files, type=pa.string())
+        metadata = pa.table({'image_file': image_file, 'mask_file': mask_file, 'caption': caption, 'file_version': file_version})
+        self._make_bucket_datasets(metadata, widths, heights, frames, fingerprint=fingerprint)
+
+    # Assigns every media file to a bucket and creates the bucket datasets. metadata is an Arrow table with the
+    # image_file, mask_file, caption and file_version columns.
+    def _make_bucket_datasets(self, metadata, widths, heights, frames, fingerprint=None):
+        num_files = len(frames)
+
+        # Bucket assignment for every file at once.
+        if self.use_size_buckets:
+            bucket_idx = self._assign_size_buckets(widths, heights, frames)
+            metadata = metadata.append_column('size_bucket', _to_list_array(self.size_buckets[np.maximum(bucket_idx, 0)]))
+            metadata = metadata.append_column('ar_bucket', pa.nulls(num_files, type=pa.list_(pa.float64())))
+        else:
+            bucket_idx = self._assign_ar_buckets(widths, heights, frames)
+            ar_idx, frame_idx = np.divmod(np.maximum(bucket_idx, 0), len(self.frame_buckets))
+            metadata = metadata.append_column('size_bucket', pa.nulls(num_files, type=pa.list_(pa.int64())))
+            metadata = metadata.append_column('ar_bucket', _to_list_array(np.stack([self.ars[ar_idx], self.frame_buckets[frame_idx]], axis=1).astype(np.float64)))
+        metadata = metadata.append_column('is_video', pa.array(frames > 1))
+        too_short = (bucket_idx < 0)
+        if too_short.any():
+            print(f'{too_short.sum()} videos with frames={sorted(set(frames[too_short].tolist()))} are being skipped because they are too short')
+        metadata_dataset = datasets.Dataset(metadata, fingerprint=fingerprint)
+        # Every media file used for training, in any bucket. For the text embedding cache.
+        self.metadata_dataset = metadata_dataset.select(np.flatnonzero(~too_short)) if too_short.any() else metadata_dataset
 
-        metadata_dataset = datasets.Dataset.from_dict({'image_file': image_files, 'caption_file': caption_files, 'mask_file': mask_files})
         # Shuffle the data. Use a deterministic seed, so the dataset is identical on all processes.
         # Seed is based on the hash of the directory path, so that if directories have the same set of images, they are shuffled differently.
         seed = int(hashlib.md5(str.encode(str(self.path))).hexdigest(), 16) % int(1e9)
-        metadata_dataset = metadata_dataset.shuffle(seed=seed)
-        metadata_map_fn = self._metadata_map_fn()
-        fingerprint = Hasher.hash([metadata_dataset._fingerprint, metadata_map_fn])
-        print('caching metadata')
-        metadata_dataset = metadata_dataset.map(
-            metadata_map_fn,
-            cache_file_name=str(self.cache_dir / f'metadata/metadata_{fingerprint}.arrow'),
-            load_from_cache_file=(not regenerate_cache),
-            batched=True,
-            batch_size=1,
-            num_proc=NUM_PROC,
-            remove_columns=metadata_dataset.column_names,
-        )
-
-        grouped_metadata = defaultdict(lambda: defaultdict(list))
-        for example in metadata_dataset:
-            if self.use_size_buckets:
-                grouping_key = tuple(example['size_bucket'])
-            else:
-                grouping_key = example['ar_bucket']
-                grouping_key = (grouping_key[0], int(grouping_key[1]))
-            d = grouped_metadata[grouping_key]
-            for k, v in example.items():
-                d[k].append(v)
+        permutation = np.random.default_rng(seed).permutation(num_files)
+        permutation = permutation[~too_short[permutation]]
+        shuffled_bucket_idx = bucket_idx[permutation]
+        # Buckets in order of first appearance in the shuffled data. Each bucket is an index selection on the one
+        # metadata table, so no data is copied.
+        unique_bucket_idx, first_position = np.unique(shuffled_bucket_idx, return_index=True)
+        unique_bucket_idx = unique_bucket_idx[np.argsort(first_position)]
 
         if self.use_size_buckets:
             self.size_bucket_datasets = []
-            for size_bucket, metadata in grouped_metadata.items():
-                metadata = datasets.Dataset.from_dict(metadata)
+            for i in unique_bucket_idx:
+                size_bucket = tuple(int(x) for x in self.size_buckets[i])
                 self.size_bucket_datasets.append(
                     SizeBucketDataset(
-                        metadata,
+                        metadata_dataset.select(permutation[shuffled_bucket_idx == i]),
                         self.directory_config,
                         size_bucket,
                         self.model_name,
+                        latent_codec=self.latent_codec,
+                        cache_format=self.cache_format,
+                        latent_store_dir=self.latent_store_dir,
                     )
                 )
         else:
             self.ar_bucket_datasets = []
-            for ar_bucket, metadata in grouped_metadata.items():
-                metadata = datasets.Dataset.from_dict(metadata)
+            for i in unique_bucket_idx:
+                ar_idx, frame_idx = divmod(int(i), len(self.frame_buckets))
+                ar_bucket = (float(self.ars[ar_idx]), int(self.frame_buckets[frame_idx]))
                 self.ar_bucket_datasets.append(
                     ARBucketDataset(
                         ar_bucket,
                         self.resolutions,
-                        metadata,
+                        metadata_dataset.select(permutation[shuffled_bucket_idx == i]),
                         self.directory_config,
                         self.model_name,
+                        latent_codec=self.latent_codec,
+                        cache_format=self.cache_format,
+                        latent_store_dir=self.latent_store_dir,
                     )
                 )
 
+    # Returns a sorted list of (image_file, caption_file, mask_file, stat_key) for every media file in the directory.
+    # The stat_key changes whenever the media file or its caption file is modified.
+    def _list_media_files(self):
+        with os.scandir(self.path) as it:
+            entries = {entry.name: entry for entry in it}
+
+        # Mask can have any extension, it just needs to have the same stem as the image.
+        mask_file_stems = {path.stem: path for path in self.mask_path.glob('*') if path.is_file()} if self.mask_path is not None else {}
+
+        media_files = []
+        # deterministic order
+        for name in sorted(entries.keys()):
+            entry = entries[name]
+            image_file = Path(entry.path)
+            if not entry.is_file() or image_file.suffix == '.txt' or image_file.suffix == '.npz' or image_file.suffix == '.json':
+                continue
+            stat = entry.stat()
+            caption_entry = entries.get(image_file.with_suffix('.txt').name, None)
+            if caption_entry is not None:
+                caption_file = caption_entry.path
+                caption_mtime = caption_entry.stat().st_mtime_ns
+            else:
+                caption_file = ''
+                caption_mtime = None
+            if image_file.stem in mask_file_stems:
+                mask_file = str(mask_file_stems[image_file.stem])
+            elif self.default_mask_file is not None:
+                mask_file = str(self.default_mask_file)
+            else:
+                if self.mask_path is not None:
+                    logger.warning(f'No mask file was found for image {image_file}, not using mask.')
+                mask_file = None
+            media_files.append((str(image_file), caption_file, mask_file, (stat.st_size, stat.st_mtime_ns, caption_mtime)))
+        return media_files
+
+    # Anything that changes the result of probing a file. Changing it invalidates the metadata index.
+    def _probe_config(self):
+        return {'framerate': self.framerate, 'video_backend': self.video_backend}
+
     def _set_defaults(self, directory_config, dataset_config):
         directory_config.setdefault('enable_ar_bucket', dataset_config.get('enable_ar_bucket', False))
         directory_config.setdefault('shuffle_tags', dataset_config.get('shuffle_tags', False))
         directory_config.setdefault('caption_prefix', dataset_config.get('caption_prefix', ''))
         directory_config.setdefault('num_repeats', dataset_config.get('num_repeats', 1))
 
-    def _metadata_map_fn(self):
+    # Turns the probe results in the metadata index into metadata columns with the final captions. Unreadable files are dropped.
+    def _build_metadata(self, media_files, index):
         captions_file = self.path / 'captions.json'
         if captions_file.exists():
             with open(captions_file) as f:
@@ -410,10 +882,9 @@ class DirectoryDataset:
         else:
             caption_data = None
 
-        def fn(example):
-            # batch size always 1
-            caption_file = example['caption_file'][0]
-            image_file = example['image_file'][0]
+        metadata = {'image_file': [], 'mask_file': [], 'caption': [], 'file_version': [], 'width': [], 'height': [], 'frames': []}
+        for image_file, _, mask_file, stat_key in media_files:
+            entry = index.entries[image_file]
             captions = None
             if caption_data is not None:
                 captions = caption_data.get(Path(image_file).name, None)
@@ -421,108 +892,69 @@ class DirectoryDataset:
                     logger.warning(f'Image file {image_file} does not have an entry in captions.json')
                 else:
                     assert isinstance(captions, list), 'captions.json must contain lists of captions'
-            if captions is None and caption_file:
-                with open(caption_file) as f:
-                    captions = [f.read().strip()]
+                    captions = list(captions)
+            if captions is None and entry['caption'] is not None:
+                captions = [entry['caption']]
             if captions is None:
                 captions = ['']
                 logger.warning(f'Cound not find caption for {image_file}. Using empty caption.')
-            for i, caption in enumerate(captions):
-                if self.directory_config['shuffle_tags']:
-                    tags = [tag.strip() for tag in caption.split(',')]
-                    random.shuffle(tags)
-                    caption = ', '.join(tags)
-                caption = self.directory_config['caption_prefix'] + caption
-                captions[i] = caption
-            empty_return = {'image_file': [], 'mask_file': [], 'caption': [], 'ar_bucket': [], 'size_bucket': [], 'is_video': []}
-
-            image_file = Path(image_file)
-            if image_file.suffix == '.webp':
-                frames = imageio.get_reader(image_file).get_length()
-                if frames > 1:
-                    raise NotImplementedError('WebP videos are not supported.')
-            try:
-                if image_file.suffix in VIDEO_EXTENSIONS:
-                    # 100% accurate frame count, but much slower.
-                    # frames = 0
-                    # for frame in imageio.v3.imiter(image_file):
-                    #     frames += 1
-                    #     height, width = frame.shape[:2]
-                    # TODO: this is an estimate of frame count. What happens if variable frame rate? Is
-                    # it still close enough?
-                    meta = imageio.v3.immeta(image_file)
-                    first_frame = next(imageio.v3.imiter(image_file))
-                    height, width = first_frame.shape[:2]
-                    assert self.framerate is not None, "Need model framerate but don't have it. This shouldn't happen. Is the framerate attribute on the model set?"
-                    frames = int(self.framerate * meta['duration'])
-                else:
-                    pil_img = Image.open(image_file)
-                    width, height = pil_img.size
-                    frames = 1
-            except Exception:
+            self._process_captions(image_file, captions)
+
+            if entry['frames'] is None:
                 logger.warning(f'Media file {image_file} could not be opened. Skipping.')
-                return empty_return
-            is_video = (frames > 1)
-            log_ar = np.log(width / height)
-
-            if self.use_size_buckets:
-                size_bucket = self._find_closest_size_bucket(log_ar, frames, is_video)
-                if size_bucket is None:
-                    print(f'video with frames={frames} is being skipped because it is too short')
-                    return empty_return
-                ar_bucket = None
-            else:
-                ar_bucket = self._find_closest_ar_bucket(log_ar, frames, is_video)
-                if ar_bucket is None:
-                    print(f'video with frames={frames} is being skipped because it is too short')
-                    return empty_return
-                size_bucket = None
-
-            return {
-                'image_file': [str(image_file)],
-                'mask_file': [example['mask_file'][0]],
-                'caption': [captions],
-                'ar_bucket': [ar_bucket],
-                'size_bucket': [size_bucket],
-                'is_video': [is_video]
-            }
-
-        return fn
-
-    def _find_closest_ar_bucket(self, log_ar, frames, is_video):
-        # Best AR bucket is the one with the smallest AR difference in log space.
-        i = np.argmin(np.abs(log_ar - self.log_ars))
-        # find closest frame bucket where the number of frames is greater than or equal to the bucket
-        diffs = frames - self.frame_buckets
-        positive_diffs = diffs[diffs >= 0]
-        if len(positive_diffs) == 0:
-            # video not long enough to find any valid frame bucket
-            return None
-        j = np.argmin(positive_diffs)
-        if is_video and self.frame_buckets[j] == 1:
-            # don't let video be mapped to the image frame bucket
-            return None
-        ar_bucket = (self.ars[i], self.frame_buckets[j])
-        return ar_bucket
+                continue
 
-    def _find_closest_size_bucket(self, log_ar, frames, is_video):
+            metadata['image_file'].append(image_file)
+            metadata['mask_file'].append(mask_file)
+            metadata['caption'].append(captions)
+            # Size and mtime of the media file, so modified files are cached again.
+            metadata['file_version'].append(f'{stat_key[0]}:{stat_key[1]}')
+            metadata['width'].append(entry['width'])
+            metadata['height'].append(entry['height'])
+            metadata['frames'].append(entry['frames'])
+        return metadata
+
+    # Applies shuffle_tags and caption_prefix to the captions of one media file, in place.
+    def _process_captions(self, image_file, captions):
+        for i, caption in enumerate(captions):
+            if self.directory_config['shuffle_tags']:
+                tags = [tag.strip() for tag in caption.split(',')]
+                # Seeded by file path so every process (and every rescan) produces the same captions.
+                random.Random(f'{image_file}:{i}').shuffle(tags)
+                caption = ', '.join(tags)
+            caption = self.directory_config['caption_prefix'] + caption
+            captions[i] = caption
+
+    # Returns, for each file, the flat index ar_idx*len(frame_buckets) + frame_idx of its AR bucket, or -1 if the
+    # video is too short for any frame bucket.
+    def _assign_ar_buckets(self, widths, heights, frames):
         # Best AR bucket is the one with the smallest AR difference in log space.
-        ar_diffs = np.abs(log_ar - self.log_ars)
-        candidate_size_buckets = self.size_buckets[np.argsort(ar_diffs, kind='stable')]
-        # Find closest size bucket where the number of frames is greater than or equal to the bucket.
-        # self.size_buckets was already sorted longest -> shortest frame length
-        found = False
-        for size_bucket in candidate_size_buckets:
-            if is_video and size_bucket[-1] == 1:
-                # don't let video be mapped to the image frame bucket
-                continue
-            if frames >= size_bucket[-1]:
-                found = True
-                break
-        if not found:
-            # video not long enough to find any valid frame bucket
-            return None
-        return size_bucket
+        log_ars = np.log(widths / heights)
+        ar_idx = np.argmin(np.abs(log_ars[:, None] - self.log_ars[None, :]), axis=1)
+        # Largest frame bucket where the number of frames is greater than or equal to the bucket.
+        # self.frame_buckets is sorted shortest -> longest.
+        frame_idx = np.searchsorted(self.frame_buckets, frames, side='right') - 1
+        # Don't let video be mapped to the image frame bucket.
+        invalid = (frame_idx < 0) | ((frames > 1) & (self.frame_buckets[np.maximum(frame_idx, 0)] == 1))
+        return np.where(invalid, -1, ar_idx * len(self.frame_buckets) + frame_idx)
+
+    # Returns, for each file, the index into self.size_buckets of its size bucket, or -1 if the video is too short
+    # for any size bucket.
+    def _assign_size_buckets(self, widths, heights, frames):
+        # Best size bucket is the one with the smallest AR difference in log space, among the size buckets where the
+        # number of frames is greater than or equal to the bucket. Ties go to the longest frame length, since
+        # self.size_buckets was already sorted longest -> shortest frame length.
+        log_ars = np.log(widths / heights)
+        ar_diffs = np.abs(log_ars[:, None] - self.log_ars[None, :])
+        order = np.argsort(ar_diffs, axis=1, kind='stable')
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(len(self.size_buckets))[None, :].repeat(len(frames), axis=0), axis=1)
+        bucket_frames = self.size_buckets[:, -1][None, :]
+        # Don't let video be mapped to the image frame bucket.
+        valid = (frames[:, None] >= bucket_frames) & ~((frames[:, None] > 1) & (bucket_frames == 1))
+        rank = np.where(valid, rank, len(self.size_buckets))
+        bucket_idx = np.argmin(rank, axis=1)
+        return np.where(valid[np.arange(len(frames)), bucket_idx], bucket_idx, -1)
 
     def _process_user_provided_ars(self, ars):
         ar_buckets = set()
@@ -547,31 +979,51 @@ class DirectoryDataset:
         return result
 
     def get_size_bucket_datasets(self):
-        if self.use_size_buckets:
+        if self.use_size_buckets or self.from_plan:
             return self.size_bucket_datasets
         result = []
         for ar_bucket_dataset in self.ar_bucket_datasets:
             result.extend(ar_bucket_dataset.get_size_bucket_datasets())
         return result
 
-    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1):
+    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1, latent_identity=None):
         print(f'caching latents: {self.path}')
         datasets = self.size_bucket_datasets if self.use_size_buckets else self.ar_bucket_datasets
         for ds in datasets:
-            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size, latent_identity=latent_identity)
 
-    def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
-        print(f'caching text embeddings: {self.path}')
-        datasets = self.size_bucket_datasets if self.use_size_buckets else self.ar_bucket_datasets
-        for ds in datasets:
-            ds.cache_text_embeddings(map_fn, i, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+    # The text embeddings of the whole directory, independent of bucketing, see _cache_shared_text_embeddings(). Every size
+    # bucket looks its captions up in it, so changing the buckets (or a file moving to another bucket) never encodes
+    # a caption again.
+    def add_text_embedding_dataset(self, te_dataset):
+        for ds in self.get_size_bucket_datasets():
+            ds.add_text_embedding_dataset(te_dataset)
+
+    def get_plan(self):
+        return [ds.get_plan() for ds in self.get_size_bucket_datasets()]
+
+    def load_plan(self, plan):
+        self.size_bucket_datasets = []
+        for size_bucket_plan in plan:
+            ds = SizeBucketDataset(
+                None,
+                self.directory_config,
+                size_bucket_plan['size_bucket'],
+                self.model_name,
+                latent_codec=self.latent_codec,
+                cache_format=self.cache_format,
+                latent_store_dir=self.latent_store_dir,
+            )
+            ds.load_plan(size_bucket_plan)
+            self.size_bucket_datasets.append(ds)
+        self.from_plan = True
 
 
 # Outermost dataset object that the caller uses. Contains multiple ConcatenatedBatchedDataset. Responsible
 # for returning the correct batch for the process's data parallel rank. Calls model.prepare_inputs so the
 # returned tuple of tensors is whatever the model needs.
 class Dataset:
-    def __init__(self, dataset_config, model, skip_dataset_validation=False):
+    def __init__(self, dataset_config, model, skip_dataset_validation=False, cache_shard=None):
         super().__init__()
         self.dataset_config = dataset_config
         self.model = model
@@ -588,6 +1040,11 @@ class Dataset:
                 dataset_config,
                 self.model_name,
                 framerate=model.framerate,
+                video_backend=model.config.get('video_backend', DEFAULT_VIDEO_BACKEND),
+                latent_codec=model.config.get('latent_cache_codec', 'none'),
+                cache_format=model.config.get('cache_format', 'arrow'),
+                latent_store_dir=model.config.get('latent_store_dir', None),
+                cache_shard=cache_shard,
                 skip_dataset_validation=skip_dataset_validation,
             )
             self.directory_datasets.append(directory_dataset)
@@ -656,7 +1113,9 @@ class Dataset:
             if key == 'mask':
                 continue  # mask is handled specially below
             if torch.is_tensor(value):
-                ret[key] = torch.stack([example[key] for example in examples])
+                # Text embeddings can be stored trimmed to their length, pad them to the longest in the batch.
+                # The batch is split into micro batches later, so every micro batch of a step has the same shape.
+                ret[key] = _pad_and_stack([example[key] for example in examples])
             else:
                 ret[key] = [example[key] for example in examples]
         # Only some items in the batch might have valid mask.
@@ -679,19 +1138,378 @@ class Dataset:
         return ret
 
     def cache_metadata(self, regenerate_cache=False):
-        for ds in self.directory_datasets:
-            ds.cache_metadata(regenerate_cache=regenerate_cache)
+        _cache_metadata(self.directory_datasets, regenerate_cache=regenerate_cache)
 
-    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1):
+    def cache_latents(self, map_fn, regenerate_cache=False, caching_batch_size=1, latent_identity=None):
         for ds in self.directory_datasets:
-            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+            ds.cache_latents(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size, latent_identity=latent_identity)
+
+    # Compact description of the cached dataset, so other processes can load it without redoing the work of
+    # building it (listing directories, fingerprinting, reading the cached tables).
+    def get_plan(self):
+        return [ds.get_plan() for ds in self.directory_datasets]
 
-    def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
+    def load_plan(self, plan):
+        for ds, directory_plan in zip(self.directory_datasets, plan):
+            ds.load_plan(directory_plan)
+
+    def merge_cache_shards(self, num_shards):
         for ds in self.directory_datasets:
-            ds.cache_text_embeddings(map_fn, i, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+            ds.merge_cache_shards(num_shards)
+
 
+# Points every cache file in the plans of all datasets at a copy under local_cache_dir. Returns the new plans, and
+# the source of every local file, {local path relative to local_cache_dir: source path}.
+def _localize_plans(plans, local_cache_dir):
+    local_cache_dir = Path(local_cache_dir)
+    files = {}
 
-def _cache_fn(datasets, queue, preprocess_media_file_fn, num_text_encoders, regenerate_cache, caching_batch_size):
+    def localize(path):
+        if path is None:
+            return None
+        path = Path(path)
+        # Cache files in different directories can have the same name.
+        local_path = Path('files') / hashlib.md5(str(path.parent).encode()).hexdigest()[:16] / path.name
+        files[str(local_path)] = str(path)
+        return str(local_cache_dir / local_path)
+
+    local_plans = []
+    for dataset_plan in plans:
+        local_dataset_plan = []
+        for directory_plan in dataset_plan:
+            local_directory_plan = []
+            for plan in directory_plan:
+                plan = dict(plan)
+                # With a shard, load_plan() doesn't read the Arrow cache files, don't copy them.
+                plan['latents_cache_files'] = [] if plan['latents_shard'] is not None else [localize(path) for path in plan['latents_cache_files']]
+                plan['latents_shard'] = localize(plan['latents_shard'])
+                plan['text_embeddings'] = [
+                    dict(te_plan, cache_files=[] if te_plan['shard'] is not None else [localize(path) for path in te_plan['cache_files']], shard=localize(te_plan['shard']))
+                    for te_plan in plan['text_embeddings']
+                ]
+                if plan['latent_store_dir'] is not None:
+                    for relative_path in plan['latent_store_files']:
+                        files[str(Path('latent_store') / relative_path)] = str(Path(plan['latent_store_dir']) / relative_path)
+                    plan['latent_store_dir'] = str(local_cache_dir / 'latent_store')
+                local_directory_plan.append(plan)
+            local_dataset_plan.append(local_directory_plan)
+        local_plans.append(local_dataset_plan)
+    return local_plans, files
+
+
+# Deterministic assignment of media files to cache shards, the same in every process and on every machine.
+def _in_cache_shard(image_file, cache_shard):
+    shard_index, num_shards = cache_shard
+    return int(hashlib.md5(image_file.encode()).hexdigest(), 16) % num_shards == shard_index
+
+
+# Converts a 2D array into an Arrow list array, one list per row.
+def _to_list_array(values):
+    num_rows, row_length = values.shape
+    offsets = np.arange(0, num_rows*row_length+1, row_length, dtype=np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values.reshape(-1)))
+
+
+# Caches metadata for multiple DirectoryDatasets. Every directory is scanned first, then all new or modified
+# files across all the directories are probed in one parallel stage.
+def _cache_metadata(directory_datasets, regenerate_cache=False):
+    # Directories with a manifest already have all their metadata, they are never scanned or probed.
+    for ds in directory_datasets:
+        if ds.manifest is not None:
+            ds._load_manifest()
+    directory_datasets = [ds for ds in directory_datasets if ds.manifest is None]
+    scans = [ds._scan_metadata(regenerate_cache=regenerate_cache) for ds in directory_datasets]
+    tasks = []
+    for ds, (_, _, to_probe) in zip(directory_datasets, scans):
+        tasks.extend((image_file, caption_file, ds.framerate, ds.video_backend) for image_file, caption_file, _ in to_probe)
+    probe_results = iter(probe_media_files(tasks))
+    for ds, (media_files, index, to_probe) in zip(directory_datasets, scans):
+        for image_file, _, stat_key in to_probe:
+            index.update(image_file, stat_key, next(probe_results))
+        ds._finish_metadata(media_files, index)
+
+
+# Decodes media files on a thread pool and sends batches of frames to the GPU ranks as soon as they are ready,
+# without waiting for the previous batches to be encoded. At most max_in_flight shared memory slabs are in use,
+# each holding a batch being encoded or its latents being copied out on a separate thread, and at most
+# 2*decode_threads files are decoded ahead, which bounds memory use. Returns the map() output for the files, in
+# order. Time spent in each stage is sent to the GPU ranks, which print it at the end of caching.
+def _encode_latents_pipelined(files, preprocess_media_file_fn, queue, batch_size, decode_threads, max_in_flight):
+    start = time.perf_counter()
+    stats = defaultdict(float)
+
+    def decode(path, mask_path, size_bucket):
+        decode_start = time.perf_counter()
+        items = preprocess_media_file_fn(path, mask_path, size_bucket)
+        return items, time.perf_counter() - decode_start
+
+    allocator = get_slab_allocator()
+    max_in_flight = max(max_in_flight, 1)
+    in_flight = deque()
+    # Batches whose latents are being copied out of their slab, oldest first.
+    copying = deque()
+    results = defaultdict(list)
+    # Latency samples for caching telemetry: per file decode, and per batch from submitting to getting the latents.
+    decode_latency, encode_latency = [], []
+
+    def submit(tensors):
+        # Start copying out the batches that are already encoded, then wait until a slab is free.
+        while len(in_flight) > 0 and in_flight[0][1].poll():
+            collect()
+        release_copied(wait=False)
+        while len(in_flight) + len(copying) >= max_in_flight:
+            if len(copying) > 0:
+                release_copied(wait=True)
+            else:
+                collect()
+        # Stack the batch directly into shared memory. Only the descriptor goes through the queue, the GPU
+        # rank reads the frames in place and writes the latents back into the same slab.
+        shape = (len(tensors),) + tuple(tensors[0].shape)
+        slab = allocator.acquire(math.prod(shape) * tensors[0].element_size())
+        batched, descriptor = slab.empty(shape, tensors[0].dtype)
+        torch.stack(tensors, out=batched)
+        del batched
+        parent_conn, child_conn = mp.Pipe(duplex=False)
+        queue.put((0, descriptor, child_conn))
+        in_flight.append((slab, parent_conn, time.perf_counter()))
+
+    def collect():
+        slab, parent_conn, submit_time = in_flight.popleft()
+        wait_start = time.perf_counter()
+        result = parent_conn.recv()  # dict
+        stats['wait_encode'] += time.perf_counter() - wait_start
+        encode_latency.append(time.perf_counter() - submit_time)
+        copying.append((slab, copier.submit(copy_out, slab, result)))
+
+    # Copy out of the slab, it gets reused for later batches.
+    def copy_out(slab, result):
+        return {k: slab.read(v).clone() if isinstance(v, TensorDescriptor) else v for k, v in result.items()}
+
+    # Returns the slabs of copied batches to the allocator, in submit order. With wait, waits for at least one.
+    def release_copied(wait):
+        while len(copying) > 0 and (wait or copying[0][1].done()):
+            slab, future = copying.popleft()
+            wait_start = time.perf_counter()
+            for k, v in future.result().items():
+                results[k].append(v)
+            stats['wait_copy'] += time.perf_counter() - wait_start
+            allocator.release(slab)
+            wait = False
+
+    image_files, masks = [], []
+    tensors = []
+    with ThreadPoolExecutor(decode_threads) as executor, ThreadPoolExecutor(1) as copier:
+        pending = deque()
+        files = iter(files)
+        while True:
+            while len(pending) < 2*decode_threads and (file := next(files, None)) is not None:
+                path, mask_path, size_bucket = file
+                pending.append((path, executor.submit(decode, path, mask_path, size_bucket)))
+            if len(pending) == 0:
+                break
+            path, future = pending.popleft()
+            wait_start = time.perf_counter()
+            items, decode_time = future.result()
+            stats['wait_decode'] += time.perf_counter() - wait_start
+            stats['decode_busy'] += decode_time
+            decode_latency.append(decode_time)
+            for tensor, mask in items:
+                # (channels, frames, height, width) for videos, (channels, height, width) for images.
+                stats['frames'] += tensor.shape[1] if tensor.ndim == 4 else 1
+                tensors.append(tensor)
+                image_files.append(path)
+                masks.append(mask)
+            while len(tensors) >= batch_size:
+                submit(tensors[:batch_size])
+                tensors = tensors[batch_size:]
+        if len(tensors) > 0:
+            submit(tensors)
+        del tensors
+        while len(in_flight) > 0:
+            collect()
+        while len(copying) > 0:
+            release_copied(wait=True)
+
+    stats['wall'] = time.perf_counter() - start
+    stats['decode_capacity'] = stats['wall'] * decode_threads
+    stats['items'] = len(image_files)
+    stats['bytes_written'] = sum(t.numel() * t.element_size() for v in results.values() for t in v)
+    queue.put((-1, dict(stats, decode_latency=decode_latency, encode_latency=encode_latency)))
+
+    if len(image_files) == 0:
+        return {'latents': [], 'mask': [], 'image_file': []}
+    # concatenate the list of tensors at each key into one batched tensor
+    for k, v in results.items():
+        results[k] = torch.cat(v)
+    results['image_file'] = image_files
+    results['mask'] = masks
+    return results
+
+
+# Like _encode_latents_pipelined, but files that already have an entry in the latent store are neither decoded nor
+# encoded, and new entries are added to the store. The map() output has a (latent_key, clip) reference per row
+# instead of the latents.
+# With prefix (see DatasetManager.cache), video entries are prefixes of a longer encode of the same file at the same
+# resolution when possible: the longest frame bucket the file is cached for is encoded, shorter ones slice its
+# latent time axis.
+def _encode_latents_with_store(files, store, store_params, preprocess_media_file_fn, queue, *args, prefix=None):
+    def get_key(path, mask_path, size_bucket, **extra_params):
+        return store.key(path, mask_path, **store_params, **preprocess_media_file_fn.get_cache_params(size_bucket), **extra_params)
+
+    # Key of the entry used for each file. Derived entries have their own keys, they are only used with prefix.
+    keys = []
+    num_clips = {}
+    to_encode = {}
+    # Entries sliced from a longer entry: key -> (longer key, frames)
+    to_derive = {}
+    # Prefix group of directly encoded video entries, the key without the frame count: key -> (group, frames)
+    prefix_groups = {}
+    # Direct encode of each derived entry, used if slicing is too far off for its size bucket:
+    # derived key -> (direct key, file, group)
+    direct_files = {}
+    for path, mask_path, size_bucket in files:
+        key = get_key(path, mask_path, size_bucket)
+        width, height, frames = size_bucket
+        use_prefix = (prefix is not None and frames > 1)
+        if use_prefix and not prefix['validate']:
+            derived_key = get_key(path, mask_path, size_bucket, prefix_of_longer_encode=True)
+            if derived_key in num_clips or derived_key in to_derive or store.num_clips(derived_key) is not None:
+                key = derived_key
+        keys.append(key)
+        if key in num_clips or key in to_encode or key in to_derive:
+            continue
+        if (n := store.num_clips(key)) is not None:
+            num_clips[key] = n
+            continue
+        if not use_prefix:
+            to_encode[key] = (path, mask_path, size_bucket)
+            continue
+        group = get_key(path, mask_path, (width, height, None))
+        max_frames = prefix['max_frames'].get((path, mask_path, width, height), frames)
+        longer = sorted(set(f for f in store.get_prefix_frames(group) + [max_frames] if f > frames))
+        longer_keys = {f: get_key(path, mask_path, (width, height, f)) for f in longer}
+        existing = [f for f in longer if store.num_clips(longer_keys[f]) is not None]
+        if len(existing) > 0:
+            longer_frames = existing[0]
+        elif max_frames > frames:
+            # Encode the longest frame bucket this file is cached for, once.
+            longer_frames = max_frames
+            longer_key = longer_keys[longer_frames]
+            if longer_key not in to_encode:
+                to_encode[longer_key] = (path, mask_path, (width, height, longer_frames))
+                prefix_groups[longer_key] = (group, longer_frames)
+        else:
+            to_encode[key] = (path, mask_path, size_bucket)
+            prefix_groups[key] = (group, frames)
+            continue
+        if prefix['validate']:
+            # Also encode directly, to compare. The direct encode is what gets stored and used.
+            to_encode[key] = (path, mask_path, size_bucket)
+            prefix_groups[key] = (group, frames)
+            to_derive[key] = (longer_keys[longer_frames], frames)
+        else:
+            keys[-1] = derived_key
+            to_derive[derived_key] = (longer_keys[longer_frames], frames)
+            direct_files[derived_key] = (key, (path, mask_path, size_bucket), group)
+    num_hits = len(num_clips)
+    # The first new derived entry of each size bucket is also encoded directly, to check the slicing against.
+    checks = {}
+    for derived_key, (direct_key, file, group) in direct_files.items():
+        if tuple(file[2]) not in checks:
+            checks[tuple(file[2])] = derived_key
+            to_encode[direct_key] = file
+            prefix_groups[direct_key] = (group, file[2][2])
+
+    # Longer encodes for prefixes have another frame count. Batches must have one shape, encode each separately.
+    def encode(entries):
+        by_size_bucket = defaultdict(dict)
+        for key, file in entries.items():
+            by_size_bucket[tuple(file[2])][key] = file
+        for size_bucket_files in by_size_bucket.values():
+            results = _encode_latents_pipelined(list(size_bucket_files.values()), preprocess_media_file_fn, queue, *args)
+            tensor_keys = [k for k in results.keys() if k != 'image_file']
+            # All clips of a file are in consecutive rows. Files without any clips get an empty entry, so they
+            # aren't decoded again either.
+            row = 0
+            for key, (path, _, _) in size_bucket_files.items():
+                clips = []
+                while row < len(results['image_file']) and results['image_file'][row] == path:
+                    clips.append({k: results[k][row] for k in tensor_keys})
+                    row += 1
+                store.save(key, clips)
+                num_clips[key] = len(clips)
+                if key in prefix_groups:
+                    store.add_prefix_frames(*prefix_groups[key])
+
+    def derive(longer_key, frames):
+        latent_frames = (frames - 1) // prefix['temporal_compression'] + 1
+        clips = []
+        for clip in range(store.num_clips(longer_key)):
+            clip = store.load(longer_key, clip)
+            clip['latents'] = clip['latents'][:, :latent_frames].clone()
+            clips.append(clip)
+        return clips
+
+    # Adds the difference between sliced and direct latents to stats, returns the relative RMS difference.
+    stats = defaultdict(float)
+    def compare(derived_clips, direct_key):
+        squared_error, squared_norm = 0., 0.
+        for derived, direct in zip(derived_clips, [store.load(direct_key, clip) for clip in range(num_clips[direct_key])]):
+            derived = decode_latents(derived['latents'], derived.get('latents_scale', None), derived.get('latents_shift', None))
+            direct = decode_latents(direct['latents'], direct.get('latents_scale', None), direct.get('latents_shift', None))
+            error = derived - direct
+            squared_error += error.square().sum().item()
+            squared_norm += direct.square().sum().item()
+            stats['prefix_max_error'] = max(stats['prefix_max_error'], error.abs().max().item())
+        stats['prefix_squared_error'] += squared_error
+        stats['prefix_squared_norm'] += squared_norm
+        return math.sqrt(squared_error / squared_norm) if squared_norm > 0 else 0.
+
+    encode(to_encode)
+    num_encoded = len(to_encode)
+    if prefix is not None and prefix['validate']:
+        for key, (longer_key, frames) in to_derive.items():
+            compare(derive(longer_key, frames), key)
+    else:
+        # Size buckets whose check is over the tolerance are encoded directly instead.
+        fallback = {}
+        for size_bucket, derived_key in checks.items():
+            error = compare(derive(*to_derive[derived_key]), direct_files[derived_key][0])
+            if error > prefix['tolerance']:
+                print(
+                    f'WARNING: latents sliced from a longer encode differ from a direct encode by {error:.2e} (relative RMS) '
+                    f'for size bucket {size_bucket}, over latent_prefix_tolerance={prefix["tolerance"]}. Encoding it directly.'
+                )
+                fallback[size_bucket] = {}
+        replaced = {}
+        for derived_key, (direct_key, file, group) in direct_files.items():
+            if tuple(file[2]) in fallback:
+                del to_derive[derived_key]
+                replaced[derived_key] = direct_key
+                if direct_key not in num_clips:
+                    fallback[tuple(file[2])][direct_key] = file
+                    prefix_groups[direct_key] = (group, file[2][2])
+        keys = [replaced.get(key, key) for key in keys]
+        for size_bucket_files in fallback.values():
+            encode(size_bucket_files)
+            num_encoded += len(size_bucket_files)
+        for key, (longer_key, frames) in to_derive.items():
+            clips = derive(longer_key, frames)
+            store.save(key, clips)
+            num_clips[key] = len(clips)
+    # Sliced entries aren't encoded, they're counted separately. With validate they're also encoded.
+    queue.put((-1, dict(stats, store_hits=num_hits, store_encoded=num_encoded, prefix_derived=len(to_derive))))
+
+    ret = {'latent_key': [], 'clip': [], 'image_file': []}
+    for key, (path, _, _) in zip(keys, files):
+        for clip in range(num_clips[key]):
+            ret['latent_key'].append(key)
+            ret['clip'].append(clip)
+            ret['image_file'].append(path)
+    return ret
+
+
+def _cache_fn(datasets, queue, preprocess_media_file_fn, text_encoder_identities, variable_length_text_embeddings, regenerate_cache, caching_batch_size, decode_threads, prefetch, latent_store_params, latent_identity, text_embedding_cache_dir):
     # Dataset map() starts a bunch of processes. Make sure torch uses a limited number of threads
     # to avoid CPU contention.
     # TODO: if we ever change Datasets map to use spawn instead of fork, this might not work.
@@ -701,54 +1519,50 @@ def _cache_fn(datasets, queue, preprocess_media_file_fn, num_text_encoders, rege
     # Alternatively, we could try fixing this by using spawn instead of fork.
     torch.set_num_threads(1)
 
-    for ds in datasets:
-        ds.cache_metadata(regenerate_cache=regenerate_cache)
+    # Probe files from all directories of all datasets together, so the probing stage can use all cores.
+    _cache_metadata([directory_dataset for ds in datasets for directory_dataset in ds.directory_datasets], regenerate_cache=regenerate_cache)
+
+    latent_store = None if latent_store_params is None else LatentStore(latent_store_params['store_dir'])
+    prefix = None
+    if latent_store_params is not None and latent_store_params['prefix'] is not None:
+        # Longest frame bucket each video is cached for, at each resolution, over all datasets.
+        max_frames = {}
+        for ds in datasets:
+            for directory_dataset in ds.directory_datasets:
+                for size_bucket_dataset in directory_dataset.get_size_bucket_datasets():
+                    width, height, frames = size_bucket_dataset.size_bucket
+                    metadata = size_bucket_dataset.metadata_dataset.select_columns(['image_file', 'mask_file']).with_format(None)[:]
+                    for image_file, mask_file in zip(metadata['image_file'], metadata['mask_file']):
+                        key = (image_file, mask_file, width, height)
+                        max_frames[key] = max(max_frames.get(key, 0), frames)
+        prefix = dict(latent_store_params['prefix'], max_frames=max_frames)
 
     def latents_map_fn(example):
         first_size_bucket = example['size_bucket'][0]
-        tensors_and_masks = []
-        image_files = []
-        captions = []
-        for path, mask_path, size_bucket, caption in zip(example['image_file'], example['mask_file'], example['size_bucket'], example['caption']):
+        for size_bucket in example['size_bucket']:
             assert size_bucket == first_size_bucket
-            items = preprocess_media_file_fn(path, mask_path, size_bucket)
-            tensors_and_masks.extend(items)
-            image_files.extend([path] * len(items))
-            captions.extend([caption] * len(items))
-
-        if len(tensors_and_masks) == 0:
-            return {'latents': [], 'mask': [], 'image_file': [], 'caption': []}
-
-        caching_batch_size = len(example['image_file'])
-        results = defaultdict(list)
-        for i in range(0, len(tensors_and_masks), caching_batch_size):
-            tensors = [t[0] for t in tensors_and_masks[i:i+caching_batch_size]]
-            batched = torch.stack(tensors)
-            parent_conn, child_conn = mp.Pipe(duplex=False)
-            queue.put((0, batched, child_conn))
-            result = parent_conn.recv()  # dict
-            for k, v in result.items():
-                results[k].append(v)
-        # concatenate the list of tensors at each key into one batched tensor
-        for k, v in results.items():
-            results[k] = torch.cat(v)
-        results['image_file'] = image_files
-        results['mask'] = [t[1] for t in tensors_and_masks]
-        results['caption'] = captions
-        return results
+        files = list(zip(example['image_file'], example['mask_file'], example['size_bucket']))
+        if latent_store is not None:
+            return _encode_latents_with_store(
+                files, latent_store, latent_store_params['params'], preprocess_media_file_fn, queue, caching_batch_size, decode_threads, prefetch, prefix=prefix
+            )
+        return _encode_latents_pipelined(files, preprocess_media_file_fn, queue, caching_batch_size, decode_threads, prefetch)
 
+    # Each map() call gets many encode batches, so decoding and encoding can overlap within the call.
+    # This doesn't change the cache fingerprint.
     for ds in datasets:
-        ds.cache_latents(latents_map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+        ds.cache_latents(latents_map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size*ENCODE_BATCHES_PER_MAP_CALL, latent_identity=latent_identity)
 
-    for text_encoder_idx in range(num_text_encoders):
+    for text_encoder_idx, text_encoder_identity in enumerate(text_encoder_identities):
         def text_embedding_map_fn(example):
             parent_conn, child_conn = mp.Pipe(duplex=False)
             queue.put((text_encoder_idx+1, example['caption'], example['is_video'], child_conn))
-            result = parent_conn.recv()  # dict
-            result['image_file'] = example['image_file']
+            result = _trim_text_embeddings(parent_conn.recv(), variable_length_text_embeddings)
+            bytes_written = sum(row.numel() * row.element_size() for v in result.values() for row in v)
+            queue.put((-1, {'text_items': len(example['caption']), 'bytes_written': bytes_written}))
+            # Rows are per unique caption, not per media file, so no image_file column.
             return result
-        for ds in datasets:
-            ds.cache_text_embeddings(text_embedding_map_fn, text_encoder_idx+1, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+        _cache_shared_text_embeddings(datasets, text_embedding_map_fn, text_encoder_idx+1, text_embedding_cache_dir, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size, text_encoder_identity=text_encoder_identity, text_embedding_format=_text_embedding_format(variable_length_text_embeddings))
 
     # signal that we're done
     queue.put(None)
@@ -764,13 +1578,101 @@ class DatasetManager:
         self.submodels = [self.vae] + list(self.text_encoders)
         self.call_vae_fn = self.model.get_call_vae_fn(self.vae)
         self.call_text_encoder_fns = [self.model.get_call_text_encoder_fn(text_encoder) for text_encoder in self.text_encoders]
+        self.text_encoder_identities = [self.model.get_text_encoder_identity(i) for i in range(1, len(self.text_encoders)+1)]
         self.regenerate_cache = regenerate_cache
         self.caching_batch_size = caching_batch_size
         self.datasets = []
+        self.shm_attachments = SharedMemoryAttachments()
+        # Tasks from different map workers are merged into one forward call. VAE tasks are merged up to this many
+        # bytes of input frames, by default caching_batch_size clips of the task's size bucket (0 disables it), text
+        # encoder tasks up to this many captions. The first task waits at most caching_max_wait_ms for others.
+        self.max_batch_bytes = self.model.config.get('caching_max_batch_bytes', None)
+        self.max_text_batch = self.model.config.get('caching_max_text_batch', 64)
+        self.max_wait = self.model.config.get('caching_max_wait_ms', 10) / 1000
+        self.pending_tasks = deque()
+        self.queue_finished = False
+        # Files each map worker decodes in parallel, and shared memory slabs each worker can use for batches being
+        # encoded or copied out.
+        self.decode_threads = self.model.config.get('caching_decode_threads', 4)
+        self.prefetch = self.model.config.get('caching_prefetch', 2)
+        self.stats = defaultdict(float)
+        self.latent_codec = self.model.config.get('latent_cache_codec', 'none')
+        validate_latent_codec(self.latent_codec)
+        if self.latent_codec != 'none' and not self.model.supports_latent_codec:
+            raise NotImplementedError(f'latent_cache_codec={self.latent_codec} is not supported for model type {self.model.name}')
+        self.latent_store_dir = self.model.config.get('latent_store_dir', None)
+        # One text embedding cache for all registered datasets. Defaults to cache/<model>/text_embeddings of the
+        # first directory.
+        self.text_embedding_cache_dir = self.model.config.get('text_embedding_cache_dir', None)
+        # Part of every latent item key and latent store key, so latents of another VAE are never reused. Only the
+        # main process caches, and hashing the VAE weights takes a while.
+        self.vae_identity = None
+        self.preprocess_media_file_fn = None
+        if is_main_process():
+            self.preprocess_media_file_fn = self.model.get_preprocess_media_file_fn()
+            try:
+                self.vae_identity = self.model.get_vae_identity()
+            except NotImplementedError:
+                if self.latent_store_dir is not None:
+                    raise ValueError(f'Model type {self.model.name} does not support latent_store_dir') from None
+        # single_beginning clips of a video at the same resolution are prefixes of each other. With a causal VAE,
+        # shorter frame buckets can slice the latents of the longest one instead of being encoded separately.
+        # latent_prefix_validation encodes them anyway, and prints the difference.
+        self.latent_prefix_reuse = self.model.config.get('latent_prefix_reuse', False)
+        self.latent_prefix_validation = self.model.config.get('latent_prefix_validation', False)
+        # Otherwise, the first sliced entry of each size bucket in every map() call is checked against a direct encode.
+        # If the relative RMS difference is over this, the size bucket is encoded directly.
+        self.latent_prefix_tolerance = self.model.config.get('latent_prefix_tolerance', 0.05)
+        if self.latent_prefix_reuse:
+            if self.latent_store_dir is None:
+                raise ValueError('latent_prefix_reuse requires latent_store_dir')
+            if self.model.config.get('video_clip_mode', 'single_beginning') != 'single_beginning':
+                raise ValueError('latent_prefix_reuse requires video_clip_mode=single_beginning')
+            if self.model.causal_vae_temporal_compression is None:
+                raise NotImplementedError(f'latent_prefix_reuse is not supported for model type {self.model.name}')
+        # Least recently used cache files are deleted after caching, while the cache directories use more than this.
+        self.cache_disk_budget_gb = self.model.config.get('cache_disk_budget_gb', None)
+        # JSONL and TensorBoard logs of caching throughput, see utils/caching_telemetry.py.
+        default_telemetry_dir = os.path.join(self.model.config['output_dir'], 'caching_telemetry') if 'output_dir' in self.model.config else None
+        self.caching_telemetry_dir = self.model.config.get('caching_telemetry_dir', default_telemetry_dir)
+        self.caching_telemetry_interval = self.model.config.get('caching_telemetry_interval', 10)
+        self.telemetry = None
+        # Copy the cache to this directory on every node after caching, and train from the copies.
+        self.local_cache_dir = self.model.config.get('local_cache_dir', None)
+        cache_format = self.model.config.get('cache_format', 'arrow')
+        if cache_format not in CACHE_FORMATS:
+            raise NotImplementedError(f'cache_format={cache_format} is not recognized. Options are: {", ".join(CACHE_FORMATS)}')
 
     def register(self, dataset):
         self.datasets.append(dataset)
 
+    def _get_text_embedding_cache_dir(self):
+        if self.text_embedding_cache_dir is not None:
+            return Path(self.text_embedding_cache_dir)
+        return self.datasets[0].directory_datasets[0].cache_dir / 'text_embeddings'
+
+    # Cache directories of all registered datasets, for verify_cache() and collect_garbage(). Includes the text
+    # embedding cache, unless it's inside one of the directory caches.
+    def _get_cache_dirs(self):
+        cache_dirs = sorted(set(str(ds.cache_dir) for dataset in self.datasets for ds in dataset.directory_datasets))
+        text_embedding_cache_dir = self._get_text_embedding_cache_dir()
+        if not any(text_embedding_cache_dir.is_relative_to(cache_dir) for cache_dir in cache_dirs):
+            cache_dirs.append(str(text_embedding_cache_dir))
+        return cache_dirs
+
+    # Everything about decoding and encoding that isn't specific to a media file or size bucket: the VAE, the
+    # latent codec, and the preprocessing (video backend, clip mode, ...). Part of the latent item keys of every
+    # dataset.
+    def get_latent_identity(self):
+        return {'vae': self.vae_identity, 'latent_codec': self.latent_codec, 'preprocess': self.preprocess_media_file_fn.get_fixed_cache_params()}
+
+    # Checks the existing cache of all registered datasets before caching, see utils/cache_verify.py. Corrupt
+    # items are dropped from the cache, so cache() encodes them again.
+    def verify_cache(self):
+        if is_main_process():
+            verify_cache(self._get_cache_dirs(), latent_store_dir=self.latent_store_dir, num_workers=NUM_PROC)
+        dist.barrier()
+
     # Some notes for myself:
     # Use a manager queue, since that can be pickled and unpickled, and sent to other processes.
     # IMPORTANT: we use multiprocess library (not Python multiprocessing!) just like HF Datasets does.
@@ -780,6 +1682,7 @@ class DatasetManager:
     # but eventually, inevitably, queue.put() will fail with BrokenPipeError. Switching from multiprocessing to multiprocess,
     # which has basically the same API, and everything works perfectly. ¯\_(ツ)_/¯
     def cache(self, unload_models=True):
+        start = time.time()
         if is_main_process():
             manager = mp.Manager()
             queue = [manager.Queue()]
@@ -790,28 +1693,68 @@ class DatasetManager:
 
         # start up a process to run through the dataset caching flow
         if is_main_process():
+            latent_store_params = None
+            if self.latent_store_dir is not None:
+                # The VAE and codec part of store keys. The media file and size bucket part comes from the
+                # preprocess function.
+                latent_store_params = {
+                    'store_dir': self.latent_store_dir,
+                    'params': {'vae': self.vae_identity, 'latent_codec': self.latent_codec},
+                    'prefix': None,
+                }
+                if self.latent_prefix_reuse:
+                    latent_store_params['prefix'] = {
+                        'temporal_compression': self.model.causal_vae_temporal_compression,
+                        'validate': self.latent_prefix_validation,
+                        'tolerance': self.latent_prefix_tolerance,
+                    }
             process = mp.Process(
                 target=_cache_fn,
                 args=(
                     self.datasets,
                     queue,
-                    self.model.get_preprocess_media_file_fn(),
-                    len(self.text_encoders),
+                    self.preprocess_media_file_fn,
+                    self.text_encoder_identities,
+                    self.model.get_variable_length_text_embeddings(),
                     self.regenerate_cache,
                     self.caching_batch_size,
+                    self.decode_threads,
+                    self.prefetch,
+                    latent_store_params,
+                    self.get_latent_identity(),
+                    self._get_text_embedding_cache_dir(),
                 )
             )
             process.start()
 
+        if self.caching_telemetry_dir is not None:
+            self.telemetry = CachingTelemetry(self.caching_telemetry_dir, dist.get_rank(), interval=self.caching_telemetry_interval)
+
         # loop on the original processes (one per GPU) to handle tasks requiring GPU models (VAE, text encoders)
         while True:
-            task = queue.get()
-            if task is None:
+            if self.telemetry is not None:
+                self.telemetry.record_queue_depth(queue.qsize())
+            wait_start = time.perf_counter()
+            tasks = self._get_tasks(queue)
+            idle = time.perf_counter() - wait_start
+            self.stats['gpu_idle'] += idle
+            if tasks is None:
                 # Propagate None so all worker processes break out of this loop.
                 # This is safe because it's a FIFO queue. The first None always comes after all work items.
                 queue.put(None)
                 break
-            self._handle_task(task)
+            busy_start = time.perf_counter()
+            self._handle_tasks(tasks)
+            if tasks[0][0] >= 0:
+                self.stats['gpu_busy'] += time.perf_counter() - busy_start
+            if self.telemetry is not None:
+                self.telemetry.record_idle(idle)
+                self.telemetry.maybe_emit()
+        self.shm_attachments.close()
+        self._print_stats()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
 
         if unload_models:
             # Free memory in all unneeded submodels. This is easier than trying to delete every reference.
@@ -827,35 +1770,188 @@ class DatasetManager:
         if is_main_process():
             process.join()
 
-        # Now load all datasets from cache.
-        for ds in self.datasets:
-            ds.cache_metadata()
-            ds.cache_latents(None)
+        # Now load all datasets from cache. Only rank 0 does the full load. Every other rank gets the plan
+        # from it and only memory-maps the cache files, so they don't all hit the storage at once.
+        if is_main_process():
+            for ds in self.datasets:
+                ds.cache_metadata()
+                ds.cache_latents(None, latent_identity=self.get_latent_identity())
             for i in range(1, len(self.text_encoders)+1):
-                ds.cache_text_embeddings(None, i)
+                _cache_shared_text_embeddings(self.datasets, None, i, self._get_text_embedding_cache_dir(), text_encoder_identity=self.text_encoder_identities[i-1], text_embedding_format=_text_embedding_format(self.model.get_variable_length_text_embeddings()))
+            plans = [[ds.get_plan() for ds in self.datasets]]
+            if self.cache_disk_budget_gb is not None:
+                collect_garbage(self._get_cache_dirs(), self.cache_disk_budget_gb * 2**30, start)
+        else:
+            plans = [None]
+        local_files = None
+        if self.local_cache_dir is not None:
+            if is_main_process():
+                plans[0], local_files = _localize_plans(plans[0], self.local_cache_dir)
+            replicate_files(local_files, self.local_cache_dir)
+        torch.distributed.broadcast_object_list(plans, src=0, group=dist.get_world_group())
+        # With local_cache_dir, rank 0 also switches to the local copies.
+        if not is_main_process() or self.local_cache_dir is not None:
+            for ds, plan in zip(self.datasets, plans[0]):
+                ds.load_plan(plan)
+
+    # Where the latent caching pipeline spends its time. Map workers send their per-stage times; this rank
+    # measures how much of the time its models were busy.
+    def _print_stats(self):
+        stats = self.stats
+        if stats['codec_squared_norm'] > 0:
+            print(
+                f'latent_cache_codec={self.latent_codec} round trip error (rank {dist.get_rank()}): '
+                f'relative RMS {math.sqrt(stats["codec_squared_error"] / stats["codec_squared_norm"]):.2e}, max abs {stats["codec_max_error"]:.2e}'
+            )
+        if stats['store_hits'] + stats['store_encoded'] + stats['prefix_derived'] > 0:
+            print(
+                f'latent store (rank {dist.get_rank()}): {int(stats["store_hits"])} files found, {int(stats["store_encoded"])} encoded, '
+                f'{int(stats["prefix_derived"])} sliced from longer latents'
+            )
+        if stats['prefix_squared_norm'] > 0:
+            print(
+                f'latent_prefix_reuse (rank {dist.get_rank()}): difference between sliced and directly encoded latents: '
+                f'relative RMS {math.sqrt(stats["prefix_squared_error"] / stats["prefix_squared_norm"]):.2e}, max abs {stats["prefix_max_error"]:.2e}'
+            )
+        if stats['wall'] == 0:
+            return
+        gpu_total = stats['gpu_busy'] + stats['gpu_idle']
+        print(
+            f'latent caching stages (rank {dist.get_rank()}): {int(stats["items"])} items; '
+            f'decode threads {100*stats["decode_busy"]/max(stats["decode_capacity"], 1e-9):.0f}% busy; '
+            f'workers waited {stats["wait_decode"]:.1f}s for decoded frames, {stats["wait_encode"]:.1f}s for latents, '
+            f'{stats["wait_copy"]:.1f}s for copying them out; '
+            f'models busy {100*stats["gpu_busy"]/max(gpu_total, 1e-9):.0f}% of {gpu_total:.1f}s'
+        )
+
+    # Tasks that can be merged into one forward call: same submodel, and for the VAE the same frame shape.
+    def _task_key(self, task):
+        if task[0] == 0:
+            descriptor = task[1]
+            return (0, descriptor.shape[1:], descriptor.dtype)
+        return (task[0],)
+
+    def _task_size(self, task):
+        if task[0] == 0:
+            descriptor = task[1]
+            return math.prod(descriptor.shape) * getattr(torch, descriptor.dtype).itemsize
+        return len(task[1])
+
+    # Returns the next group of tasks to run as one forward call, or None when there are no more tasks. Waits up
+    # to max_wait for more tasks of the same kind, until the budget is reached. Other tasks are kept for later.
+    def _get_tasks(self, queue):
+        if self.pending_tasks:
+            first = self.pending_tasks.popleft()
+        elif self.queue_finished:
+            return None
+        else:
+            first = queue.get()
+            if first is None:
+                self.queue_finished = True
+                return None
+        if first[0] < 0:
+            return [first]
+        tasks = [first]
+        key = self._task_key(first)
+        size = self._task_size(first)
+        if first[0] != 0:
+            budget = self.max_text_batch
+        elif self.max_batch_bytes is not None:
+            budget = self.max_batch_bytes
+        else:
+            # Partial batches (the last one of each map call, or of a bucket) are merged into full ones, never
+            # into a bigger forward than caching_batch_size already allows.
+            budget = self.caching_batch_size * size // first[1].shape[0]
+        skipped = []
+        deadline = time.perf_counter() + self.max_wait
+        while size < budget:
+            if self.pending_tasks:
+                task = self.pending_tasks.popleft()
+            elif self.queue_finished:
+                break
+            else:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    task = queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if task is None:
+                    self.queue_finished = True
+                    break
+            task_size = self._task_size(task)
+            if self._task_key(task) == key and size + task_size <= budget:
+                tasks.append(task)
+                size += task_size
+            else:
+                skipped.append(task)
+        self.pending_tasks.extendleft(reversed(skipped))
+        return tasks
 
     @torch.no_grad()
-    def _handle_task(self, task):
-        id = task[0]
+    def _handle_tasks(self, tasks):
+        id = tasks[0][0]
+        if id < 0:
+            # Stage timing stats from a map worker.
+            worker_stats = tasks[0][1]
+            if self.telemetry is not None:
+                self.telemetry.record_worker_stats(worker_stats)
+            for k, v in worker_stats.items():
+                if isinstance(v, list):
+                    # Latency samples, only for telemetry.
+                    continue
+                self.stats[k] = max(self.stats[k], v) if k.endswith('_max_error') else self.stats[k] + v
+            return
         # moved needed submodel to cuda, and everything else to cpu
         if next(self.submodels[id].parameters()).device.type != 'cuda':
             for i, submodel in enumerate(self.submodels):
                 if i != id:
                     submodel.to('cpu')
             self.submodels[id].to('cuda')
+        forward_start = time.perf_counter()
         if id == 0:
-            tensor, pipe = task[1:]
+            tensors = [self.shm_attachments.read(task[1]) for task in tasks]
+            batch_sizes = [len(tensor) for tensor in tensors]
+            tensor = torch.cat(tensors) if len(tensors) > 1 else tensors[0]
             results = self.call_vae_fn(tensor)
+            del tensor, tensors
+            if self.latent_codec != 'none':
+                latents = results.pop('latents')
+                encoded = encode_latents(latents, self.latent_codec)
+                squared_error, squared_norm, max_error = round_trip_error(latents, encoded)
+                self.stats['codec_squared_error'] += squared_error
+                self.stats['codec_squared_norm'] += squared_norm
+                self.stats['codec_max_error'] = max(self.stats['codec_max_error'], max_error)
+                results.update(encoded)
         elif id > 0:
-            caption, is_video, pipe = task[1:]
-            results = self.call_text_encoder_fns[id-1](caption, is_video=is_video)
+            captions, is_video = [], []
+            for task in tasks:
+                captions.extend(task[1])
+                is_video.extend(task[2])
+            batch_sizes = [len(task[1]) for task in tasks]
+            results = self.call_text_encoder_fns[id-1](captions, is_video=is_video)
         else:
             raise RuntimeError()
         # Need to move to CPU here. If we don't, we get this error:
         # RuntimeError: Cannot re-initialize CUDA in forked subprocess. To use CUDA with multiprocessing, you must use the 'spawn' start method
         # I think this is because HF Datasets uses the multiprocess library (different from Python multiprocessing!) so it will always use fork.
         results = {k: v.to('cpu') for k, v in results.items()}
-        pipe.send(results)
+        if self.telemetry is not None:
+            # After the copy to CPU, which waits for the GPU.
+            self.telemetry.record_forward(id, sum(batch_sizes), time.perf_counter() - forward_start)
+        # Scatter the results back to each requester.
+        split_results = {k: torch.split(v, batch_sizes) for k, v in results.items()}
+        for i, task in enumerate(tasks):
+            task_results = {k: v[i] for k, v in split_results.items()}
+            if id == 0:
+                # Send the latents back through the worker's slab if they fit.
+                descriptors = self.shm_attachments.write_results(task_results, task[1].name)
+                if descriptors is not None:
+                    task[-1].send(descriptors)
+                    continue
+            # Pickling a view would send the whole underlying storage.
+            task[-1].send({k: v.clone() for k, v in task_results.items()})
 
 
 def split_batch(batch, pieces):
@@ -0,0 +1,43 @@
+from pathlib import Path
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from utils.common import atomic_write
+
+
+# Cache of resized, cropped video clips as uint8 arrays, independent of the VAE and the model. Re-encoding
+# latents (new VAE, dtype, model, or --regenerate_cache) then reads the frames from here instead of decoding
+# and resizing the video again. Each entry is one .npy file of shape (num_clips, 3, num_frames, height, width),
+# loaded memory-mapped.
+class FrameCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    # Everything that changes the cached frames is part of the key. The file's size and mtime catch modified files.
+    def key(self, filepath, **params):
+        stat = os.stat(filepath)
+        key_data = {'file': str(Path(filepath).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        key_data.update(params)
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f'{key}.npy'
+
+    def load(self, key):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            # Truncated or corrupt file, decode again.
+            return None
+
+    def save(self, key, clips):
+        path = self._path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        with atomic_write(path, suffix='.npy') as tmp_path:
+            np.save(tmp_path, clips)
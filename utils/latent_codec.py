@@ -0,0 +1,51 @@
+import torch
+
+
+LATENT_CODECS = ('none', 'bfloat16', 'float8')
+FLOAT8_MAX = torch.finfo(torch.float8_e4m3fn).max
+# Arrow has no bfloat16 or float8 type, so encoded latents are stored as integer views of the same bits.
+STORAGE_DTYPES = {'bfloat16': torch.int16, 'float8': torch.uint8}
+
+
+def validate_latent_codec(codec):
+    if codec not in LATENT_CODECS:
+        raise NotImplementedError(f'latent_cache_codec={codec} is not recognized. Options are: {", ".join(LATENT_CODECS)}')
+
+
+# Encodes a batch of latents (bs, channels, ...) for storage in the latent cache. Returns the columns to store.
+# float8 uses a shift and scale per item and channel, so every channel uses the full float8 range.
+def encode_latents(latents, codec):
+    if codec == 'none':
+        return {'latents': latents}
+    latents = latents.float()
+    if codec == 'bfloat16':
+        return {'latents': latents.to(torch.bfloat16).view(torch.int16)}
+    elif codec == 'float8':
+        dims = tuple(range(2, latents.ndim))
+        low = latents.amin(dim=dims, keepdim=True)
+        high = latents.amax(dim=dims, keepdim=True)
+        shift = (high + low) / 2
+        scale = ((high - low) / (2 * FLOAT8_MAX)).clamp(min=1e-12)
+        quantized = ((latents - shift) / scale).clamp(-FLOAT8_MAX, FLOAT8_MAX).to(torch.float8_e4m3fn).view(torch.uint8)
+        return {'latents': quantized, 'latents_scale': scale.flatten(1), 'latents_shift': shift.flatten(1)}
+    else:
+        raise NotImplementedError(f'latent_cache_codec={codec} is not recognized')
+
+
+# Inverse of encode_latents, returns float32. The codec is known from the storage dtype.
+def decode_latents(latents, scale=None, shift=None):
+    if latents.dtype == torch.int16:
+        return latents.view(torch.bfloat16).float()
+    elif latents.dtype == torch.uint8:
+        latents = latents.view(torch.float8_e4m3fn).float()
+        shape = tuple(scale.shape) + (1,) * (latents.ndim - scale.ndim)
+        return latents * scale.view(shape) + shift.view(shape)
+    return latents.float()
+
+
+# Squared error, squared norm and max absolute error of the round trip, for reporting.
+def round_trip_error(latents, encoded):
+    latents = latents.float()
+    decoded = decode_latents(encoded['latents'], encoded.get('latents_scale', None), encoded.get('latents_shift', None))
+    error = decoded - latents
+    return error.square().sum().item(), latents.square().sum().item(), error.abs().max().item()
@@ -0,0 +1,126 @@
+from pathlib import Path
+import os
+import json
+import hashlib
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from utils.common import atomic_write
+
+
+def _hash_file(filepath, h):
+    with open(filepath, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+
+
+# Hash of the contents of a file, or of all files under a directory. For identifying model weights.
+def hash_path(path):
+    path = Path(path)
+    h = hashlib.blake2b()
+    files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+    for filepath in files:
+        h.update(str(filepath.relative_to(path) if path.is_dir() else '').encode())
+        _hash_file(filepath, h)
+    return h.hexdigest()
+
+
+# Hash of the parameters and buffers of a loaded module, for models without a weights path to hash.
+def hash_module(module):
+    h = hashlib.blake2b()
+    for name, tensor in sorted(module.state_dict().items()):
+        h.update(f'{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode())
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+# Content-addressed store of encoded latents, shared by every directory, dataset config and run that points at
+# the same store_dir. An entry holds all clips of one media file, encoded for one size bucket. The key is a hash
+# of the file contents (and mask file contents), the preprocessing parameters, the VAE identity and the size
+# bucket, so the same clip in two directories or after a rename is encoded once. Bucket datasets store only
+# (key, clip) references, see SizeBucketDataset.
+class LatentStore:
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        # Content hashes of files already read by this process, by (path, size, mtime).
+        self.file_hashes = {}
+
+    def _file_hash(self, filepath):
+        stat = os.stat(filepath)
+        stat_key = (str(filepath), stat.st_size, stat.st_mtime_ns)
+        if stat_key not in self.file_hashes:
+            h = hashlib.blake2b()
+            _hash_file(filepath, h)
+            self.file_hashes[stat_key] = h.hexdigest()
+        return self.file_hashes[stat_key]
+
+    def key(self, filepath, mask_filepath, **params):
+        key_data = {
+            'file': self._file_hash(filepath),
+            'mask': self._file_hash(mask_filepath) if mask_filepath else None,
+        }
+        key_data.update(params)
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    # Path of an entry relative to store_dir, for copying entries to another store.
+    def relative_path(self, key):
+        return Path(key[:2]) / f'{key}.safetensors'
+
+    def _path(self, key):
+        return self.store_dir / self.relative_path(key)
+
+    # Number of clips in the entry, or None if there is no (readable) entry.
+    def num_clips(self, key):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            with safe_open(path, framework='pt') as f:
+                return int(f.metadata()['num_clips'])
+        except Exception:
+            # Truncated or corrupt file, encode again.
+            return None
+
+    # Returns the tensors of one clip, e.g. {'latents': ..., 'mask': ...}. Tensors that were None aren't stored,
+    # the caller fills them in.
+    def load(self, key, clip):
+        prefix = f'{clip}.'
+        with safe_open(self._path(key), framework='pt') as f:
+            return {name.removeprefix(prefix): f.get_tensor(name) for name in f.keys() if name.startswith(prefix)}
+
+    # clips is a list of dicts of tensors, one per clip. None values are skipped.
+    def save(self, key, clips):
+        path = self._path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        tensors = {
+            f'{i}.{name}': tensor.contiguous()
+            for i, clip in enumerate(clips)
+            for name, tensor in clip.items()
+            if tensor is not None
+        }
+        with atomic_write(path, suffix='.safetensors') as tmp_path:
+            save_file(tensors, tmp_path, metadata={'num_clips': str(len(clips))})
+
+    # Frame counts a media file is encoded for, at one resolution. group is the key of the entries without the
+    # frame count. Only used for slicing shorter latents from longer ones (prefix reuse), so a lost update
+    # just means an extra encode.
+    def _prefix_path(self, group):
+        return self.store_dir / 'prefixes' / group[:2] / f'{group}.json'
+
+    def get_prefix_frames(self, group):
+        try:
+            with open(self._prefix_path(group)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def add_prefix_frames(self, group, frames):
+        all_frames = self.get_prefix_frames(group)
+        if frames in all_frames:
+            return
+        path = self._prefix_path(group)
+        os.makedirs(path.parent, exist_ok=True)
+        with atomic_write(path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(sorted(all_frames + [frames]), f)
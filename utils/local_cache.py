@@ -0,0 +1,122 @@
+from contextlib import nullcontext
+from pathlib import Path
+import os
+import json
+import hashlib
+
+import torch
+import deepspeed.comm.comm as dist
+
+from utils.common import atomic_write
+
+
+CHUNK_SIZE = 64 << 20
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(path, manifest):
+    with atomic_write(path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+# Copies cache files from global rank 0 to local_cache_dir on every node, for clusters where the other nodes can't
+# see rank 0's filesystem, or where reading it during training is slow. files is {path relative to
+# local_cache_dir: source path}, only needed on rank 0. Must be called by all ranks.
+# The first rank of each node receives the files over a gloo group, so it works with any backend for training.
+# Every file is checked against a blake2b digest of what rank 0 read. A manifest of the copied files (with the
+# size and mtime of their source) makes later runs only copy new or modified files.
+def replicate_files(files, local_cache_dir):
+    local_cache_dir = Path(local_cache_dir)
+    local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+    is_node_leader = [None] * dist.get_world_size()
+    torch.distributed.all_gather_object(is_node_leader, local_rank == 0)
+    leader_ranks = [rank for rank, is_leader in enumerate(is_node_leader) if is_leader]
+    assert 0 in leader_ranks, 'Global rank 0 must have LOCAL_RANK 0'
+    # new_group() must be called by all ranks, even ranks that aren't in the group.
+    group = torch.distributed.new_group(leader_ranks, backend='gloo')
+
+    if local_rank == 0:
+        # Sources of all files, with the size and mtime that identify their current version.
+        entries = [None]
+        if dist.get_rank() == 0:
+            entries[0] = []
+            for local_path, source in sorted(files.items()):
+                stat = os.stat(source)
+                entries[0].append((local_path, source, stat.st_size, stat.st_mtime_ns))
+        torch.distributed.broadcast_object_list(entries, src=0, group=group)
+        entries = entries[0]
+
+        os.makedirs(local_cache_dir, exist_ok=True)
+        manifest_path = local_cache_dir / 'manifest.json'
+        manifest = _load_manifest(manifest_path)
+        needed = set()
+        for i, (local_path, source, size, mtime_ns) in enumerate(entries):
+            copied = manifest.get(local_path, None)
+            path = local_cache_dir / local_path
+            if copied is None or copied['source'] != [source, size, mtime_ns] or not path.exists() or path.stat().st_size != size:
+                needed.add(i)
+        all_needed = [None] * len(leader_ranks)
+        torch.distributed.all_gather_object(all_needed, needed, group=group)
+        to_send = sorted(set().union(*all_needed))
+        if dist.get_rank() == 0:
+            total_bytes = sum(entries[i][2] for i in to_send)
+            print(f'local_cache_dir: copying {len(to_send)} of {len(entries)} cache files ({total_bytes / 2**30:.2f} GiB) to {len(leader_ranks)} nodes')
+
+        for i in to_send:
+            local_path, source, size, mtime_ns = entries[i]
+            digest = _transfer_file(source, local_cache_dir / local_path, size, i in needed, group)
+            if i in needed:
+                manifest[local_path] = {'source': [source, size, mtime_ns], 'digest': digest}
+        _save_manifest(manifest_path, manifest)
+
+    # The other ranks of each node wait until their node has all the files.
+    dist.barrier()
+
+
+# Sends one file from rank 0 to all ranks in the group, in chunks. Ranks that already have the file still take
+# part in the broadcasts, but don't write anything. Returns the digest of the source file.
+def _transfer_file(source, path, size, write, group):
+    sender = (dist.get_rank() == 0)
+    h = hashlib.blake2b()
+    if write:
+        os.makedirs(path.parent, exist_ok=True)
+    # A file with a checksum mismatch is never renamed to path.
+    with (atomic_write(path) if write else nullcontext()) as tmp_path:
+        f = open(source, 'rb') if sender else None
+        out = open(tmp_path, 'wb') if write else None
+        try:
+            for offset in range(0, size, CHUNK_SIZE):
+                chunk_size = min(CHUNK_SIZE, size - offset)
+                if sender:
+                    data = f.read(chunk_size)
+                    if len(data) != chunk_size:
+                        raise RuntimeError(f'{source} changed while copying it to local_cache_dir')
+                    chunk = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+                else:
+                    chunk = torch.empty(chunk_size, dtype=torch.uint8)
+                torch.distributed.broadcast(chunk, src=0, group=group)
+                if write and not sender:
+                    data = chunk.numpy().tobytes()
+                if sender or write:
+                    h.update(data)
+                if write:
+                    out.write(data)
+        finally:
+            if f is not None:
+                f.close()
+            if out is not None:
+                out.close()
+
+        digest = [h.hexdigest() if sender else None]
+        torch.distributed.broadcast_object_list(digest, src=0, group=group)
+        digest = digest[0]
+        if write and h.hexdigest() != digest:
+            raise RuntimeError(f'Checksum mismatch copying {source} to {path}')
+    return digest
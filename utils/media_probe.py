@@ -0,0 +1,157 @@
+import math
+from fractions import Fraction
+
+import numpy as np
+import imageio
+import av
+
+
+DEFAULT_VIDEO_BACKEND = 'pyav'
+# Tolerance (in seconds) when comparing frame timestamps to output sample times.
+TIMESTAMP_EPSILON = 1e-6
+
+
+# Maps native frame timestamps (seconds, sorted, relative to the first frame) to the native frame index used for
+# each output frame when resampling to fps. Each output frame at time k/fps uses the latest native frame whose
+# timestamp is <= k/fps. end_time is when the last native frame stops being displayed.
+def resample_indices(timestamps, end_time, fps):
+    if len(timestamps) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    num_output_frames = max(math.ceil(end_time * fps - TIMESTAMP_EPSILON), 1)
+    output_times = np.arange(num_output_frames) / fps
+    indices = np.searchsorted(timestamps, output_times + TIMESTAMP_EPSILON, side='right') - 1
+    return np.clip(indices, 0, len(timestamps) - 1)
+
+
+# Reads video metadata from the container without decoding any pixels. Frame counts and timestamps come from the
+# stream headers when the stream is constant frame rate, otherwise from demuxing packet timestamps (still no
+# decoding). Decoding goes through the same resampling, so the frame count from probe() is exactly the number of
+# frames iter_frames() yields. The non-exact probe never demuxes, for variable frame rate streams the frame count
+# is estimated from the header duration.
+class PyAVBackend:
+    name = 'pyav'
+
+    def __init__(self, framerate):
+        self.framerate = framerate
+
+    def probe(self, path, exact=True):
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            width, height = stream.codec_context.width, stream.codec_context.height
+            if not exact:
+                return self._probe_header(container, stream, width, height)
+            timestamps, end_time = self._timestamps(container, stream)
+        return {
+            'width': width,
+            'height': height,
+            'frames': len(resample_indices(timestamps, end_time, self.framerate)),
+            'native_frames': len(timestamps),
+            'duration': float(end_time),
+        }
+
+    def _probe_header(self, container, stream, width, height):
+        if self._is_constant_frame_rate(stream):
+            timestamps, end_time = self._timestamps(container, stream)
+            frames = len(resample_indices(timestamps, end_time, self.framerate))
+            return {'width': width, 'height': height, 'frames': frames, 'native_frames': len(timestamps), 'duration': float(end_time)}
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration is not None:
+            duration = container.duration / av.time_base
+        else:
+            duration = 0.
+        frames = max(math.ceil(duration * self.framerate - TIMESTAMP_EPSILON), 1)
+        return {'width': width, 'height': height, 'frames': frames, 'native_frames': stream.frames or None, 'duration': duration}
+
+    def iter_frames(self, path):
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            timestamps, end_time = self._timestamps(container, stream)
+        indices = resample_indices(timestamps, end_time, self.framerate)
+        if len(indices) == 0:
+            return
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = 'AUTO'
+            j = 0
+            # Decoder outputs frames in presentation order, which is the order of the sorted timestamps.
+            for i, frame in enumerate(container.decode(stream)):
+                if indices[j] != i:
+                    continue
+                array = frame.to_ndarray(format='rgb24')
+                while j < len(indices) and indices[j] == i:
+                    yield array
+                    j += 1
+                if j == len(indices):
+                    # Don't decode frames past the last one we need.
+                    break
+
+    def _is_constant_frame_rate(self, stream):
+        average_rate = stream.average_rate
+        guessed_rate = getattr(stream, 'guessed_rate', None)
+        return stream.frames > 0 and average_rate and guessed_rate and Fraction(average_rate) == Fraction(guessed_rate)
+
+    def _timestamps(self, container, stream):
+        average_rate = stream.average_rate
+        if self._is_constant_frame_rate(stream):
+            # Constant frame rate, the headers tell us everything.
+            rate = float(average_rate)
+            return np.arange(stream.frames) / rate, stream.frames / rate
+        # Variable frame rate or no frame count in the header. Demux to get the presentation timestamps.
+        pts = []
+        durations = []
+        for packet in container.demux(stream):
+            # Flush packets at the end of the stream have no pts.
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            durations.append(packet.duration or 0)
+        if len(pts) == 0:
+            return np.zeros((0,)), 0.
+        time_base = float(stream.time_base)
+        pts = np.array(pts, dtype=np.int64)
+        order = np.argsort(pts, kind='stable')
+        timestamps = (pts[order] - pts[order[0]]) * time_base
+        last_duration = durations[order[-1]] * time_base
+        if last_duration <= 0:
+            last_duration = 1 / float(average_rate) if average_rate else 1 / self.framerate
+        return timestamps, timestamps[-1] + last_duration
+
+
+# The original imageio-based behavior. The non-exact probe estimates the frame count from the container duration,
+# and decodes the first frame to get the resolution. The exact probe decodes the whole video.
+class ImageioBackend:
+    name = 'imageio'
+
+    def __init__(self, framerate):
+        self.framerate = framerate
+
+    def probe(self, path, exact=False):
+        if exact:
+            frames = 0
+            for frame in imageio.v3.imiter(path, fps=self.framerate):
+                frames += 1
+                height, width = frame.shape[:2]
+            return {'width': width, 'height': height, 'frames': frames}
+        meta = imageio.v3.immeta(path)
+        first_frame = next(imageio.v3.imiter(path))
+        height, width = first_frame.shape[:2]
+        # TODO: this is an estimate of frame count. What happens if variable frame rate? Is
+        # it still close enough?
+        return {'width': width, 'height': height, 'frames': int(self.framerate * meta['duration']), 'duration': meta['duration']}
+
+    def iter_frames(self, path):
+        return imageio.v3.imiter(path, fps=self.framerate)
+
+
+VIDEO_BACKENDS = {
+    'pyav': PyAVBackend,
+    'imageio': ImageioBackend,
+}
+
+
+def get_video_backend(name, framerate):
+    if name not in VIDEO_BACKENDS:
+        raise NotImplementedError(f'video_backend={name} is not recognized')
+    assert framerate is not None, "Need model framerate but don't have it. This shouldn't happen. Is the framerate attribute on the model set?"
+    return VIDEO_BACKENDS[name](framerate)
@@ -0,0 +1,69 @@
+from pathlib import Path
+import os
+import json
+
+from deepspeed.utils.logging import logger
+
+from utils.common import atomic_write
+
+
+INDEX_VERSION = 1
+
+
+# Persistent per-file metadata index for one directory. Each media file's probe result (resolution, frame count,
+# raw caption) is stored keyed by the file path, together with a stat key of (file size, file mtime, caption mtime).
+# On a rescan, only files whose stat key changed (or which are new) need to be probed again.
+# The probe_config is stored in the index header. If it changes (e.g. different model framerate), the whole
+# index is invalidated, since frame counts depend on it.
+class MetadataIndex:
+    def __init__(self, path, probe_config, regenerate=False):
+        self.path = Path(path)
+        self.probe_config = probe_config
+        self.entries = {}
+        self.dirty = False
+        if not regenerate and self.path.exists():
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f'Metadata index {self.path} could not be read, rebuilding it.')
+                data = None
+            if data is not None and data.get('version') == INDEX_VERSION and data.get('probe_config') == probe_config:
+                self.entries = data['entries']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, image_file, stat_key):
+        entry = self.entries.get(image_file, None)
+        if entry is None or entry['stat_key'] != list(stat_key):
+            return None
+        return entry
+
+    def update(self, image_file, stat_key, probe_result):
+        entry = dict(probe_result)
+        entry['stat_key'] = list(stat_key)
+        self.entries[image_file] = entry
+        self.dirty = True
+
+    # Drop entries for files that no longer exist.
+    def prune(self, image_files):
+        image_files = set(image_files)
+        for image_file in list(self.entries.keys()):
+            if image_file not in image_files:
+                del self.entries[image_file]
+                self.dirty = True
+
+    # Adds the entries of another index, e.g. one written by a cache shard.
+    def merge(self, other):
+        if other.entries:
+            self.entries.update(other.entries)
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.path.parent, exist_ok=True)
+        with atomic_write(self.path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'probe_config': self.probe_config, 'entries': self.entries}, f)
+        self.dirty = False
@@ -0,0 +1,107 @@
+from pathlib import Path
+import os
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+import imageio
+import multiprocess as mp
+from tqdm import tqdm
+
+from utils.common import VIDEO_EXTENSIONS
+from utils.media_probe import get_video_backend
+
+
+# Files per task sent to a worker process. Large batches amortize the IPC, and give each worker's thread pool
+# enough files to keep the storage queue full.
+PROBE_BATCH_SIZE = 256
+# Below this many files, probing in the current process is faster than starting worker processes.
+MIN_FILES_FOR_WORKERS = 64
+MIN_THREADS_PER_WORKER = 4
+MAX_THREADS_PER_WORKER = 32
+LATENCY_SAMPLE_SIZE = 16
+
+
+# Probes a single file. Reads the caption file, resolution and frame count. Unreadable media files get None
+# for width, height and frames.
+def probe_media_file(image_file, caption_file, framerate, video_backend):
+    caption = None
+    if caption_file:
+        with open(caption_file) as f:
+            caption = f.read().strip()
+
+    image_file = Path(image_file)
+    if image_file.suffix == '.webp':
+        frames = imageio.get_reader(image_file).get_length()
+        if frames > 1:
+            raise NotImplementedError('WebP videos are not supported.')
+    try:
+        if image_file.suffix in VIDEO_EXTENSIONS:
+            meta = get_video_backend(video_backend, framerate).probe(image_file)
+            width, height, frames = meta['width'], meta['height'], meta['frames']
+        else:
+            pil_img = Image.open(image_file)
+            width, height = pil_img.size
+            frames = 1
+    except Exception:
+        # Recorded in the index, so broken files aren't probed again until they change.
+        width, height, frames = None, None, None
+
+    return {'caption': caption, 'width': width, 'height': height, 'frames': frames}
+
+
+def _probe_batch(args):
+    batch, num_threads = args
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(lambda task: probe_media_file(*task), batch))
+
+
+# Median time to stat a file and read its first block. Network filesystems are orders of magnitude slower than
+# local disks here, and need many more requests in flight to reach full throughput.
+def measure_storage_latency(paths):
+    latencies = []
+    for path in paths[:LATENCY_SAMPLE_SIZE]:
+        start = time.perf_counter()
+        os.stat(path)
+        with open(path, 'rb') as f:
+            f.read(4096)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2] if latencies else 0.
+
+
+# Probes all tasks, a list of (image_file, caption_file, framerate, video_backend) tuples, potentially from many
+# directories. Tasks are split into large batches spread over worker processes, and each worker probes its batch
+# with a thread pool. Returns the probe results in the same order as the tasks.
+def probe_media_files(tasks):
+    if len(tasks) == 0:
+        return []
+    start = time.perf_counter()
+    # Sample files spread over the whole list, so multiple directories on different storage all get measured.
+    stride = max(len(tasks) // LATENCY_SAMPLE_SIZE, 1)
+    latency = measure_storage_latency([task[0] for task in tasks[::stride]])
+    num_threads = int(min(MAX_THREADS_PER_WORKER, max(MIN_THREADS_PER_WORKER, 4 * latency * 1000)))
+
+    # Smaller batches for small file counts, so every core still gets work.
+    batch_size = max(min(PROBE_BATCH_SIZE, math.ceil(len(tasks) / os.cpu_count())), 1)
+    batches = [(tasks[i:i+batch_size], num_threads) for i in range(0, len(tasks), batch_size)]
+    if len(tasks) < MIN_FILES_FOR_WORKERS:
+        num_workers = 0
+        results = _probe_batch((tasks, num_threads))
+    else:
+        num_workers = min(os.cpu_count(), len(batches))
+        results = []
+        with mp.Pool(num_workers) as pool:
+            with tqdm(total=len(tasks), desc='probing media files') as pbar:
+                for batch_results in pool.imap(_probe_batch, batches):
+                    results.extend(batch_results)
+                    pbar.update(len(batch_results))
+
+    duration = time.perf_counter() - start
+    workers_str = f'{num_workers} workers' if num_workers > 0 else 'in process'
+    print(
+        f'probed {len(tasks)} media files in {duration:.2f}s ({len(tasks)/max(duration, 1e-9):.1f} files/s, '
+        f'{workers_str} x {num_threads} threads, storage latency {latency*1000:.2f}ms)'
+    )
+    return results
@@ -0,0 +1,65 @@
+import copy
+
+import torch
+from deepspeed.utils.logging import logger
+
+
+# KV cache of the fixed prompt template prefix of a causal LM text encoder. Every caption is wrapped in the same
+# template, and the hidden states of the template prefix (the crop_start tokens) are cropped off anyway, so the
+# prefix is encoded once per template and only the caption tokens run through the model. Causal attention means
+# the caption tokens see exactly the same keys and values either way. The first batch of every prefix is also run
+# the normal way and compared: if the outputs aren't bitwise equal (some attention kernels tile differently for
+# different query lengths), the cache is turned off for that prefix.
+class PrefixKVCache:
+    def __init__(self, model):
+        self.model = model
+        # {(device, dtype, prefix token ids): past_key_values, or None if the outputs didn't match}
+        self.prefixes = {}
+
+    def _full_forward(self, input_ids, attention_mask, prefix_len):
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+        return outputs.last_hidden_state[:, prefix_len:], tuple(hidden_state[:, prefix_len:] for hidden_state in outputs.hidden_states)
+
+    def _cached_forward(self, past_key_values, input_ids, attention_mask, prefix_len):
+        # The cache is appended to during the forward, so every call gets its own copy.
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(input_ids.shape[0])
+        outputs = self.model(
+            input_ids=input_ids[:, prefix_len:],
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_hidden_states=True,
+        )
+        return outputs.last_hidden_state, outputs.hidden_states
+
+    # Returns the last hidden state and the hidden states of every layer of model(input_ids, attention_mask,
+    # output_hidden_states=True), cropped to the positions from prefix_len on. Falls back to the normal forward if
+    # the rows don't share the same prefix, or if the prefix has padding.
+    @torch.no_grad()
+    def forward(self, input_ids, attention_mask, prefix_len):
+        assert 0 < prefix_len < input_ids.shape[1]
+        prefix_ids = input_ids[0, :prefix_len]
+        if (input_ids[:, :prefix_len] != prefix_ids).any():
+            return self._full_forward(input_ids, attention_mask, prefix_len)
+        if attention_mask is not None and not attention_mask[:, :prefix_len].all():
+            return self._full_forward(input_ids, attention_mask, prefix_len)
+
+        key = (str(input_ids.device), self.model.dtype, tuple(prefix_ids.tolist()))
+        if key in self.prefixes:
+            past_key_values = self.prefixes[key]
+            if past_key_values is None:
+                return self._full_forward(input_ids, attention_mask, prefix_len)
+            return self._cached_forward(past_key_values, input_ids, attention_mask, prefix_len)
+
+        past_key_values = self.model(input_ids=prefix_ids.unsqueeze(0), use_cache=True).past_key_values
+        cached = self._cached_forward(past_key_values, input_ids, attention_mask, prefix_len)
+        full = self._full_forward(input_ids, attention_mask, prefix_len)
+        # Only positions inside the attention mask are used downstream.
+        mask = (attention_mask[:, prefix_len:] != 0) if attention_mask is not None else torch.ones(full[0].shape[:2], dtype=torch.bool, device=input_ids.device)
+        if all(torch.equal(a[mask], b[mask]) for a, b in zip((cached[0],) + cached[1], (full[0],) + full[1])):
+            self.prefixes[key] = past_key_values
+        else:
+            logger.warning(f'Prefix KV cache output differs from the full forward for a {prefix_len} token prompt template prefix, not using the cache for it')
+            self.prefixes[key] = None
+        return full
@@ -0,0 +1,31 @@
+from pathlib import Path
+import os
+import json
+
+from utils.common import atomic_write
+
+
+# Segments whose cache files all still exist, oldest first, from the segment index of a cache. The index is a
+# directory with one JSON file per segment. Each file is written once, so processes caching different items into
+# the same cache directory (e.g. tools/build_cache.py shards) never overwrite each other's segments.
+def load_segment_index(index_dir):
+    if not index_dir.exists():
+        return []
+    segments = []
+    for segment_file in index_dir.glob('*.json'):
+        try:
+            with open(segment_file) as f:
+                segment = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if all((index_dir.parent / cache_file).exists() for cache_file in segment['cache_files']):
+            segments.append(segment)
+    return sorted(segments, key=lambda segment: segment['created'])
+
+
+# Writes (or replaces) the JSON file of a segment, named after its first cache file.
+def save_segment(index_dir, segment):
+    os.makedirs(index_dir, exist_ok=True)
+    segment_file = Path(index_dir) / f'{Path(segment["cache_files"][0]).stem}.json'
+    with atomic_write(segment_file) as tmp_file, open(tmp_file, 'w') as f:
+        json.dump(segment, f)
@@ -0,0 +1,220 @@
+from pathlib import Path
+import os
+import math
+import mmap
+import json
+import struct
+
+import numpy as np
+import pyarrow as pa
+import torch
+
+from utils.common import atomic_write
+
+
+# Flat, memory-mapped cache file. Each tensor column is stored as the raw bytes of every row back to back, with an
+# offset index and a shape index, so a row is read as a torch.frombuffer() view with no copy and no deserialization.
+# Rows can have different shapes, and None rows. Other columns (file names, captions) are stored as JSON.
+# Layout: MAGIC, column data and indexes (each aligned to ALIGNMENT), JSON header, header offset (uint64), MAGIC.
+# A shard is a copy: the Arrow cache files it's written from are kept, because they are the item-level cache (segment
+# index, staleness check, verify_cache) that later runs reuse. cache_format='shard' about doubles the cache's disk use.
+CACHE_FORMATS = ('arrow', 'shard')
+MAGIC = b'DPSHARD1'
+ALIGNMENT = 64
+FOOTER = struct.Struct('<Q8s')
+
+
+def _pad(f):
+    padding = -f.tell() % ALIGNMENT
+    f.write(b'\0' * padding)
+
+
+def _write_array(f, array):
+    _pad(f)
+    offset = f.tell()
+    f.write(np.ascontiguousarray(array).tobytes())
+    return offset
+
+
+def _torch_dtype(name):
+    return getattr(torch, name)
+
+
+# Writes a Dataset (torch format) to a shard. Values are stored exactly as the dataset returns them, except for
+# columns in column_dtypes, which are cast first. source is stored in the header, for checking staleness later.
+def write_shard(path, dataset, column_dtypes=None, source=None):
+    column_dtypes = column_dtypes or {}
+    path = Path(path)
+    num_rows = len(dataset)
+    header = {'num_rows': num_rows, 'source': source, 'tensors': {}, 'objects': {}}
+    with atomic_write(path) as tmp_path:
+        _write_shard(tmp_path, dataset, column_dtypes, header)
+
+
+# Rows are read from the Arrow table in batches of about this many bytes, and each batch is written with one call.
+WRITE_BATCH_BYTES = 64 * 2**20
+
+
+# Numeric and bool leaf types are tensor columns, anything else (strings, all-null columns) is stored as JSON.
+def _leaf_type(arrow_type):
+    if isinstance(arrow_type, pa.ExtensionType):
+        arrow_type = arrow_type.storage_type
+    ndim = 0
+    while pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type) or pa.types.is_fixed_size_list(arrow_type):
+        arrow_type = arrow_type.value_type
+        ndim += 1
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_boolean(arrow_type):
+        return arrow_type, ndim
+    return None, ndim
+
+
+# The dtype the torch formatter of the dataset gives a leaf type.
+def _default_dtype(arrow_type):
+    if pa.types.is_boolean(arrow_type):
+        return torch.bool
+    if pa.types.is_floating(arrow_type):
+        return torch.float32
+    return torch.int64
+
+
+# Flattens a column of nested lists without copying. Returns whether each row is present, the shape of each row, the
+# leaf values, and the range of leaf values of each row. Nested lists of a row are contiguous in the leaf values.
+def _flatten_column(array, ndim):
+    if isinstance(array, pa.ExtensionArray):
+        array = array.storage
+    num_rows = len(array)
+    present = np.ones(num_rows, dtype=bool) if array.null_count == 0 else ~array.is_null().to_numpy(zero_copy_only=False)
+    shapes = np.zeros((num_rows, ndim), dtype=np.int64)
+    starts = np.arange(num_rows, dtype=np.int64)
+    ends = starts + 1
+    for dim in range(ndim):
+        offsets = array.offsets.to_numpy() if not pa.types.is_fixed_size_list(array.type) else None
+        if offsets is None:
+            size = array.type.list_size
+            offsets = (np.arange(len(array) + 1, dtype=np.int64) + array.offset) * size
+        offsets = offsets.astype(np.int64)
+        # Tensors are rectangular, the size of each dimension is the length of the first list at that level.
+        first = np.minimum(starts, len(offsets) - 2)
+        shapes[:, dim] = np.where(ends > starts, offsets[first+1] - offsets[first], 0)
+        starts, ends = offsets[starts], offsets[ends]
+        array = array.values
+    values = array.to_numpy(zero_copy_only=False)
+    return present, shapes, values, starts, ends
+
+
+# Leaf values cast to dtype, as a buffer. numpy has no bfloat16, that cast goes through torch.
+def _to_bytes(values, dtype):
+    if dtype == torch.bfloat16:
+        return torch.from_numpy(values.astype(np.float32)).to(dtype).view(torch.uint8).numpy().data
+    return np.ascontiguousarray(values, dtype=torch.empty(0, dtype=dtype).numpy().dtype).data
+
+
+def _write_shard(tmp_path, dataset, column_dtypes, header):
+    num_rows = header['num_rows']
+    # Rows in dataset order, with any indices mapping (select(), shuffle()) applied.
+    arrow_dataset = dataset.with_format('arrow')
+    row_bytes = max(dataset.data.nbytes // max(len(dataset.data), 1), 1)
+    batch_size = max(WRITE_BATCH_BYTES // row_bytes, 1)
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for name in dataset.column_names:
+            leaf_type, ndim = _leaf_type(dataset.data.schema.field(name).type)
+            values = arrow_dataset.select_columns([name])
+            if leaf_type is None or dataset.data.column(name).null_count == len(dataset.data):
+                header['objects'][name] = [value for batch in values.iter(batch_size) for value in batch.column(name).to_pylist()]
+                continue
+            dtype = column_dtypes.get(name, _default_dtype(leaf_type))
+            offsets = np.zeros(num_rows + 1, dtype=np.int64)
+            # First entry of each row is 1 if the row is present, 0 if it's None. Then the shape.
+            shapes = np.zeros((num_rows, ndim+1), dtype=np.int64)
+            _pad(f)
+            data_offset = f.tell()
+            row = 0
+            for batch in values.iter(batch_size):
+                for chunk in batch.column(name).chunks:
+                    present, chunk_shapes, leaf_values, starts, ends = _flatten_column(chunk, ndim)
+                    end = row + len(chunk)
+                    shapes[row:end, 0] = present
+                    shapes[row:end, 1:] = np.where(present[:, None], chunk_shapes, 0)
+                    lengths = np.where(present, ends - starts, 0)
+                    offsets[row+1:end+1] = offsets[row] + np.cumsum(lengths * dtype.itemsize)
+                    if len(chunk) > 0 and np.array_equal(starts[1:], ends[:-1]) and present.all():
+                        # Usual case: rows back to back in the leaf values, one write for the whole chunk.
+                        ranges = [(starts[0], ends[-1])]
+                    else:
+                        ranges = [(start, stop) for start, stop, is_present in zip(starts, ends, present) if is_present]
+                    for start, stop in ranges:
+                        f.write(_to_bytes(leaf_values[start:stop], dtype))
+                    row = end
+            assert row == num_rows and f.tell() - data_offset == offsets[-1]
+            header['tensors'][name] = {
+                'dtype': str(dtype).removeprefix('torch.'),
+                'data_offset': data_offset,
+                'offsets_offset': _write_array(f, offsets),
+                'shapes_offset': _write_array(f, shapes),
+                'ndim': ndim + 1,
+            }
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode())
+        f.write(FOOTER.pack(header_offset, MAGIC))
+
+
+def read_shard_source(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-FOOTER.size, os.SEEK_END)
+            header_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                return None
+            f.seek(header_offset)
+            header = json.loads(f.read()[:-FOOTER.size])
+        return header['source']
+    except (OSError, ValueError):
+        return None
+
+
+class Shard:
+    def __init__(self, path):
+        self.path = str(path)
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            # Private copy-on-write mapping. Nothing ever writes to it, but torch.frombuffer() wants a writable buffer.
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        header_offset, magic = FOOTER.unpack(self.mmap[-FOOTER.size:])
+        assert magic == MAGIC, f'{self.path} is not a shard file'
+        header = json.loads(self.mmap[header_offset:len(self.mmap)-FOOTER.size])
+        self.num_rows = header['num_rows']
+        self.objects = header['objects']
+        self.tensors = {}
+        for name, column in header['tensors'].items():
+            offsets = np.frombuffer(self.mmap, dtype=np.int64, count=self.num_rows+1, offset=column['offsets_offset'])
+            shapes = np.frombuffer(self.mmap, dtype=np.int64, count=self.num_rows*column['ndim'], offset=column['shapes_offset'])
+            self.tensors[name] = (_torch_dtype(column['dtype']), column['data_offset'], offsets, shapes.reshape(self.num_rows, column['ndim']))
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx):
+        ret = {}
+        for name, (dtype, data_offset, offsets, shapes) in self.tensors.items():
+            present, *shape = (int(x) for x in shapes[idx])
+            shape = tuple(shape)
+            if not present:
+                ret[name] = None
+            elif offsets[idx+1] == offsets[idx]:
+                ret[name] = torch.empty(shape, dtype=dtype)
+            else:
+                ret[name] = torch.frombuffer(self.mmap, dtype=dtype, count=math.prod(shape), offset=data_offset + int(offsets[idx])).view(shape)
+        for name, values in self.objects.items():
+            ret[name] = values[idx]
+        return ret
+
+    # mmap objects can't be pickled. Reopen the file instead, e.g. in spawned dataloader workers.
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
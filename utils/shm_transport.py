@@ -0,0 +1,166 @@
+import os
+import math
+from collections import OrderedDict
+from typing import NamedTuple
+
+import torch
+from multiprocess import shared_memory, resource_tracker
+from multiprocess.util import Finalize
+
+
+# Tensors in a slab start at multiples of this.
+SLAB_ALIGNMENT = 64
+MIN_SLAB_SIZE = 1 << 20
+# Free slabs a worker keeps around for reuse.
+MAX_FREE_SLABS = 4
+# Shared memory segments a GPU rank keeps mapped. Workers replace their slabs when they need bigger ones, so old
+# segments eventually stop being used.
+MAX_ATTACHED_SEGMENTS = 64
+
+
+def _align(n):
+    return (n + SLAB_ALIGNMENT - 1) // SLAB_ALIGNMENT * SLAB_ALIGNMENT
+
+
+def _nbytes(shape, dtype):
+    return math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # A tensor view of the segment still exists. The mapping goes away with the process.
+        pass
+
+
+# Small, picklable reference to a tensor stored in a shared memory segment. This is what goes through the queue
+# instead of the tensor data.
+class TensorDescriptor(NamedTuple):
+    name: str
+    offset: int
+    shape: tuple
+    dtype: str
+
+
+def _view(buf, descriptor):
+    dtype = getattr(torch, descriptor.dtype)
+    count = math.prod(descriptor.shape)
+    if count == 0:
+        return torch.empty(descriptor.shape, dtype=dtype)
+    return torch.frombuffer(buf, dtype=dtype, count=count, offset=descriptor.offset).view(descriptor.shape)
+
+
+# One shared memory segment owned by a map worker. Holds one batch at a time: the worker writes the input
+# frames, the GPU rank reads them in place and writes the latents back into the same segment.
+class Slab:
+    def __init__(self, size):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+
+    # Returns an uninitialized tensor backed by the slab, and its descriptor. Use as the out= of the op producing
+    # the batch, so the batch is written to shared memory directly.
+    def empty(self, shape, dtype):
+        shape = tuple(shape)
+        assert _nbytes(shape, dtype) <= self.size
+        descriptor = TensorDescriptor(self.name, 0, shape, str(dtype).removeprefix('torch.'))
+        return _view(self.shm.buf, descriptor), descriptor
+
+    def read(self, descriptor):
+        assert descriptor.name == self.name
+        return _view(self.shm.buf, descriptor)
+
+    def close(self):
+        _close(self.shm)
+        self.shm.unlink()
+
+
+# Per worker process pool of slabs. A slab is acquired for each batch sent to the GPU ranks, and released once
+# the results are copied out.
+class SlabAllocator:
+    def __init__(self):
+        self.free_slabs = []
+        self.pid = os.getpid()
+        # Unlink the segments when the worker process exits.
+        Finalize(self, self.close, exitpriority=10)
+
+    def acquire(self, nbytes):
+        candidates = [slab for slab in self.free_slabs if slab.size >= nbytes]
+        if candidates:
+            slab = min(candidates, key=lambda slab: slab.size)
+            self.free_slabs.remove(slab)
+            return slab
+        size = MIN_SLAB_SIZE
+        while size < nbytes:
+            size *= 2
+        return Slab(size)
+
+    def release(self, slab):
+        self.free_slabs.append(slab)
+        if len(self.free_slabs) > MAX_FREE_SLABS:
+            smallest = min(self.free_slabs, key=lambda slab: slab.size)
+            self.free_slabs.remove(smallest)
+            smallest.close()
+
+    def close(self):
+        for slab in self.free_slabs:
+            slab.close()
+        self.free_slabs = []
+
+
+_allocator = None
+
+
+def get_slab_allocator():
+    global _allocator
+    # Forked processes must not reuse the parent's slabs.
+    if _allocator is None or _allocator.pid != os.getpid():
+        _allocator = SlabAllocator()
+    return _allocator
+
+
+# GPU rank side. Maps worker slabs by name, reads inputs in place and writes results back.
+class SharedMemoryAttachments:
+    def __init__(self):
+        self.segments = OrderedDict()
+
+    def _get(self, name):
+        if name in self.segments:
+            self.segments.move_to_end(name)
+            return self.segments[name]
+        shm = shared_memory.SharedMemory(name=name)
+        # The worker owns the segment. Without this, the resource tracker of this process would unlink it when
+        # this process exits.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        self.segments[name] = shm
+        while len(self.segments) > MAX_ATTACHED_SEGMENTS:
+            _, old_shm = self.segments.popitem(last=False)
+            _close(old_shm)
+        return shm
+
+    def read(self, descriptor):
+        return _view(self._get(descriptor.name).buf, descriptor)
+
+    # Writes the result tensors into the slab the input came from, overwriting the input. Returns a dict of
+    # descriptors, or None if the results don't fit, in which case the caller sends the tensors themselves.
+    def write_results(self, results, name):
+        shm = self._get(name)
+        offsets = {}
+        offset = 0
+        for k, v in results.items():
+            offsets[k] = offset
+            offset = _align(offset + v.numel() * v.element_size())
+        if offset > shm.size:
+            return None
+        descriptors = {}
+        for k, v in results.items():
+            descriptor = TensorDescriptor(name, offsets[k], tuple(v.shape), str(v.dtype).removeprefix('torch.'))
+            _view(shm.buf, descriptor).copy_(v)
+            descriptors[k] = descriptor
+        return descriptors
+
+    def close(self):
+        for shm in self.segments.values():
+            _close(shm)
+        self.segments.clear()